@@ -0,0 +1,67 @@
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import WD_N_CELLS
+from frontend_digitizers_calibration.smooth_minmax import get_window_index
+
+MINMAX_WINDOW_SIZE = 21
+
+
+class CalibrationBuffers(object):
+    """
+    Preallocated arrays to calibrate the channels of a device without allocations per pulse.
+    There is a row for the signal and one for the background waveform of each channel - messages without background
+    waveforms use only the first n_channels rows.
+    The calibrated data is sent out as views of the output arrays, so they are used in rotation: an output array
+    is overwritten only n_sets pulses after it was handed out.
+    """
+
+    def __init__(self, n_channels, n_sets=2):
+        """
+        :param n_channels: Number of channels of the device.
+        :param n_sets: Number of output arrays to rotate.
+        """
+        self.n_channels = n_channels
+        self.n_sets = n_sets
+        n_rows = 2 * n_channels
+
+        self.outputs = [numpy.empty((n_rows, WD_N_CELLS), dtype=numpy.float32) for _ in range(n_sets)]
+        self.output_index = 0
+
+        # Message values.
+        self.trigger_cells = numpy.empty(n_rows, dtype=numpy.int32)
+        self.gains = numpy.empty(n_rows, dtype=numpy.float32)
+
+        # Workspace of VoltageCalibration.calibrate_many.
+        self.row_offsets = numpy.empty(n_rows, dtype=numpy.intp)
+        self.cell_index = numpy.empty((n_rows, WD_N_CELLS), dtype=numpy.intp)
+        self.table = numpy.empty((n_rows, WD_N_CELLS), dtype=numpy.float32)
+        self.second_table = numpy.empty((n_rows, WD_N_CELLS), dtype=numpy.float32)
+        self.mask = numpy.empty((n_rows, WD_N_CELLS), dtype=bool)
+
+        # Workspace of find_minmax.
+        self.minmax_windows = numpy.empty((n_rows,) + get_window_index(WD_N_CELLS, MINMAX_WINDOW_SIZE).shape,
+                                          dtype=numpy.float32)
+
+    def next_output(self):
+        """
+        :return: The next output array in the rotation.
+        """
+        output = self.outputs[self.output_index]
+        self.output_index = (self.output_index + 1) % self.n_sets
+
+        return output
+
+
+def allocate_device_buffers(devices, n_sets):
+    """
+    Allocate the calibration buffers of all the devices from the configuration.
+    :param devices: Devices section of the configuration.
+    :param n_sets: Number of output arrays to rotate, 0 to not preallocate.
+    :return: Dictionary with device_name: CalibrationBuffers, None if n_sets is 0.
+    """
+    if not n_sets:
+        return None
+
+    return {device_name: CalibrationBuffers(len(device_definition[config.CONFIG_DEVICE_CHANNELS]), n_sets)
+            for device_name, device_definition in devices.items()}
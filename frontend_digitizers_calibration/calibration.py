@@ -1,11 +1,19 @@
 import os
-import ctypes
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import monotonic
+
 import numpy as np
 from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration_cache import file_cache_key, load_precompiled_calibration, \
+    check_calibration_crc
+from frontend_digitizers_calibration.fused_calibration import warm_up_fused_calibration, NUMBA_AVAILABLE
+from frontend_digitizers_calibration.metrics import STAGE_CALIBRATION_LOAD
 import logging
 
 WD_N_CHANNELS = 18
 WD_N_CELLS = 1024
+CELL_INDEX = np.arange(WD_N_CELLS)
 
 _logger = logging.getLogger(__name__)
 
@@ -14,86 +22,146 @@ class VoltageCalibration(object):
     Voltage Calibration Class
     """
 
-    class VoltageCalibrationBinaryData(ctypes.Structure):
-        _fields_ = [
-            ('version_id', ctypes.c_char * 4),
-            ('crc', ctypes.c_int),
-            ('sampling_frequency', ctypes.c_short),
-            ('padding', ctypes.c_short),
-            ('temperature', ctypes.c_float),
-            ('wf_offset1', ctypes.c_float * 1024 * 18),
-            ('wf_offset2', ctypes.c_float * 1024 * 18),
-            ('wf_gain1', ctypes.c_float * 1024 * 18),
-            ('wf_gain2', ctypes.c_float * 1024 * 18),
-            ('drs_offset_range0', ctypes.c_float * 16),
-            ('drs_offset_range1', ctypes.c_float * 16),
-            ('drs_offset_range2', ctypes.c_float * 16),
-            ('adc_offset_range0', ctypes.c_float * 16),
-            ('adc_offset_range1', ctypes.c_float * 16),
-            ('adc_offset_range2', ctypes.c_float * 16)
-        ]
-
-    def __init__(self, filename=None):
+    # Layout of the .vcal binary file.
+    VoltageCalibrationBinaryData = np.dtype([
+        ('version_id', 'S4'),
+        ('crc', '<i4'),
+        ('sampling_frequency', '<i2'),
+        ('padding', '<i2'),
+        ('temperature', '<f4'),
+        ('wf_offset1', '<f4', (WD_N_CHANNELS, WD_N_CELLS)),
+        ('wf_offset2', '<f4', (WD_N_CHANNELS, WD_N_CELLS)),
+        ('wf_gain1', '<f4', (WD_N_CHANNELS, WD_N_CELLS)),
+        ('wf_gain2', '<f4', (WD_N_CHANNELS, WD_N_CELLS)),
+        ('drs_offset_range0', '<f4', (16,)),
+        ('drs_offset_range1', '<f4', (16,)),
+        ('drs_offset_range2', '<f4', (16,)),
+        ('adc_offset_range0', '<f4', (16,)),
+        ('adc_offset_range1', '<f4', (16,)),
+        ('adc_offset_range2', '<f4', (16,))
+    ])
+
+    # Layout of the precompiled calibration in the cache folder: the .vcal file and the doubled tables.
+    PrecompiledBinaryData = np.dtype([
+        ('format_version', '<u4'),
+        ('source_crc', '<u4'),
+        ('source', VoltageCalibrationBinaryData),
+        ('doubled_tables', '<f4', (3, WD_N_CHANNELS, 2 * WD_N_CELLS))
+    ])
+
+    def __init__(self, filename=None, cache_folder=None):
         if filename is None:
             self.valid = False
         else:
-            self.valid = self.load(filename)
-
-    def unroll_calibration(self, n_channels=WD_N_CHANNELS, max_offset=WD_N_CELLS):
-        self.unrolled_wf_offset1 = []
-        self.unrolled_wf_gain1 = []
-        self.unrolled_wf_gain2 = []
-
-        # For each channel.
-        for channel_number in range(n_channels):
-            channel_wf_offset1 = []
-            channel_wf_gain1 = []
-            channel_wf_gain2 = []
-
-            # For each offset.
-            for offset_number in range(max_offset):
-                channel_wf_offset1.append(np.roll(self.wf_offset1[channel_number], -offset_number))
-                channel_wf_gain1.append(np.roll(self.wf_gain1[channel_number], -offset_number))
-                channel_wf_gain2.append(np.roll(self.wf_gain2[channel_number], -offset_number))
-
-            self.unrolled_wf_offset1.append(channel_wf_offset1)
-            self.unrolled_wf_gain1.append(channel_wf_gain1)
-            self.unrolled_wf_gain2.append(channel_wf_gain2)
-
-    def load(self, filename):
+            self.valid = self.load(filename, cache_folder)
+
+    @staticmethod
+    def double_tables(wf_offset1, wf_gain1, wf_gain2):
+        # Store each table twice along the cell axis: the calibration rotated by a trigger cell is then
+        # the view [trigger_cell:trigger_cell+WD_N_CELLS], so there is no need to precompute every rotation.
+        return np.tile(np.stack([wf_offset1, wf_gain1, wf_gain2]), 2)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Map the .vcal file and check its size, version and CRC.
+        :return: Memory mapped record of the file, None if the file is not valid.
+        """
         # check file size
-        if os.path.getsize(filename) != ctypes.sizeof(self.VoltageCalibrationBinaryData):
+        if os.path.getsize(filename) != cls.VoltageCalibrationBinaryData.itemsize:
             print("Voltage Cal: %s has wrong file size!" % filename)
-            return False
-
-        cbd = self.VoltageCalibrationBinaryData()
+            return None
 
-        with open(filename, 'rb') as file:
-            file.readinto(cbd)
+        # The tables are read-only views of the memory mapped file.
+        cbd = np.memmap(filename, dtype=cls.VoltageCalibrationBinaryData, mode='r', shape=(1,))
 
-        if cbd.version_id != b"CAL2":
+        if cbd['version_id'][0] != b"CAL2":
             print("Voltage Cal: %s has wrong version!" % filename)
+            return None
+
+        if not check_calibration_crc(filename, cbd['crc'][0], cls.VoltageCalibrationBinaryData.fields['crc'][1]):
+            print("Voltage Cal: %s has wrong CRC!" % filename)
+            return None
+
+        return cbd
+
+    @classmethod
+    def zeros(cls, precompiled):
+        """
+        Calibration with tables of zeros, of the same types as the tables of a loaded calibration.
+        :param precompiled: Tables of the type loaded from a precompiled calibration, otherwise from a .vcal file.
+        :return: VoltageCalibration, not valid.
+        """
+        vcal = cls()
+
+        record = np.zeros(1, dtype=cls.PrecompiledBinaryData)
+        # Read-only as the memory mapped files.
+        record.flags.writeable = False
+
+        vcal.set_tables(record['source'])
+        if precompiled:
+            vcal.doubled_wf_offset1, vcal.doubled_wf_gain1, vcal.doubled_wf_gain2 = record['doubled_tables'][0]
+        else:
+            vcal.doubled_wf_offset1, vcal.doubled_wf_gain1, vcal.doubled_wf_gain2 = \
+                cls.double_tables(vcal.wf_offset1, vcal.wf_gain1, vcal.wf_gain2)
+
+        return vcal
+
+    @classmethod
+    def precompile(cls, filename):
+        """
+        :return: PrecompiledBinaryData record of the .vcal file, None if the file is not valid.
+        """
+        cbd = cls.read(filename)
+        if cbd is None:
+            return None
+
+        precompiled = np.zeros(1, dtype=cls.PrecompiledBinaryData)
+        precompiled['source'] = cbd
+        precompiled['doubled_tables'] = cls.double_tables(cbd['wf_offset1'][0], cbd['wf_gain1'][0],
+                                                          cbd['wf_gain2'][0])
+
+        return precompiled
+
+    def load(self, filename, cache_folder=None):
+        if cache_folder is None:
+            cbd = self.read(filename)
+            if cbd is None:
+                return False
+
+            self.set_tables(cbd)
+            self.doubled_wf_offset1, self.doubled_wf_gain1, self.doubled_wf_gain2 = \
+                self.double_tables(self.wf_offset1, self.wf_gain1, self.wf_gain2)
+
+            return True
+
+        # All the tables are read-only views of a single memory mapped file.
+        precompiled = load_precompiled_calibration(cache_folder, filename, self.PrecompiledBinaryData,
+                                                   lambda: self.precompile(filename))
+        if precompiled is None:
             return False
 
-        self.version_id = str(cbd.version_id)
-        self.crc = int(cbd.crc)
-        self.sampling_frequency = float(cbd.sampling_frequency)
-        self.temperature = float(cbd.temperature)
-        self.wf_offset1 = np.ctypeslib.as_array(cbd.wf_offset1)
-        self.wf_offset2 = np.ctypeslib.as_array(cbd.wf_offset2)
-        self.wf_gain1 = np.ctypeslib.as_array(cbd.wf_gain1)
-        self.wf_gain2 = np.ctypeslib.as_array(cbd.wf_gain2)
-        self.drs_offset_range0 = np.ctypeslib.as_array(cbd.drs_offset_range0)
-        self.drs_offset_range1 = np.ctypeslib.as_array(cbd.drs_offset_range1)
-        self.drs_offset_range2 = np.ctypeslib.as_array(cbd.drs_offset_range2)
-        self.adc_offset_range0 = np.ctypeslib.as_array(cbd.adc_offset_range0)
-        self.adc_offset_range1 = np.ctypeslib.as_array(cbd.adc_offset_range1)
-        self.adc_offset_range2 = np.ctypeslib.as_array(cbd.adc_offset_range2)
-
-        self.unroll_calibration()
+        self.set_tables(precompiled['source'])
+        self.doubled_wf_offset1, self.doubled_wf_gain1, self.doubled_wf_gain2 = precompiled['doubled_tables'][0]
 
         return True
 
+    def set_tables(self, cbd):
+        self.version_id = cbd['version_id'][0].decode()
+        self.crc = int(cbd['crc'][0])
+        self.sampling_frequency = float(cbd['sampling_frequency'][0])
+        self.temperature = float(cbd['temperature'][0])
+        self.wf_offset1 = np.asarray(cbd['wf_offset1'][0])
+        self.wf_offset2 = np.asarray(cbd['wf_offset2'][0])
+        self.wf_gain1 = np.asarray(cbd['wf_gain1'][0])
+        self.wf_gain2 = np.asarray(cbd['wf_gain2'][0])
+        self.drs_offset_range0 = np.asarray(cbd['drs_offset_range0'][0])
+        self.drs_offset_range1 = np.asarray(cbd['drs_offset_range1'][0])
+        self.drs_offset_range2 = np.asarray(cbd['drs_offset_range2'][0])
+        self.adc_offset_range0 = np.asarray(cbd['adc_offset_range0'][0])
+        self.adc_offset_range1 = np.asarray(cbd['adc_offset_range1'][0])
+        self.adc_offset_range2 = np.asarray(cbd['adc_offset_range2'][0])
+
     def dump(self):
         print("Voltage Cal Version %-4s  CRC=0x%08x  Freq: %4d  Temperature %.2f deg. C" % (
             self.version_id, self.crc, self.sampling_frequency, self.temperature))
@@ -110,9 +178,11 @@ class VoltageCalibration(object):
                 self.adc_offset_range0[ch], self.adc_offset_range1[ch], self.adc_offset_range2[ch]))
 
     def calibrate(self, data, trigger_cell, channel):
+        # calibration tables rotated by the trigger cell (views, no copy)
+        cells = slice(trigger_cell, trigger_cell + WD_N_CELLS)
 
         # cell-by-cell offset calibration
-        data -= self.unrolled_wf_offset1[channel][trigger_cell]
+        data -= self.doubled_wf_offset1[channel, cells]
 
         # start-to-end offset calibration
         data -= self.wf_offset2[channel]
@@ -120,79 +190,205 @@ class VoltageCalibration(object):
         # gain calibration
         msk_gtz = data > 0  # create boolean mask vector for selection
 
-        gain_correction = np.copy(self.unrolled_wf_gain2[channel][trigger_cell])
-        gain_correction[msk_gtz] = self.unrolled_wf_gain1[channel][trigger_cell][msk_gtz]
+        gain_correction = np.where(msk_gtz, self.doubled_wf_gain1[channel, cells],
+                                   self.doubled_wf_gain2[channel, cells])
         data /= gain_correction
 
         return data
 
+    def calibrate_many(self, data, trigger_cells, channels, workspace=None):
+        """
+        Calibrate several waveforms in one pass.
+        :param data: 2D float32 array (n_waveforms x WD_N_CELLS), calibrated in place.
+        :param trigger_cells: Trigger cell of each waveform.
+        :param channels: Channel number of each waveform.
+        :param workspace: CalibrationBuffers with preallocated arrays for the gathered tables, None to allocate them.
+        :return: The calibrated data.
+        """
+        if workspace is not None:
+            return self.calibrate_many_in_place(data, trigger_cells, channels, workspace)
+
+        channels = np.asarray(channels)[:, np.newaxis]
+        # gather the calibration tables rotated by the trigger cell of each waveform
+        cells = np.asarray(trigger_cells)[:, np.newaxis] + np.arange(WD_N_CELLS)
+
+        # cell-by-cell offset calibration
+        data -= self.doubled_wf_offset1[channels, cells]
+
+        # start-to-end offset calibration
+        data -= self.wf_offset2[channels[:, 0]]
+
+        # gain calibration
+        msk_gtz = data > 0  # create boolean mask vector for selection
+
+        gain_correction = np.where(msk_gtz, self.doubled_wf_gain1[channels, cells],
+                                   self.doubled_wf_gain2[channels, cells])
+        data /= gain_correction
+
+        return data
+
+    def calibrate_many_in_place(self, data, trigger_cells, channels, workspace):
+        # Same operations as calibrate_many, with the gathered tables written into the workspace arrays.
+        # mode='clip' keeps np.take from buffering the output - the indices are always in range.
+        # The workspace can have more rows than the data.
+        n_rows = len(data)
+        row_offsets = workspace.row_offsets[:n_rows]
+        cell_index = workspace.cell_index[:n_rows]
+        table = workspace.table[:n_rows]
+        second_table = workspace.second_table[:n_rows]
+        mask = workspace.mask[:n_rows]
+
+        # flat index of the cells in the doubled tables, rotated by the trigger cell of each waveform
+        np.multiply(channels, 2 * WD_N_CELLS, out=row_offsets)
+        row_offsets += trigger_cells
+        # per row - a broadcast add allocates the ufunc iteration buffer
+        for row, row_offset in enumerate(row_offsets):
+            np.add(CELL_INDEX, row_offset, out=cell_index[row])
+
+        # cell-by-cell offset calibration
+        np.take(self.doubled_wf_offset1.reshape(-1), cell_index, out=table, mode='clip')
+        data -= table
+
+        # start-to-end offset calibration
+        np.take(self.wf_offset2, channels, axis=0, out=table, mode='clip')
+        data -= table
+
+        # gain calibration
+        np.greater(data, 0, out=mask)
+        np.logical_not(mask, out=mask)
+
+        np.take(self.doubled_wf_gain1.reshape(-1), cell_index, out=table, mode='clip')
+        np.take(self.doubled_wf_gain2.reshape(-1), cell_index, out=second_table, mode='clip')
+        np.copyto(table, second_table, where=mask)
+        data /= table
+
+        return data
+
 
 class TimeCalibration(object):
     """
     Timing Calibration Class
     """
 
-    class TimeCalibrationBinaryData(ctypes.Structure):
-        _fields_ = [
-            ('version_id', ctypes.c_char * 4),
-            ('crc', ctypes.c_int),
-            ('sampling_frequency', ctypes.c_float),
-            ('temperature', ctypes.c_float),
-            ('dt', ctypes.c_float * 1024 * 18),
-            ('period', ctypes.c_float * 1024 * 18),
-            ('offset', ctypes.c_float * 18)
-        ]
-
-    def __init__(self, filename=None):
+    # Layout of the .tcal binary file.
+    TimeCalibrationBinaryData = np.dtype([
+        ('version_id', 'S4'),
+        ('crc', '<i4'),
+        ('sampling_frequency', '<f4'),
+        ('temperature', '<f4'),
+        ('dt', '<f4', (WD_N_CHANNELS, WD_N_CELLS)),
+        ('period', '<f4', (WD_N_CHANNELS, WD_N_CELLS)),
+        ('offset', '<f4', (WD_N_CHANNELS,))
+    ])
+
+    # Layout of the precompiled calibration in the cache folder: the .tcal file and the integrated time table.
+    PrecompiledBinaryData = np.dtype([
+        ('format_version', '<u4'),
+        ('source_crc', '<u4'),
+        ('source', TimeCalibrationBinaryData),
+        ('time', '<f4', (WD_N_CHANNELS, 2 * WD_N_CELLS))
+    ])
+
+    def __init__(self, filename=None, cache_folder=None, time_axis_cache_size=config.DEFAULT_TIME_AXIS_CACHE_SIZE):
+        # time axes of the recently used (channel, trigger_cell), in least recently used order
+        self.time_axes = OrderedDict()
+        self.time_axis_cache_size = time_axis_cache_size
+        # time axis shared by all channels and trigger cells, for calibrations with uniform sampling
+        self.uniform_time_axis = None
+        self.uniform_dt_ns = None
+        # file name and CRC of the calibration file, or the frequency of the default calibration
+        self.calibration_id = None
+
         if filename is None:
             self.valid = False
         else:
-            self.valid = self.load(filename)
+            self.valid = self.load(filename, cache_folder)
 
     def load_default(self, frequency_MHz):
         # just calculate time axis from the period of the sampling frequency
         dt_zero_pad_tile = np.full((WD_N_CHANNELS, WD_N_CELLS*2), 1 / (frequency_MHz*1e6), dtype='float32')
         self.time = np.cumsum(dt_zero_pad_tile, axis=1)
-        self.unroll_calibration()
-
-    def unroll_calibration(self, n_channels=WD_N_CHANNELS, max_offset=WD_N_CELLS):
-        # will contain a list of nd arrays holding time axis in ns [channel][trigger_cell][sample]
-        self.unrolled_time_ns=[]
-
-        # For each channel.
-        for channel_number in range(n_channels):
-            channel_unrolled_time = []
 
-            # For each offset.
-            for trigger_cell in range(max_offset):
-                channel_unrolled_time.append((self.time[channel_number][trigger_cell:trigger_cell+max_offset]
-                                             - self.time[channel_number][trigger_cell])*1e9)
+        # the sampling is uniform, the same time axis is valid for all channels and trigger cells
+        self.uniform_dt_ns = 1e3 / frequency_MHz
+        self.uniform_time_axis = (np.arange(WD_N_CELLS) * self.uniform_dt_ns).astype('float32')
+        self.uniform_time_axis.flags.writeable = False
 
-            self.unrolled_time_ns.append(channel_unrolled_time)
+        self.calibration_id = "default-%sMHz" % frequency_MHz
 
-    def load(self, filename):
+    @classmethod
+    def read(cls, filename):
+        """
+        Map the .tcal file and check its size, version and CRC.
+        :return: Memory mapped record of the file, None if the file is not valid.
+        """
         # check file size
-        if os.path.getsize(filename) != ctypes.sizeof(self.TimeCalibrationBinaryData):
+        if os.path.getsize(filename) != cls.TimeCalibrationBinaryData.itemsize:
             print("Timing Cal: %s has wrong file size!" % filename)
-            return False
-
-        cbd = self.TimeCalibrationBinaryData()
+            return None
 
-        with open(filename, 'rb') as file:
-            file.readinto(cbd)
+        # The tables are read-only views of the memory mapped file.
+        cbd = np.memmap(filename, dtype=cls.TimeCalibrationBinaryData, mode='r', shape=(1,))
 
-        if cbd.version_id != b"CAL2":
+        if cbd['version_id'][0] != b"CAL2":
             print("Timing Cal: %s has wrong version!" % filename)
-            return False
+            return None
+
+        if not check_calibration_crc(filename, cbd['crc'][0], cls.TimeCalibrationBinaryData.fields['crc'][1]):
+            print("Timing Cal: %s has wrong CRC!" % filename)
+            return None
+
+        return cbd
+
+    @classmethod
+    def precompile(cls, filename):
+        """
+        :return: PrecompiledBinaryData record of the .tcal file, None if the file is not valid.
+        """
+        cbd = cls.read(filename)
+        if cbd is None:
+            return None
+
+        precompiled = np.zeros(1, dtype=cls.PrecompiledBinaryData)
+        precompiled['source'] = cbd
+        precompiled['time'] = cls.calculate_time(cbd['dt'][0])
+
+        return precompiled
+
+    def load(self, filename, cache_folder=None):
+        if cache_folder is None:
+            cbd = self.read(filename)
+            if cbd is None:
+                return False
+
+            self.set_tables(cbd)
+            self.time = self.calculate_time(self.dt)
+
+        else:
+            # All the tables are read-only views of a single memory mapped file.
+            precompiled = load_precompiled_calibration(cache_folder, filename, self.PrecompiledBinaryData,
+                                                       lambda: self.precompile(filename))
+            if precompiled is None:
+                return False
+
+            self.set_tables(precompiled['source'])
+            self.time = precompiled['time'][0]
 
-        self.version_id = str(cbd.version_id)
-        self.crc = int(cbd.crc)
-        self.sampling_frequency = float(cbd.sampling_frequency)
-        self.temperature = float(cbd.temperature)
-        self.dt = np.ctypeslib.as_array(cbd.dt)
-        self.period = np.ctypeslib.as_array(cbd.period)
-        self.offset = np.ctypeslib.as_array(cbd.offset)
+        self.calibration_id = file_cache_key(filename)
 
+        return True
+
+    def set_tables(self, cbd):
+        self.version_id = cbd['version_id'][0].decode()
+        self.crc = int(cbd['crc'][0])
+        self.sampling_frequency = float(cbd['sampling_frequency'][0])
+        self.temperature = float(cbd['temperature'][0])
+        self.dt = np.asarray(cbd['dt'][0])
+        self.period = np.asarray(cbd['period'][0])
+        self.offset = np.asarray(cbd['offset'][0])
+
+    @staticmethod
+    def calculate_time(dt):
         # bulid integrated time vector t
         # variant 1 : iterations
         #   self.t = np.zeros([WD_N_CHANNELS, 2047], dtype='float32')
@@ -202,19 +398,51 @@ class TimeCalibration(object):
 
         # variant 2 : with numpy functions instead of iterations:
         # make an copy of an array of dts (axis 1) and append it to the original one, remove last element
-        dt_zero_pad_tile = np.tile(self.dt, 2)[:, :-1]
+        dt_zero_pad_tile = np.tile(dt, 2)[:, :-1]
         # prepend an element of with 0 at the beginning of each array (axis 1)
         dt_zero_pad_tile = np.pad(dt_zero_pad_tile, [(0, 0), (1, 0)], mode='constant')
         # calculate running time with the cumulative sum along axis 1
         # time now contains time axis starting from cell 0
-        self.time = np.cumsum(dt_zero_pad_tile, axis=1)
+        return np.cumsum(dt_zero_pad_tile, axis=1)
 
-        self.unroll_calibration()
-
-        return True
+    def calculate_time_axis(self, trigger_cell, channel):
+        # time axis in ns starting at the trigger cell, from the time table doubled along the cell axis
+        return (self.time[channel, trigger_cell:trigger_cell + WD_N_CELLS] - self.time[channel, trigger_cell]) * 1e9
 
     def get_time_axis(self, trigger_cell, channel):
-        return self.unrolled_time_ns[channel][trigger_cell]
+        """
+        Time axis in ns of a waveform. The returned array is shared and must not be modified.
+        :param trigger_cell: Trigger cell of the waveform.
+        :param channel: Channel number of the waveform.
+        :return: Time axis, 1D float32 array of WD_N_CELLS samples.
+        """
+        if self.uniform_time_axis is not None:
+            return self.uniform_time_axis
+
+        key = (int(channel), int(trigger_cell))
+
+        if key in self.time_axes:
+            self.time_axes.move_to_end(key)
+            return self.time_axes[key]
+
+        time_axis = self.calculate_time_axis(key[1], key[0])
+        time_axis.flags.writeable = False
+
+        self.time_axes[key] = time_axis
+        if len(self.time_axes) > self.time_axis_cache_size:
+            self.time_axes.popitem(last=False)
+
+        return time_axis
+
+    def get_time_axis_descriptor(self):
+        """
+        Compact description of the time axis, for calibrations with uniform sampling.
+        :return: (t0, dt) in ns, None if the sampling is not uniform.
+        """
+        if self.uniform_time_axis is None:
+            return None
+
+        return 0.0, self.uniform_dt_ns
 
     def dump(self):
         print("Timing Cal Version %-4s  CRC=0x%08x  Freq: %.0f  Temperature %.2f deg. C" % (
@@ -231,7 +459,8 @@ class TimeCalibration(object):
 
 class CalibrationManager(object):
 
-    def __init__(self, ioc_host_config, config_folder):
+    def __init__(self, ioc_host_config, config_folder, cache_size=config.DEFAULT_CALIBRATION_CACHE_SIZE,
+                 background_loading=False, cache_folder=config.DEFAULT_CALIBRATION_CACHE_FOLDER, metrics=None):
         self.vcal = VoltageCalibration()
         self.tcal = TimeCalibration()
         self.vcal_found = False
@@ -244,71 +473,210 @@ class CalibrationManager(object):
 
         self.last_sampling_frequency = 0
 
+        # Loaded calibrations {sampling_frequency: (vcal_found, tcal_found, vcal, tcal)}, least recently used first.
+        self.cache_size = max(cache_size, 1)
+        self.calibrations = OrderedDict()
+
+        # Load new calibrations in a worker thread instead of blocking the caller.
+        self.background_loading = background_loading
+        # Sampling frequency being loaded in the background, None if no loading is in progress.
+        self.loading_frequency = None
+        self.lock = Lock()
+
+        # Thread preloading the calibrations while the stream starts, None if they are not being preloaded.
+        self.preloading_thread = None
+
+        # Folder where the tables derived from the calibration files are stored, shared between processes.
+        self.cache_folder = cache_folder
+
+        # StreamMetrics to report the calibration load time to, None to not report it.
+        self.metrics = metrics
+
     def load_calibration_data(self, sampling_frequency):
-        tcal_file_name = ""
-        vcal_file_name = ""
 
         # Check if we already have this calibration file loaded.
         if sampling_frequency != self.last_sampling_frequency:
+            self.wait_for_preloading()
+
+            with self.lock:
+                if sampling_frequency in self.calibrations:
+                    _logger.debug("Using cached calibration for frequency '%s'.", sampling_frequency)
+                    self.calibrations.move_to_end(sampling_frequency)
+
+                elif self.background_loading:
+                    # The calibration is not available until the worker thread has loaded it.
+                    self.start_background_loading(sampling_frequency)
+                    return False
 
-            if sampling_frequency not in self.vcal_files:
-                _logger.debug("No calibration file found for frequency '%s'.", sampling_frequency)
-                self.vcal_found = False
-                if sampling_frequency != self.last_sampling_frequency:
-                    _logger.info("No calibration file found for frequency '%s'.", sampling_frequency)
-                self.last_sampling_frequency = sampling_frequency
-            else:
-                vcal_file_name = self.vcal_files[sampling_frequency]
-                if not os.path.exists(vcal_file_name):
-                    self.vcal_found = False
-                    _logger.debug("The specified calibration file '%s' for frequency '%s' does not exist.",
-                                  vcal_file_name, sampling_frequency)
-                    if sampling_frequency != self.last_sampling_frequency:
-                        _logger.info("The specified calibration file '%s' for frequency '%s' does not exist.",
-                                     vcal_file_name, sampling_frequency)
-                    self.last_sampling_frequency = sampling_frequency
                 else:
-                    self.vcal_found = True
+                    self.cache_calibration(sampling_frequency, self.load_calibration(sampling_frequency))
 
-            # time calibration
+                # Swap in the calibration of the new frequency.
+                self.vcal_found, self.tcal_found, self.vcal, self.tcal = self.calibrations[sampling_frequency]
 
-            if sampling_frequency not in self.tcal_files:
-                self.tcal_found = False
-                _logger.debug("No time calibration file found for frequency '%s'.", sampling_frequency)
-                if sampling_frequency != self.last_sampling_frequency:
-                    _logger.info("No time calibration file found for frequency '%s'.", sampling_frequency)
+        self.last_sampling_frequency = sampling_frequency
+        return self.vcal_found
 
+    def start_background_loading(self, sampling_frequency):
+        # Only one load at a time - the next frequency is loaded when requested after this one finishes.
+        if self.loading_frequency is not None:
+            return
+
+        _logger.info("Loading calibration for frequency '%s' in the background.", sampling_frequency)
+        self.loading_frequency = sampling_frequency
+
+        loading_thread = Thread(target=self.background_load, args=(sampling_frequency,))
+        loading_thread.daemon = True
+        loading_thread.start()
+
+    def background_load(self, sampling_frequency):
+        try:
+            calibration = self.load_calibration(sampling_frequency)
+
+        except Exception:
+            _logger.exception("Loading calibration for frequency '%s' failed.", sampling_frequency)
+            # Cache the failure as well, otherwise every new message would retry the loading.
+            calibration = (False, False, VoltageCalibration(), TimeCalibration())
+
+        with self.lock:
+            self.cache_calibration(sampling_frequency, calibration)
+            self.loading_frequency = None
+
+    def start_preloading(self):
+        """
+        Preload the calibrations in a worker thread, so the stream can start in the meantime. The first message
+        waits for the preloading to finish.
+        """
+        self.preloading_thread = Thread(target=self.preload_calibration_data)
+        self.preloading_thread.daemon = True
+        self.preloading_thread.start()
+
+    def start_warming_up(self):
+        """
+        Compile the fused calibration kernel in a worker thread while the stream starts, for tables of the type the
+        calibrations are loaded with. The preloading compiles it for the preloaded calibrations instead.
+        """
+        if not (config.USE_FUSED_CALIBRATION and NUMBA_AVAILABLE):
+            return
+
+        vcal = VoltageCalibration.zeros(precompiled=self.cache_folder is not None)
+
+        def warm_up():
+            start_time = monotonic()
+            try:
+                warm_up_fused_calibration(vcal)
+            except Exception:
+                _logger.exception("Compiling the fused calibration kernel failed.")
+                return
+
+            _logger.info("Compiled the fused calibration kernel in %.3f seconds.", monotonic() - start_time)
+
+        warm_up_thread = Thread(target=warm_up, name="fused calibration warm up")
+        warm_up_thread.daemon = True
+        warm_up_thread.start()
+
+    def wait_for_preloading(self):
+        preloading_thread = self.preloading_thread
+        if preloading_thread is None:
+            return
+
+        if preloading_thread.is_alive():
+            _logger.info("Waiting for the calibrations to be preloaded.")
+        preloading_thread.join()
+
+        self.preloading_thread = None
+
+    def preload_calibration_data(self):
+        """
+        Load the calibrations of all the frequencies in the frequency mappings into the cache, and compile the fused
+        calibration kernel for them.
+        """
+        start_time = monotonic()
+        frequencies = sorted(set(self.vcal_files) | set(self.tcal_files))
+
+        if len(frequencies) > self.cache_size:
+            _logger.warning("Preloading %d frequencies, but the calibration cache holds only %d.",
+                            len(frequencies), self.cache_size)
+
+        for sampling_frequency in frequencies:
+            if sampling_frequency not in self.calibrations:
+                _logger.info("Preloading calibration for frequency '%s'.", sampling_frequency)
+                calibration = self.load_calibration(sampling_frequency)
+
+                with self.lock:
+                    self.cache_calibration(sampling_frequency, calibration)
+
+        if config.USE_FUSED_CALIBRATION:
+            for vcal_found, _, vcal, _ in list(self.calibrations.values()):
+                if vcal_found:
+                    warm_up_fused_calibration(vcal)
+                    break
+
+        _logger.info("Preloaded the calibrations of %d frequencies in %.3f seconds.", len(frequencies),
+                     monotonic() - start_time)
+
+    def cache_calibration(self, sampling_frequency, calibration):
+        self.calibrations[sampling_frequency] = calibration
+
+        # Evict the least recently used calibrations.
+        while len(self.calibrations) > self.cache_size:
+            evicted_frequency, _ = self.calibrations.popitem(last=False)
+            _logger.info("Calibration for frequency '%s' evicted from the cache.", evicted_frequency)
+
+    def load_calibration(self, sampling_frequency):
+        """
+        Load the voltage and time calibration for the sampling frequency.
+        :param sampling_frequency: Sampling frequency in MHz.
+        :return: (vcal_found, tcal_found, vcal, tcal)
+        """
+        start_time = monotonic()
+
+        vcal = VoltageCalibration()
+        tcal = TimeCalibration()
+        vcal_found = False
+        tcal_found = False
+
+        if sampling_frequency not in self.vcal_files:
+            _logger.info("No calibration file found for frequency '%s'.", sampling_frequency)
+        else:
+            vcal_file_name = self.vcal_files[sampling_frequency]
+            if not os.path.exists(vcal_file_name):
+                _logger.info("The specified calibration file '%s' for frequency '%s' does not exist.",
+                             vcal_file_name, sampling_frequency)
             else:
-                tcal_file_name = self.tcal_files[sampling_frequency]
-                if not os.path.exists(tcal_file_name):
-                    self.tcal_found = False
-                    _logger.debug("The specified time calibration file '%s' for frequency '%s' does not exist.",
-                                  tcal_file_name, sampling_frequency)
-                    if sampling_frequency != self.last_sampling_frequency:
-                        _logger.info("The specified time calibration file '%s' for frequency '%s' does not exist.",
-                                     tcal_file_name, sampling_frequency)
-                else:
-                    self.tcal_found = True
+                _logger.debug("Loading calibration file '%s'.", vcal_file_name)
+                vcal = VoltageCalibration(vcal_file_name, self.cache_folder)
+                vcal_found = vcal.valid
 
-            if self.tcal_found:
-                _logger.debug("Loading calibration file '%s'.", tcal_file_name)
-                self.tcal.load(tcal_file_name)
+        # time calibration
+
+        if sampling_frequency not in self.tcal_files:
+            _logger.info("No time calibration file found for frequency '%s'.", sampling_frequency)
+        else:
+            tcal_file_name = self.tcal_files[sampling_frequency]
+            if not os.path.exists(tcal_file_name):
+                _logger.info("The specified time calibration file '%s' for frequency '%s' does not exist.",
+                             tcal_file_name, sampling_frequency)
             else:
-                _logger.info("Loading default time axis for '%s'.", sampling_frequency)
-                self.tcal.load_default(sampling_frequency)
+                _logger.debug("Loading calibration file '%s'.", tcal_file_name)
+                tcal = TimeCalibration(tcal_file_name, self.cache_folder)
+                tcal_found = tcal.valid
 
-            if self.vcal_found:
-                _logger.debug("Loading calibration file '%s'.", vcal_file_name)
-                self.vcal.load(vcal_file_name)
+        if not tcal_found:
+            _logger.info("Loading default time axis for '%s'.", sampling_frequency)
+            tcal.load_default(sampling_frequency)
 
-        self.last_sampling_frequency = sampling_frequency
-        return self.vcal_found
+        load_time = monotonic() - start_time
+        _logger.info("Calibration for frequency '%s' loaded in %.3f seconds.", sampling_frequency, load_time)
 
+        if self.metrics is not None:
+            self.metrics.observe(STAGE_CALIBRATION_LOAD, load_time)
 
+        return vcal_found, tcal_found, vcal, tcal
 
     @staticmethod
     def load_frequency_mapping(ioc_host_config, config_folder, config_section):
-        frequency_map = ioc_host_config[config_section]
+        frequency_map = ioc_host_config.get(config_section, {})
 
         frequency_files = {}
 
@@ -319,4 +687,37 @@ class CalibrationManager(object):
 
             frequency_files[actual_frequency] = abs_file_path
 
-        return frequency_files
\ No newline at end of file
+        return frequency_files
+
+
+def precompile_calibrations(ioc_host_config, config_folder, cache_folder):
+    """
+    Store the precompiled calibrations of the files in the frequency mappings of the configuration in the cache
+    folder, so the stream maps them at startup instead of deriving the tables.
+    :param ioc_host_config: Configuration of the ioc host.
+    :param config_folder: Folder the calibration files in the configuration are relative to.
+    :param cache_folder: Folder to store the precompiled calibrations in.
+    :return: (number of precompiled calibration files, list of the missing or invalid calibration files)
+    """
+    vcal_files = CalibrationManager.load_frequency_mapping(ioc_host_config, config_folder,
+                                                           config.CONFIG_SECTION_FREQUENCY_MAPPING)
+    tcal_files = CalibrationManager.load_frequency_mapping(ioc_host_config, config_folder,
+                                                           config.CONFIG_SECTION_TIME_FREQUENCY_MAPPING)
+
+    n_precompiled = 0
+    invalid_files = []
+
+    for calibration_class, files in ((VoltageCalibration, vcal_files), (TimeCalibration, tcal_files)):
+        for filename in sorted(set(files.values())):
+            if not os.path.exists(filename):
+                _logger.warning("Calibration file '%s' does not exist.", filename)
+                invalid_files.append(filename)
+
+            elif calibration_class(filename, cache_folder).valid:
+                n_precompiled += 1
+
+            else:
+                _logger.warning("Calibration file '%s' is not valid.", filename)
+                invalid_files.append(filename)
+
+    return n_precompiled, invalid_files
@@ -0,0 +1,136 @@
+import logging
+import os
+import zlib
+
+import numpy as np
+
+from frontend_digitizers_calibration import config
+
+_logger = logging.getLogger(__name__)
+
+# Version of the precompiled calibration format, stored in the files and part of their names. Increase it when the
+# layout of the precompiled calibrations changes.
+PRECOMPILED_FORMAT_VERSION = 1
+
+
+def file_crc(filename):
+    """
+    CRC32 of the file content.
+    :param filename: File to calculate the CRC of.
+    :return: CRC32 as unsigned int.
+    """
+    with open(filename, 'rb') as file:
+        return zlib.crc32(file.read()) & 0xffffffff
+
+
+def file_cache_key(filename, crc=None):
+    """
+    Cache key of the tables derived from a calibration file - the file name and the CRC of its content.
+    :param filename: Calibration file.
+    :param crc: CRC of the file content, calculated if None.
+    :return: Cache key.
+    """
+    if crc is None:
+        crc = file_crc(filename)
+
+    return "%s-%08x" % (os.path.basename(filename), crc)
+
+
+def verify_calibration_crc(filename, stored_crc, crc_offset):
+    """
+    Check the CRC stored in a calibration file: the CRC32 of the file with the 4 bytes crc field set to 0. A stored CRC
+    of 0 means that the CRC is not set, the file is accepted.
+    :param filename: Calibration file.
+    :param stored_crc: Value of the crc field.
+    :param crc_offset: Offset of the crc field in the file.
+    :return: True if the CRC matches or is not set.
+    """
+    stored_crc = int(stored_crc) & 0xffffffff
+    if stored_crc == 0:
+        return True
+
+    with open(filename, 'rb') as file:
+        content = file.read()
+
+    zeroed_crc = zlib.crc32(content[crc_offset + 4:], zlib.crc32(bytes(4), zlib.crc32(content[:crc_offset])))
+
+    return stored_crc == zeroed_crc & 0xffffffff
+
+
+def check_calibration_crc(filename, stored_crc, crc_offset, mode=None):
+    """
+    Check the CRC stored in a calibration file with verify_calibration_crc.
+    :param mode: One of the config.CALIBRATION_CRC_CHECK modes, config.CALIBRATION_CRC_CHECK if None.
+    :return: False if the file is rejected.
+    """
+    mode = mode if mode is not None else config.CALIBRATION_CRC_CHECK
+
+    if mode == config.CALIBRATION_CRC_CHECK_OFF or verify_calibration_crc(filename, stored_crc, crc_offset):
+        return True
+
+    if mode == config.CALIBRATION_CRC_CHECK_WARN:
+        _logger.warning("Calibration file '%s' does not match its CRC 0x%08x, using it anyway.", filename,
+                        int(stored_crc))
+        return True
+
+    return False
+
+
+def get_precompiled_file(cache_folder, cache_key):
+    return os.path.join(cache_folder, "%s.precompiled-v%d.npy" % (cache_key, PRECOMPILED_FORMAT_VERSION))
+
+
+def load_precompiled_calibration(cache_folder, filename, dtype, precompile):
+    """
+    Load the precompiled form of a calibration file from the cache folder: the content of the file and the tables
+    derived from it, in a single record memory mapped read-only, so all processes using the same cache folder share
+    the pages. If it is not cached yet or does not match the file, precompile and store it.
+    :param cache_folder: Folder with the precompiled calibrations.
+    :param filename: Calibration file.
+    :param dtype: Layout of the precompiled record, with the format_version and source_crc fields.
+    :param precompile: Function without arguments that returns the precompiled record (array of 1 element with the
+                       dtype), None if the file is not a valid calibration.
+    :return: The precompiled record, None if the file is not a valid calibration.
+    """
+    source_crc = file_crc(filename)
+    precompiled_file = get_precompiled_file(cache_folder, file_cache_key(filename, source_crc))
+
+    if os.path.exists(precompiled_file):
+        try:
+            precompiled = np.load(precompiled_file, mmap_mode='r')
+
+            if precompiled.dtype == dtype and precompiled.shape == (1,) and \
+                    precompiled['format_version'][0] == PRECOMPILED_FORMAT_VERSION and \
+                    precompiled['source_crc'][0] == source_crc:
+                return precompiled
+
+            _logger.warning("Precompiled calibration '%s' does not match '%s', precompiling it again.",
+                            precompiled_file, filename)
+
+        except (OSError, ValueError) as e:
+            _logger.warning("Cannot load precompiled calibration '%s', precompiling it again: %s", precompiled_file, e)
+
+    precompiled = precompile()
+    if precompiled is None:
+        return None
+
+    precompiled['format_version'] = PRECOMPILED_FORMAT_VERSION
+    precompiled['source_crc'] = source_crc
+
+    _logger.info("Storing precompiled calibration '%s'.", precompiled_file)
+
+    try:
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+        # Write to a temporary file first, so other processes never map a partially written calibration.
+        temp_file = "%s.%d.tmp" % (precompiled_file, os.getpid())
+        with open(temp_file, 'wb') as file:
+            np.save(file, precompiled)
+        os.replace(temp_file, precompiled_file)
+
+    except OSError as e:
+        _logger.warning("Cannot store precompiled calibration in '%s': %s", precompiled_file, e)
+        return precompiled
+
+    return np.load(precompiled_file, mmap_mode='r')
@@ -0,0 +1,98 @@
+import logging
+import time
+
+from frontend_digitizers_calibration import config
+
+_logger = logging.getLogger(__name__)
+
+
+def get_message_lag(message, clock=time.time):
+    """
+    :param message: bsread message.
+    :param clock: Wall clock in seconds since the epoch.
+    :return: Seconds between the global timestamp of the message and now, None if the message has no timestamp.
+    """
+    global_timestamp = getattr(message.data, "global_timestamp", None)
+
+    if not global_timestamp:
+        return None
+
+    return clock() - (global_timestamp + (getattr(message.data, "global_timestamp_offset", 0) or 0) * 1e-9)
+
+
+class CatchUpPolicy(object):
+    """
+    Decide which messages to skip when the stream falls behind, so the outputs show the newest pulses again as soon
+    as possible. Has to be called in pulse_id order.
+
+    The stream is behind when the lag of a message (its global timestamp against the wall clock) exceeds max_lag,
+    or the number of messages waiting to be processed exceeds max_queue_depth. It catches up once the lag is below
+    max_lag * CATCH_UP_RESUME_FRACTION and the queue below max_queue_depth * CATCH_UP_RESUME_FRACTION, so it does
+    not flip between the two for every message.
+    """
+
+    def __init__(self, max_lag=None, max_queue_depth=None, clock=time.time):
+        """
+        :param max_lag: Lag in seconds above which the messages are skipped, None or 0 to not check the lag.
+        :param max_queue_depth: Waiting messages above which the messages are skipped, None or 0 to not check them.
+        :param clock: Wall clock in seconds since the epoch.
+        """
+        self.max_lag = max_lag or None
+        self.max_queue_depth = max_queue_depth or None
+        self.clock = clock
+
+        self.catching_up = False
+        self.n_skipped = 0
+        self.n_catch_ups = 0
+        # Messages skipped in the current catch up.
+        self.n_catch_up_skipped = 0
+
+    @property
+    def enabled(self):
+        return self.max_lag is not None or self.max_queue_depth is not None
+
+    def is_behind(self, lag, queue_depth, limit_fraction):
+        if self.max_lag is not None and lag is not None and lag > self.max_lag * limit_fraction:
+            return True
+
+        if self.max_queue_depth is not None and queue_depth is not None and \
+                queue_depth > self.max_queue_depth * limit_fraction:
+            return True
+
+        return False
+
+    def skip(self, message, queue_depth=None):
+        """
+        :param message: Next message to process.
+        :param queue_depth: Number of messages waiting after this one, None if not known.
+        :return: True if the message should be skipped.
+        """
+        if not self.enabled:
+            return False
+
+        lag = get_message_lag(message, self.clock) if self.max_lag is not None else None
+
+        if not self.catching_up:
+            if not self.is_behind(lag, queue_depth, 1):
+                return False
+
+            self.catching_up = True
+            self.n_catch_ups += 1
+            self.n_catch_up_skipped = 0
+            _logger.warning("Stream behind at pulse_id '%s' (lag %s seconds, %s messages waiting), catching up.",
+                            message.data.pulse_id, "%.3f" % lag if lag is not None else "unknown", queue_depth)
+
+        elif not self.is_behind(lag, queue_depth, config.CATCH_UP_RESUME_FRACTION):
+            self.catching_up = False
+            _logger.info("Caught up at pulse_id '%s', %d messages skipped.", message.data.pulse_id,
+                         self.n_catch_up_skipped)
+            return False
+
+        self.n_skipped += 1
+        self.n_catch_up_skipped += 1
+        return True
+
+    def get_statistics(self):
+        return {"skipped": self.n_skipped,
+                "catch_ups": self.n_catch_ups,
+                "catching_up": self.catching_up}
@@ -1,16 +1,115 @@
 # Runner script default parameters.
 DEFAULT_CONFIG_FOLDER = "/configuration"
+# Folder for the precompiled calibrations derived from the calibration files - None to not store them.
+DEFAULT_CALIBRATION_CACHE_FOLDER = None
 DEFAULT_INPUT_STREAM_PORT = 9999
 DEFAULT_OUTPUT_STREAM_PORT = 9999
 
 # This should be enough for 10 seconds of processing - 1 second for each file change.
 INPUT_STREAM_QUEUE_SIZE = 1000
 
+# Number of sampling frequencies to keep the loaded calibration of.
+DEFAULT_CALIBRATION_CACHE_SIZE = 4
+
+# Number of (channel, trigger cell) time axes to keep for non uniform time calibrations.
+DEFAULT_TIME_AXIS_CACHE_SIZE = 2048
+
+# Check of the CRC stored in the calibration files, the CRC32 of the file with the crc field set to 0 - a stored CRC of
+# 0 is not checked. "strict" rejects the files that do not match, "warn" only logs them, "off" does not check.
+CALIBRATION_CRC_CHECK_STRICT = "strict"
+CALIBRATION_CRC_CHECK_WARN = "warn"
+CALIBRATION_CRC_CHECK_OFF = "off"
+CALIBRATION_CRC_CHECK = CALIBRATION_CRC_CHECK_WARN
+
+# What to do with messages received while the calibration is loaded in the background.
+UNCALIBRATED_FALLBACK_DROP = "drop"
+UNCALIBRATED_FALLBACK_RAW = "raw"
+UNCALIBRATED_FALLBACKS = [UNCALIBRATED_FALLBACK_DROP, UNCALIBRATED_FALLBACK_RAW]
+DEFAULT_UNCALIBRATED_FALLBACK = UNCALIBRATED_FALLBACK_DROP
+
+# Pipelined mode - queues between the receive, compute, send and EPICS stages.
+BACKPRESSURE_BLOCK = "block"
+BACKPRESSURE_DROP_OLDEST = "drop_oldest"
+BACKPRESSURE_DROP_NEWEST = "drop_newest"
+BACKPRESSURE_POLICIES = [BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST, BACKPRESSURE_DROP_NEWEST]
+DEFAULT_PIPELINE_QUEUE_SIZE = 100
+DEFAULT_COMPUTE_BACKPRESSURE = BACKPRESSURE_BLOCK
+DEFAULT_SEND_BACKPRESSURE = BACKPRESSURE_BLOCK
+DEFAULT_EPICS_BACKPRESSURE = BACKPRESSURE_DROP_OLDEST
+# A pipeline stage failing this many items in a row stops the stream - the service is restarted.
+PIPELINE_MAX_CONSECUTIVE_FAILURES = 100
+# Seconds between the checks of the stopped stages, by the stage threads and the producers waiting on a full queue.
+PIPELINE_POLL_INTERVAL = 0.1
+# Seconds to wait at shutdown for each stage to process its queued items.
+PIPELINE_STOP_TIMEOUT = 5
+
+# Number of preallocated output arrays per device used in rotation - 0 to allocate them for each message.
+DEFAULT_OUTPUT_BUFFER_SETS = 0
+
+# Calibrate the waveforms with the fused kernel of fused_calibration when Numba is installed.
+USE_FUSED_CALIBRATION = True
+
+# How the time axes are sent in the output stream:
+#  - full: the time axis of each channel, in each message.
+#  - on_change: the time axis only when it changed, and a reference to it in each message.
+#  - reference: only a reference to the time axis, see time_axis.TimeAxisResolver.
+TIME_AXIS_MODE_FULL = "full"
+TIME_AXIS_MODE_ON_CHANGE = "on_change"
+TIME_AXIS_MODE_REFERENCE = "reference"
+TIME_AXIS_MODES = [TIME_AXIS_MODE_FULL, TIME_AXIS_MODE_ON_CHANGE, TIME_AXIS_MODE_REFERENCE]
+DEFAULT_TIME_AXIS_MODE = TIME_AXIS_MODE_FULL
+
+# Number of processes to calibrate in - 1 to calibrate in the receiving process.
+DEFAULT_WORKERS = 1
+# Maximum number of messages per worker being processed or waiting to be sent in pulse_id order.
+WORKER_MAX_IN_FLIGHT = 4
+# Seconds to wait for the result of a message before the stream stops - a worker process that dies never returns the
+# results of its messages.
+WORKER_RESULT_TIMEOUT = 30
+# Seconds between the checks for a missing result while submit waits for a free slot.
+WORKER_POLL_INTERVAL = 0.5
+
+# Catch up when the stream falls behind - the messages are skipped until the stream has caught up:
+#  - pass_through: only the values from the input message are sent, not to EPICS.
+#  - drop: nothing is sent.
+CATCH_UP_MODE_PASS_THROUGH = "pass_through"
+CATCH_UP_MODE_DROP = "drop"
+CATCH_UP_MODES = [CATCH_UP_MODE_PASS_THROUGH, CATCH_UP_MODE_DROP]
+DEFAULT_CATCH_UP_MODE = CATCH_UP_MODE_PASS_THROUGH
+# Lag of a message in seconds (global timestamp against the wall clock) to start catching up at - 0 to not check.
+DEFAULT_CATCH_UP_MAX_LAG = 0
+# Messages waiting to be processed to start catching up at - 0 to not check.
+DEFAULT_CATCH_UP_MAX_QUEUE_DEPTH = 0
+# Fraction of the maximum lag and queue depth below which the stream has caught up.
+CATCH_UP_RESUME_FRACTION = 0.5
+
+# Port of the Prometheus metrics endpoint - 0 to not serve the metrics.
+DEFAULT_METRICS_PORT = 0
+# Seconds between the metrics summaries in the log - 0 to not log them.
+DEFAULT_METRICS_LOG_INTERVAL = 0
+
+# Number of pulses processed at once when recalibrating a dump.
+DEFAULT_RECALIBRATION_BATCH_SIZE = 1000
+
 # Configuration section names.
 CONFIG_SECTION_FREQUENCY_MAPPING = "frequency_mapping"
 CONFIG_SECTION_TIME_FREQUENCY_MAPPING = "time_calibration_frequency_mapping"
 CONFIG_SECTION_FREQUENCY = "frequency"
 CONFIG_SECTION_DEVICES = "devices"
+CONFIG_SECTION_EPICS = "epics"
+CONFIG_SECTION_OUTPUT = "output"
+
+# Output schema property names - the computed and pass-through patterns of the stream and epics outputs.
+CONFIG_OUTPUT_STREAM = "stream"
+CONFIG_OUTPUT_EPICS = "epics"
+CONFIG_OUTPUT_COMPUTED = "computed"
+CONFIG_OUTPUT_PASS_THROUGH = "pass_through"
+
+# EPICS publisher property names.
+CONFIG_EPICS_WHITELIST = "whitelist"
+CONFIG_EPICS_MAX_RATE = "max_rate"
+CONFIG_EPICS_PV_MAX_RATES = "pv_max_rates"
+CONFIG_EPICS_SKIP_UNCHANGED = "skip_unchanged"
 
 # Device property names.
 CONFIG_DEVICE_TYPE = "device_type"
@@ -20,6 +119,20 @@ CONFIG_DEVICE_X_SCALING_OFFSET = "x_scaling_offset"
 CONFIG_DEVICE_Y_SCALING_FACTOR = "y_scaling_factor"
 CONFIG_DEVICE_Y_SCALING_OFFSET = "y_scaling_offset"
 CONFIG_DEVICE_KEITHLEY_INTENSITY = "keithley_intensity"
+CONFIG_DEVICE_SCALING_FACTOR = "scaling_factor"
+CONFIG_DEVICE_SCALING_OFFSET = "scaling_offset"
+CONFIG_DEVICE_INTENSITY_AVERAGE_WINDOW = "intensity_average_window"
+CONFIG_DEVICE_RUNNING_STATISTICS = "running_statistics"
+
+# Running statistics property names.
+CONFIG_STATISTICS_VALUES = "values"
+CONFIG_STATISTICS_WINDOW = "window"
+CONFIG_STATISTICS_EWMA_ALPHA = "ewma_alpha"
+
+# Number of pulses to average the pbpg intensity over.
+DEFAULT_INTENSITY_AVERAGE_WINDOW = 240
+# Number of pulses of the running statistics of the device outputs.
+DEFAULT_STATISTICS_WINDOW = 100
 
 # Channel property names.
 CONFIG_CHANNEL_PV_PREFIX = "pv_prefix"
@@ -0,0 +1,101 @@
+import numpy
+
+from frontend_digitizers_calibration.devices.pbpg import SUFFIX_DEVICE_INTENSITY_PBPG
+from frontend_digitizers_calibration.devices.utils import normalized_difference, SUFFIX_DEVICE_INTENSITY, \
+    SUFFIX_X_INTENSITY, SUFFIX_Y_INTENSITY, SUFFIX_DEVICE_XPOS, SUFFIX_DEVICE_YPOS
+
+
+class DeviceGroup(object):
+    """
+    Intensity and position of many 4 channel devices of an IOC in one vectorized pass, on a devices x 4 matrix
+    of the channel sums. Same calculation as calculate_intensity_and_position for each device, the positions are NaN
+    where the sum of the two channels is 0. The group calculates in float32; with NumPy < 2 the per-device calculation
+    promotes the float32 sums to float64 with the scaling constants, so the values can differ in the last digits.
+    The devices are processed without the intensity and position before, see calibrate_pbps and calibrate_pbpg.
+    """
+
+    def __init__(self, device_plans, intensity_scaling_factors):
+        """
+        :param device_plans: DevicePlans of the devices, with 4 channels each.
+        :param intensity_scaling_factors: Intensity scaling factor of each device.
+        """
+        self.device_names = [plan.device_name for plan in device_plans]
+        n_devices = len(device_plans)
+
+        # [device][channel] name of the channel sum.
+        self.sum_keys = [[channel.data_sum for channel in plan.channels[:4]] for plan in device_plans]
+
+        # Names of the output values, in the device order.
+        self.intensity_keys = [plan.device_keys[SUFFIX_DEVICE_INTENSITY] for plan in device_plans]
+        self.x_intensity_keys = [plan.device_keys[SUFFIX_X_INTENSITY] for plan in device_plans]
+        self.y_intensity_keys = [plan.device_keys[SUFFIX_Y_INTENSITY] for plan in device_plans]
+        self.x_position_keys = [plan.device_keys[SUFFIX_DEVICE_XPOS] for plan in device_plans]
+        self.y_position_keys = [plan.device_keys[SUFFIX_DEVICE_YPOS] for plan in device_plans]
+
+        # The pbpg devices also have the intensity for the running average.
+        self.copy_intensity_indexes = [index for index, plan in enumerate(device_plans)
+                                       if SUFFIX_DEVICE_INTENSITY_PBPG in plan.device_keys]
+        self.copy_intensity_keys = [device_plans[index].device_keys[SUFFIX_DEVICE_INTENSITY_PBPG]
+                                    for index in self.copy_intensity_indexes]
+
+        def get_vector(values):
+            vector = numpy.array(values, dtype=numpy.float32)
+            vector.flags.writeable = False
+            return vector
+
+        self.intensity_scaling_factors = get_vector(intensity_scaling_factors)
+        self.x_scaling_factors = get_vector([plan.x_scaling_factor for plan in device_plans])
+        self.x_scaling_offsets = get_vector([plan.x_scaling_offset for plan in device_plans])
+        self.y_scaling_factors = get_vector([plan.y_scaling_factor for plan in device_plans])
+        self.y_scaling_offsets = get_vector([plan.y_scaling_offset for plan in device_plans])
+
+        # Workspace, the output values are copied out of it.
+        self.sums = numpy.empty((n_devices, 4), dtype=numpy.float32)
+        self.intensity = numpy.empty(n_devices, dtype=numpy.float32)
+        self.x_intensity = numpy.empty(n_devices, dtype=numpy.float32)
+        self.y_intensity = numpy.empty(n_devices, dtype=numpy.float32)
+        self.x_position = numpy.empty(n_devices, dtype=numpy.float32)
+        self.y_position = numpy.empty(n_devices, dtype=numpy.float32)
+
+    def __len__(self):
+        return len(self.device_names)
+
+    def calculate(self, data_to_send):
+        """
+        :param data_to_send: Dictionary with the channel sums of the devices, to add the calculated values to.
+        :return: Dictionary with the calculated values.
+        """
+        sums = self.sums
+
+        for index, sum_keys in enumerate(self.sum_keys):
+            sums[index] = [data_to_send[key] for key in sum_keys]
+
+        channel1_sum, channel2_sum, channel3_sum, channel4_sum = sums.T
+
+        intensity = self.intensity
+        numpy.add(channel1_sum, channel2_sum, out=intensity)
+        intensity += channel3_sum
+        intensity += channel4_sum
+        intensity *= self.intensity_scaling_factors
+        numpy.abs(intensity, out=intensity)
+
+        numpy.abs(numpy.add(channel1_sum, channel2_sum, out=self.x_intensity), out=self.x_intensity)
+        numpy.abs(numpy.add(channel3_sum, channel4_sum, out=self.y_intensity), out=self.y_intensity)
+
+        # Scaling
+        x_position = normalized_difference(channel1_sum, channel2_sum, out=self.x_position)
+        x_position *= self.x_scaling_factors
+        x_position += self.x_scaling_offsets
+
+        y_position = normalized_difference(channel3_sum, channel4_sum, out=self.y_position)
+        y_position *= self.y_scaling_factors
+        y_position += self.y_scaling_offsets
+
+        data_to_send.update(zip(self.intensity_keys, intensity))
+        data_to_send.update(zip(self.x_intensity_keys, self.x_intensity))
+        data_to_send.update(zip(self.y_intensity_keys, self.y_intensity))
+        data_to_send.update(zip(self.x_position_keys, x_position))
+        data_to_send.update(zip(self.y_position_keys, y_position))
+        data_to_send.update(zip(self.copy_intensity_keys, intensity[self.copy_intensity_indexes]))
+
+        return data_to_send
@@ -1,9 +1,181 @@
-from frontend_digitizers_calibration.devices.pbpg import process_pbpg
-from frontend_digitizers_calibration.devices.pbps import process_pbps
-from frontend_digitizers_calibration.devices.single_channel import process_single_channel
-
-device_type_processing_function_mapping = {
-    "pbps": process_pbps,
-    "pbpg": process_pbpg,
-    "single_channel": process_single_channel
-}
+import logging
+import sys
+from collections import OrderedDict
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.devices.group import DeviceGroup
+from frontend_digitizers_calibration.devices.pbpg import pbpg_processor
+from frontend_digitizers_calibration.devices.pbps import pbps_processor
+from frontend_digitizers_calibration.devices.single_channel import single_channel_processor
+from frontend_digitizers_calibration.devices.utils import DEVICE_PROCESSOR_ENTRY_POINT_GROUP
+
+_logger = logging.getLogger(__name__)
+
+# device_type: DeviceProcessor
+device_processors = OrderedDict()
+
+# The mappings from the device type are filled in by register_device_processor.
+device_type_processing_function_mapping = {}
+
+# Processing without state between pulses - can run in parallel for different pulses.
+device_type_parallel_processing_function_mapping = {}
+
+# Parallel processing with the intensity and position of the 4 channel devices left to the DeviceGroup.
+device_type_grouped_processing_function_mapping = {}
+
+# Intensity scaling factor of the device types in the DeviceGroup.
+device_type_group_intensity_scaling_factor_mapping = {}
+
+# Processing with state between pulses, following the parallel processing - has to run in pulse_id order.
+device_type_ordered_processing_function_mapping = {}
+
+# Processing of many pulses at once, including the ordered processing - the batches are processed in pulse_id order.
+device_type_batch_processing_function_mapping = {}
+
+device_type_plan_mapping = {}
+
+_plugins_loaded = False
+
+
+def register_device_processor(processor):
+    """
+    Make a device type available to the configuration, replacing a registered one with the same device type.
+    :param processor: DeviceProcessor of the device type.
+    :return: The processor.
+    """
+    device_type = processor.device_type
+    device_processors[device_type] = processor
+
+    device_type_processing_function_mapping[device_type] = processor.processing_function
+    device_type_parallel_processing_function_mapping[device_type] = processor.parallel_processing_function
+    device_type_plan_mapping[device_type] = processor.compile_plan
+
+    if processor.grouped_processing_function is not None:
+        device_type_grouped_processing_function_mapping[device_type] = processor.grouped_processing_function
+        device_type_group_intensity_scaling_factor_mapping[device_type] = processor.group_intensity_scaling_factor
+    else:
+        device_type_grouped_processing_function_mapping[device_type] = processor.parallel_processing_function
+        device_type_group_intensity_scaling_factor_mapping.pop(device_type, None)
+
+    if processor.ordered_processing_function is not None:
+        device_type_ordered_processing_function_mapping[device_type] = processor.ordered_processing_function
+    else:
+        device_type_ordered_processing_function_mapping.pop(device_type, None)
+
+    if processor.batch_processing_function is not None:
+        device_type_batch_processing_function_mapping[device_type] = processor.batch_processing_function
+    else:
+        device_type_batch_processing_function_mapping.pop(device_type, None)
+
+    return processor
+
+
+def iter_entry_points(group):
+    """
+    Entry points of the installed packages in the group: from importlib.metadata on Python 3.10+, where it can select
+    the group, from pkg_resources of setuptools before.
+    """
+    # Imported here, it is the slowest part of the module import and only needed for the unknown device types.
+    if sys.version_info >= (3, 10):
+        from importlib.metadata import entry_points
+        return entry_points(group=group)
+
+    import pkg_resources
+    return pkg_resources.iter_entry_points(group)
+
+
+def load_device_processor_plugins():
+    """
+    Register the device processors of the installed packages, from the DEVICE_PROCESSOR_ENTRY_POINT_GROUP entry
+    points. The device types of this package are not replaced. A plugin failing to load is logged and skipped.
+    """
+    global _plugins_loaded
+    _plugins_loaded = True
+
+    for entry_point in iter_entry_points(DEVICE_PROCESSOR_ENTRY_POINT_GROUP):
+        if entry_point.name in device_processors:
+            continue
+
+        try:
+            processor = entry_point.load()
+        except Exception:
+            _logger.exception("Cannot load the device processor '%s'.", entry_point)
+            continue
+
+        register_device_processor(processor)
+        _logger.info("Registered device type '%s' from '%s'.", processor.device_type, entry_point)
+
+
+def get_device_processor(device_type):
+    """
+    :return: DeviceProcessor of the device type, looked up in the plugins if it is not registered.
+    """
+    if device_type not in device_processors and not _plugins_loaded:
+        load_device_processor_plugins()
+
+    if device_type not in device_processors:
+        raise ValueError("Unknown device_type '%s', available: %s." % (device_type, list(device_processors)))
+
+    return device_processors[device_type]
+
+
+def compile_device_plans(devices, processing_function_mapping=device_type_processing_function_mapping,
+                         ordered_processing_function_mapping=device_type_ordered_processing_function_mapping):
+    """
+    Compile the devices section of the configuration into the plans used to process each message.
+    :param devices: Devices section of the configuration.
+    :param processing_function_mapping: Mapping from the device type to the processing function.
+    :param ordered_processing_function_mapping: Mapping from the device type to the processing function to call in
+                                                pulse_id order after the processing function.
+    :return: Dictionary with device_name: DevicePlan, in the order of the configuration.
+    """
+    device_plans = OrderedDict()
+
+    for device_name, device_definition in devices.items():
+        device_type = device_definition[config.CONFIG_DEVICE_TYPE]
+
+        processor = get_device_processor(device_type)
+        processor.validate(device_name, device_definition)
+
+        device_plans[device_name] = processor.compile_plan(
+            device_name, device_definition,
+            processing_function=processing_function_mapping[device_type],
+            ordered_processing_function=ordered_processing_function_mapping.get(device_type))
+
+    return device_plans
+
+
+def compile_output_template(device_plans):
+    """
+    Dictionary with the declared outputs of the devices, all None. It is copied for each message and filled in by
+    the processing functions, so the output dictionary does not grow device by device.
+    :param device_plans: Dictionary with device_name: DevicePlan.
+    :return: Dictionary with output name: None.
+    """
+    output_names = []
+
+    for plan in device_plans.values():
+        output_names.extend(device_processors[plan.device_type].get_output_names(plan))
+
+    return dict.fromkeys(output_names)
+
+
+def compile_device_group(device_plans,
+                         intensity_scaling_factor_mapping=device_type_group_intensity_scaling_factor_mapping):
+    """
+    Group the 4 channel devices of the plans, to calculate their intensity and position at once.
+    :param device_plans: Dictionary with device_name: DevicePlan, compiled with the grouped processing functions.
+    :param intensity_scaling_factor_mapping: Mapping from the device type to the intensity scaling factor, for the
+                                             device types in the group.
+    :return: DeviceGroup of the devices, None if there are no devices to group.
+    """
+    group_plans = [plan for plan in device_plans.values() if plan.device_type in intensity_scaling_factor_mapping]
+
+    if not group_plans:
+        return None
+
+    return DeviceGroup(group_plans, [intensity_scaling_factor_mapping[plan.device_type] for plan in group_plans])
+
+
+for _processor in (pbps_processor, pbpg_processor, single_channel_processor):
+    register_device_processor(_processor)
@@ -1,15 +1,22 @@
-from collections import deque
+import numpy
 
 from frontend_digitizers_calibration import config
-from frontend_digitizers_calibration.devices.utils import calibrate_channel, calculate_intensity_and_position, \
-    SUFFIX_DEVICE_INTENSITY
+from frontend_digitizers_calibration.devices.utils import calibrate_channels, calculate_intensity_and_position, \
+    SUFFIX_DEVICE_INTENSITY, INTENSITY_AND_POSITION_SUFFIXES, DevicePlan, calibrate_channels_batch, DeviceProcessor
+from frontend_digitizers_calibration.running_statistics import DeviceStatistics
 
 
 SUFFIX_DEVICE_INTENSITY_AVG = "INTENSITY-AVG"
 SUFFIX_DEVICE_INTENSITY_CAL = "INTENSITY-CAL"
 SUFFIX_DEVICE_INTENSITY_PBPG = "INTENSITY"
 
-pbpg_queue = deque(maxlen=240)
+PBPG_INTENSITY_SCALING_FACTOR = 0.5
+
+PBPG_DEVICE_SUFFIXES = INTENSITY_AND_POSITION_SUFFIXES + (SUFFIX_DEVICE_INTENSITY_PBPG, SUFFIX_DEVICE_INTENSITY_AVG,
+                                                          SUFFIX_DEVICE_INTENSITY_CAL)
+
+# device_name: DeviceStatistics, for the calls without the statistics of the device.
+pbpg_statistics = {}
 
 # Gain setting is epics enum (DBF_ENUM). Only the integer value of the enum is passed on in the stream.
 # The same gain setting can be achieved with different gain configurations, this is why some gains
@@ -35,39 +42,155 @@ VOLTAGE_GAIN_MAPPING_PBPG = {
 }
 
 
-def process_pbpg(message, device_name, device_definition, channels_definition, calibration_data):
+def compile_pbpg_plan(device_name, device_definition, **kwargs):
+    return DevicePlan(device_name, device_definition, gain_mapping=VOLTAGE_GAIN_MAPPING_PBPG,
+                      device_suffixes=PBPG_DEVICE_SUFFIXES, **kwargs)
+
+
+def calibrate_pbpg(message, device_name, device_definition, channels_definition, calibration_data, buffers=None,
+                   plan=None, data_to_send=None):
+    """
+    Processing of a single pulse without the intensity and position - they are calculated for all the devices at
+    once by DeviceGroup, which also sets the intensity for the running average.
+    """
+
+    if plan is None:
+        plan = compile_pbpg_plan(device_name, device_definition, channels_definition=channels_definition)
 
-    data_to_send = {}
+    if data_to_send is None:
+        data_to_send = {}
 
-    for channel in channels_definition:
-        pv_prefix = channel[config.CONFIG_CHANNEL_PV_PREFIX]
-        channel_number = channel[config.CONFIG_CHANNEL_NUMBER]
-        # pv_names = channel[config.CONFIG_CHANNEL_PVS]
+    return calibrate_channels(message=message,
+                              data_to_send=data_to_send,
+                              channels_definition=channels_definition,
+                              calibration_data=calibration_data,
+                              gain_mapping=VOLTAGE_GAIN_MAPPING_PBPG,
+                              buffers=buffers,
+                              plan=plan)
 
-        calibrate_channel(message=message,
-                          data_to_send=data_to_send,
-                          pv_prefix=pv_prefix,
-                          channel_number=channel_number,
-                          calibration_data=calibration_data,
-                          gain_mapping=VOLTAGE_GAIN_MAPPING_PBPG)
 
-    # Retrieve the channel names in the correct order.
-    channel_names = [channel[config.CONFIG_CHANNEL_PV_PREFIX] for channel in channels_definition]
+def calculate_pbpg(message, device_name, device_definition, channels_definition, calibration_data, buffers=None,
+                   plan=None, data_to_send=None):
+    """
+    Processing of a single pulse, without the running average - can be run in parallel for different pulses.
+    """
 
-    calculate_intensity_and_position(message, data_to_send, channel_names, device_name, device_definition,
-                                     intensity_scaling_factor=0.5)
+    if plan is None:
+        plan = compile_pbpg_plan(device_name, device_definition, channels_definition=channels_definition)
+
+    data_to_send = calibrate_pbpg(message, device_name, device_definition, channels_definition, calibration_data,
+                                  buffers, plan, data_to_send)
+
+    calculate_intensity_and_position(message, data_to_send, None, device_name, device_definition,
+                                     intensity_scaling_factor=PBPG_INTENSITY_SCALING_FACTOR, plan=plan)
 
     # Retrieve intensity for more calculations.
-    intensity = data_to_send[device_name + SUFFIX_DEVICE_INTENSITY]
-    data_to_send[device_name + SUFFIX_DEVICE_INTENSITY_PBPG] = intensity
+    intensity = data_to_send[plan.device_keys[SUFFIX_DEVICE_INTENSITY]]
+    data_to_send[plan.device_keys[SUFFIX_DEVICE_INTENSITY_PBPG]] = intensity
+
+    return data_to_send
+
 
-    pbpg_queue.append(intensity)
-    # average last 240 intensities
-    intensity_average = sum(pbpg_queue) / len(pbpg_queue)
-    data_to_send[device_name + SUFFIX_DEVICE_INTENSITY_AVG] = intensity_average
+def get_intensity_statistics(device_name, device_definition, statistics=None):
+    """
+    Running statistics of the intensity of the device.
+    :param statistics: DeviceStatistics of the device, None to use the module level ones.
+    """
+    if statistics is None:
+        if device_name not in pbpg_statistics:
+            pbpg_statistics[device_name] = DeviceStatistics(device_name, device_definition)
 
-    keithley_intensity = message.data.data[device_definition[config.CONFIG_DEVICE_KEITHLEY_INTENSITY]].value
+        statistics = pbpg_statistics[device_name]
+
+    return statistics.get(SUFFIX_DEVICE_INTENSITY_PBPG,
+                          window=device_definition.get(config.CONFIG_DEVICE_INTENSITY_AVERAGE_WINDOW,
+                                                       config.DEFAULT_INTENSITY_AVERAGE_WINDOW))
+
+
+def average_pbpg(message, device_name, device_definition, data_to_send, plan=None, statistics=None):
+    """
+    Running average of the intensity - has to be called in pulse_id order.
+    """
+
+    if plan is None:
+        plan = compile_pbpg_plan(device_name, device_definition)
+
+    device_keys = plan.device_keys
+
+    intensity = data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY_PBPG]]
+
+    # average of the last intensity_average_window intensities
+    intensity_statistics = get_intensity_statistics(device_name, device_definition, statistics)
+    intensity_statistics.add(intensity)
+    intensity_average = intensity_statistics.mean
+    data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY_AVG]] = intensity_average
+
+    keithley_intensity = message.data.data[plan.keithley_intensity].value
     intensity_cal = intensity * (keithley_intensity / intensity_average)
-    data_to_send[device_name + SUFFIX_DEVICE_INTENSITY_CAL] = intensity_cal
+    data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY_CAL]] = intensity_cal
 
     return data_to_send
+
+
+def process_pbpg(message, device_name, device_definition, channels_definition, calibration_data, buffers=None,
+                 plan=None, statistics=None, data_to_send=None):
+
+    if plan is None:
+        plan = compile_pbpg_plan(device_name, device_definition, channels_definition=channels_definition)
+
+    data_to_send = calculate_pbpg(message, device_name, device_definition, channels_definition, calibration_data,
+                                  buffers, plan, data_to_send)
+
+    return average_pbpg(message, device_name, device_definition, data_to_send, plan, statistics)
+
+
+def process_pbpg_batch(batch, device_name, device_definition, channels_definition, calibration_data, plan=None,
+                       statistics=None, data_to_send=None):
+    """
+    Processing of many pulses at once, the values are arrays over the pulses. The batches have to be processed in
+    pulse_id order.
+    """
+
+    if plan is None:
+        plan = compile_pbpg_plan(device_name, device_definition, channels_definition=channels_definition)
+
+    device_keys = plan.device_keys
+
+    if data_to_send is None:
+        data_to_send = {}
+
+    calibrate_channels_batch(batch, data_to_send, calibration_data, plan)
+
+    calculate_intensity_and_position(batch, data_to_send, None, device_name, device_definition,
+                                     intensity_scaling_factor=PBPG_INTENSITY_SCALING_FACTOR, plan=plan)
+
+    intensity = data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY]]
+    data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY_PBPG]] = intensity
+
+    # The running average is sequential.
+    intensity_statistics = get_intensity_statistics(device_name, device_definition, statistics)
+    intensity_average = numpy.empty(len(intensity), dtype=numpy.float64)
+
+    for index, pulse_intensity in enumerate(intensity):
+        intensity_statistics.add(pulse_intensity)
+        intensity_average[index] = intensity_statistics.mean
+
+    data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY_AVG]] = intensity_average
+
+    keithley_intensity = batch.data.data[plan.keithley_intensity].value
+    data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY_CAL]] = intensity * (keithley_intensity / intensity_average)
+
+    return data_to_send
+
+
+pbpg_processor = DeviceProcessor(device_type="pbpg",
+                                 processing_function=process_pbpg,
+                                 parallel_processing_function=calculate_pbpg,
+                                 ordered_processing_function=average_pbpg,
+                                 grouped_processing_function=calibrate_pbpg,
+                                 batch_processing_function=process_pbpg_batch,
+                                 group_intensity_scaling_factor=PBPG_INTENSITY_SCALING_FACTOR,
+                                 plan_function=compile_pbpg_plan,
+                                 n_channels=4,
+                                 device_inputs=(config.CONFIG_DEVICE_KEITHLEY_INTENSITY,),
+                                 device_outputs=PBPG_DEVICE_SUFFIXES)
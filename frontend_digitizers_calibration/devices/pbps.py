@@ -1,25 +1,70 @@
-from frontend_digitizers_calibration import config
-from frontend_digitizers_calibration.devices.utils import calibrate_channel, \
-    calculate_intensity_and_position
+from frontend_digitizers_calibration.devices.utils import calibrate_channels, \
+    calculate_intensity_and_position, DevicePlan, calibrate_channels_batch, DeviceProcessor, \
+    INTENSITY_AND_POSITION_SUFFIXES
 
 
-def process_pbps(message, device_name, device_definition, channels_definition, calibration_data):
+def compile_pbps_plan(device_name, device_definition, **kwargs):
+    return DevicePlan(device_name, device_definition, device_suffixes=INTENSITY_AND_POSITION_SUFFIXES, **kwargs)
 
-    data_to_send = {}
 
-    for channel in channels_definition:
-        pv_prefix = channel[config.CONFIG_CHANNEL_PV_PREFIX]
-        channel_number = channel[config.CONFIG_CHANNEL_NUMBER]
+def calibrate_pbps(message, device_name, device_definition, channels_definition, calibration_data, buffers=None,
+                   plan=None, data_to_send=None):
+    """
+    Processing without the intensity and position - they are calculated for all the devices at once by DeviceGroup.
+    """
 
-        calibrate_channel(message=message,
-                          data_to_send=data_to_send,
-                          pv_prefix=pv_prefix,
-                          channel_number=channel_number,
-                          calibration_data=calibration_data)
+    if plan is None:
+        plan = compile_pbps_plan(device_name, device_definition, channels_definition=channels_definition)
 
-    # Retrieve the channel names in the correct order.
-    channel_names = [channel[config.CONFIG_CHANNEL_PV_PREFIX] for channel in channels_definition]
+    if data_to_send is None:
+        data_to_send = {}
 
-    calculate_intensity_and_position(message, data_to_send, channel_names, device_name, device_definition)
+    return calibrate_channels(message=message,
+                              data_to_send=data_to_send,
+                              channels_definition=channels_definition,
+                              calibration_data=calibration_data,
+                              buffers=buffers,
+                              plan=plan)
+
+
+def process_pbps(message, device_name, device_definition, channels_definition, calibration_data, buffers=None,
+                 plan=None, data_to_send=None):
+
+    if plan is None:
+        plan = compile_pbps_plan(device_name, device_definition, channels_definition=channels_definition)
+
+    data_to_send = calibrate_pbps(message, device_name, device_definition, channels_definition, calibration_data,
+                                  buffers, plan, data_to_send)
+
+    calculate_intensity_and_position(message, data_to_send, None, device_name, device_definition, plan=plan)
 
     return data_to_send
+
+
+def process_pbps_batch(batch, device_name, device_definition, channels_definition, calibration_data, plan=None,
+                       statistics=None, data_to_send=None):
+    """
+    Processing of many pulses at once, the values are arrays over the pulses.
+    """
+
+    if plan is None:
+        plan = compile_pbps_plan(device_name, device_definition, channels_definition=channels_definition)
+
+    if data_to_send is None:
+        data_to_send = {}
+
+    calibrate_channels_batch(batch, data_to_send, calibration_data, plan)
+
+    calculate_intensity_and_position(batch, data_to_send, None, device_name, device_definition, plan=plan)
+
+    return data_to_send
+
+
+pbps_processor = DeviceProcessor(device_type="pbps",
+                                 processing_function=process_pbps,
+                                 grouped_processing_function=calibrate_pbps,
+                                 batch_processing_function=process_pbps_batch,
+                                 group_intensity_scaling_factor=1,
+                                 plan_function=compile_pbps_plan,
+                                 n_channels=4,
+                                 device_outputs=INTENSITY_AND_POSITION_SUFFIXES)
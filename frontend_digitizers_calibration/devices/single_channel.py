@@ -1,34 +1,70 @@
-from frontend_digitizers_calibration import config
-from frontend_digitizers_calibration.devices.utils import calibrate_channel, SUFFIX_CHANNEL_DATA_SUM
+from frontend_digitizers_calibration.devices.utils import calibrate_channels, DevicePlan, calibrate_channels_batch, \
+    DeviceProcessor
 
 
 SUFFIX_DEVICE_SCALED_DATA_SUM = "SCALED-DATA-SUM"
 
 
-def process_single_channel(message, device_name, device_definition, channels_definition, calibration_data):
+def compile_single_channel_plan(device_name, device_definition, **kwargs):
+    return DevicePlan(device_name, device_definition, device_suffixes=(SUFFIX_DEVICE_SCALED_DATA_SUM,), **kwargs)
 
-    scaling_offset = device_definition["scaling_offset"]
-    scaling_factor = device_definition["scaling_factor"]
 
-    data_to_send = {}
+def process_single_channel(message, device_name, device_definition, channels_definition, calibration_data,
+                           buffers=None, plan=None, data_to_send=None):
 
-    for channel in channels_definition:
-        pv_prefix = channel[config.CONFIG_CHANNEL_PV_PREFIX]
-        channel_number = channel[config.CONFIG_CHANNEL_NUMBER]
-        # pv_names = channel[config.CONFIG_CHANNEL_PVS]
+    if plan is None:
+        plan = compile_single_channel_plan(device_name, device_definition, channels_definition=channels_definition)
 
-        calibrate_channel(message=message,
-                          data_to_send=data_to_send,
-                          pv_prefix=pv_prefix,
-                          channel_number=channel_number,
-                          calibration_data=calibration_data)
+    scaling_offset = plan.scaling_offset
+    scaling_factor = plan.scaling_factor
 
-    if not pv_prefix:
+    if data_to_send is None:
+        data_to_send = {}
+
+    if not plan.channels:
         raise ValueError("pv_prefix not available - are channels defined for device '%s'?" % device_name)
 
+    calibrate_channels(message=message,
+                       data_to_send=data_to_send,
+                       channels_definition=channels_definition,
+                       calibration_data=calibration_data,
+                       buffers=buffers,
+                       plan=plan)
+
     # The data sum for the single channel should be scaled.
-    data_sum = data_to_send[pv_prefix + SUFFIX_CHANNEL_DATA_SUM]
+    data_sum = data_to_send[plan.channels[-1].data_sum]
     scaled_data_sum = (data_sum * scaling_factor) + scaling_offset
-    data_to_send[device_name + SUFFIX_DEVICE_SCALED_DATA_SUM] = scaled_data_sum
+    data_to_send[plan.device_keys[SUFFIX_DEVICE_SCALED_DATA_SUM]] = scaled_data_sum
+
+    return data_to_send
+
+
+def process_single_channel_batch(batch, device_name, device_definition, channels_definition, calibration_data,
+                                 plan=None, statistics=None, data_to_send=None):
+    """
+    Processing of many pulses at once, the values are arrays over the pulses.
+    """
+
+    if plan is None:
+        plan = compile_single_channel_plan(device_name, device_definition, channels_definition=channels_definition)
+
+    if not plan.channels:
+        raise ValueError("pv_prefix not available - are channels defined for device '%s'?" % device_name)
+
+    if data_to_send is None:
+        data_to_send = {}
+
+    calibrate_channels_batch(batch, data_to_send, calibration_data, plan)
+
+    data_sum = data_to_send[plan.channels[-1].data_sum]
+    data_to_send[plan.device_keys[SUFFIX_DEVICE_SCALED_DATA_SUM]] = (data_sum * plan.scaling_factor) + \
+        plan.scaling_offset
 
     return data_to_send
+
+
+single_channel_processor = DeviceProcessor(device_type="single_channel",
+                                           processing_function=process_single_channel,
+                                           batch_processing_function=process_single_channel_batch,
+                                           plan_function=compile_single_channel_plan,
+                                           device_outputs=(SUFFIX_DEVICE_SCALED_DATA_SUM,))
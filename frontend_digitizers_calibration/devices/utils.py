@@ -1,10 +1,17 @@
+import sys
+
 import numpy
 
 from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import WD_N_CELLS
+from frontend_digitizers_calibration.buffers import CalibrationBuffers, MINMAX_WINDOW_SIZE
+from frontend_digitizers_calibration.fused_calibration import calibrate_fused, NUMBA_AVAILABLE
 from frontend_digitizers_calibration.smooth_minmax import find_minmax
 
 SUFFIX_CHANNEL_DATA = "-DATA"
+SUFFIX_CHANNEL_BG_DATA = "-BG-DATA"
 SUFFIX_CHANNEL_DATA_TRIGGER = "-DRS_TC"
+SUFFIX_CHANNEL_BG_DATA_TRIGGER = "-BG-DRS_TC"
 SUFFIX_CHANNEL_WD_GAIN = "-WD-gain-RBa"
 SUFFIX_CHANNEL_DATA_SUM = "-DATA-SUM"
 SUFFIX_CHANNEL_DATA_AMP = "-DATA-AMP"
@@ -17,6 +24,12 @@ SUFFIX_CHANNEL_BG_DATA_MIN = "-BG-DATA-MIN"
 SUFFIX_CHANNEL_BG_DATA_MAX = "-BG-DATA-MAX"
 SUFFIX_CHANNEL_TIME_AXIS = "-TIME-AXIS"
 SUFFIX_CHANNEL_BG_TIME_AXIS = "-BG-TIME-AXIS"
+# [channel_number, trigger_cell] of the time axis of a channel, see time_axis.add_time_axis_references.
+SUFFIX_CHANNEL_TIME_AXIS_REFERENCE = "-TIME-AXIS-REF"
+SUFFIX_CHANNEL_BG_TIME_AXIS_REFERENCE = "-BG-TIME-AXIS-REF"
+# Identity of the time calibration, see TimeCalibration.calibration_id.
+SUFFIX_CHANNEL_TIME_AXIS_CALIBRATION = "-TIME-AXIS-CALIBRATION"
+SUFFIX_CHANNEL_BG_TIME_AXIS_CALIBRATION = "-BG-TIME-AXIS-CALIBRATION"
 SUFFIX_CHANNEL_ROI_SIG_START = "-ROI_sig_min"
 SUFFIX_CHANNEL_ROI_SIG_END = "-ROI_sig_max"
 SUFFIX_CHANNEL_ROI_BG_START = "-ROI_bg_min"
@@ -29,6 +42,23 @@ SUFFIX_Y_INTENSITY = "INTENSITY-Y"
 SUFFIX_DEVICE_XPOS = "XPOS"
 SUFFIX_DEVICE_YPOS = "YPOS"
 
+# Suffixes of the channel values read and written by calibrate_channels - the background values only if the message
+# has the background waveforms.
+CALIBRATION_CHANNEL_INPUTS = (SUFFIX_CHANNEL_DATA, SUFFIX_CHANNEL_DATA_TRIGGER, SUFFIX_CHANNEL_WD_GAIN,
+                              SUFFIX_CHANNEL_ROI_SIG_START, SUFFIX_CHANNEL_ROI_SIG_END, SUFFIX_CHANNEL_ROI_BG_START,
+                              SUFFIX_CHANNEL_ROI_BG_END)
+CALIBRATION_CHANNEL_OUTPUTS = (SUFFIX_CHANNEL_DATA_SUM, SUFFIX_CHANNEL_DATA_CALIBRATED, SUFFIX_CHANNEL_DATA_MIN,
+                               SUFFIX_CHANNEL_DATA_MAX, SUFFIX_CHANNEL_DATA_AMP, SUFFIX_CHANNEL_TIME_AXIS)
+
+# Entry point group of the device processors of other packages, see DeviceProcessor.
+DEVICE_PROCESSOR_ENTRY_POINT_GROUP = "frontend_digitizers_calibration.devices"
+
+# Number of waveforms calibrated at once by calibrate_channels_batch.
+BATCH_CHUNK_SIZE = 256
+
+INTENSITY_AND_POSITION_SUFFIXES = (SUFFIX_DEVICE_INTENSITY, SUFFIX_X_INTENSITY, SUFFIX_Y_INTENSITY,
+                                   SUFFIX_DEVICE_XPOS, SUFFIX_DEVICE_YPOS)
+
 
 # Gain setting is epics enum (DBF_ENUM). Only the integer value of the enum is passed on in the stream.
 # The same gain setting can be achieved with different gain configurations, this is why some gains
@@ -54,64 +84,520 @@ VOLTAGE_GAIN_MAPPING_PDIM = {
 }
 
 
-def calibrate_channel(message, data_to_send, pv_prefix, channel_number, calibration_data,
-                      gain_mapping=VOLTAGE_GAIN_MAPPING_PDIM):
+class ChannelPlan(object):
+    """
+    Names of the input and output values of a channel, compiled once from the channel definition.
+    """
+    __slots__ = ["pv_prefix", "channel_number", "data", "trigger_cell", "gain", "roi_signal_start", "roi_signal_end",
+                 "roi_background_start", "roi_background_end", "bg_data", "bg_trigger_cell", "data_sum",
+                 "data_calibrated", "data_min", "data_max", "data_amp", "time_axis", "bg_data_sum",
+                 "bg_data_calibrated", "bg_data_min", "bg_data_max", "bg_time_axis", "time_axis_references"]
+
+    def __init__(self, channel_definition):
+        pv_prefix = sys.intern(channel_definition[config.CONFIG_CHANNEL_PV_PREFIX])
+
+        self.pv_prefix = pv_prefix
+        self.channel_number = channel_definition[config.CONFIG_CHANNEL_NUMBER]
+
+        # Input values.
+        self.data = sys.intern(pv_prefix + SUFFIX_CHANNEL_DATA)
+        self.trigger_cell = sys.intern(pv_prefix + SUFFIX_CHANNEL_DATA_TRIGGER)
+        self.gain = sys.intern(pv_prefix + SUFFIX_CHANNEL_WD_GAIN)
+        self.roi_signal_start = sys.intern(pv_prefix + SUFFIX_CHANNEL_ROI_SIG_START)
+        self.roi_signal_end = sys.intern(pv_prefix + SUFFIX_CHANNEL_ROI_SIG_END)
+        self.roi_background_start = sys.intern(pv_prefix + SUFFIX_CHANNEL_ROI_BG_START)
+        self.roi_background_end = sys.intern(pv_prefix + SUFFIX_CHANNEL_ROI_BG_END)
+        self.bg_data = sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_DATA)
+        self.bg_trigger_cell = sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_DATA_TRIGGER)
+
+        # Output values.
+        self.data_sum = sys.intern(pv_prefix + SUFFIX_CHANNEL_DATA_SUM)
+        self.data_calibrated = sys.intern(pv_prefix + SUFFIX_CHANNEL_DATA_CALIBRATED)
+        self.data_min = sys.intern(pv_prefix + SUFFIX_CHANNEL_DATA_MIN)
+        self.data_max = sys.intern(pv_prefix + SUFFIX_CHANNEL_DATA_MAX)
+        self.data_amp = sys.intern(pv_prefix + SUFFIX_CHANNEL_DATA_AMP)
+        self.time_axis = sys.intern(pv_prefix + SUFFIX_CHANNEL_TIME_AXIS)
+        self.bg_data_sum = sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_DATA_SUM)
+        self.bg_data_calibrated = sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_DATA_CALIBRATED)
+        self.bg_data_min = sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_DATA_MIN)
+        self.bg_data_max = sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_DATA_MAX)
+        self.bg_time_axis = sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_TIME_AXIS)
+
+        # (time axis, trigger cell, reference, calibration) of the signal and background waveform.
+        self.time_axis_references = (
+            (self.time_axis, self.trigger_cell, sys.intern(pv_prefix + SUFFIX_CHANNEL_TIME_AXIS_REFERENCE),
+             sys.intern(pv_prefix + SUFFIX_CHANNEL_TIME_AXIS_CALIBRATION)),
+            (self.bg_time_axis, self.bg_trigger_cell, sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_TIME_AXIS_REFERENCE),
+             sys.intern(pv_prefix + SUFFIX_CHANNEL_BG_TIME_AXIS_CALIBRATION)))
+
+
+def compile_gain_table(gain_mapping):
+    """
+    Array lookup table of the gain mapping: gain_table[gain_setting] = gain factor.
+    """
+    gain_table = numpy.zeros(max(gain_mapping) + 1, dtype=numpy.float32)
+
+    for gain_setting, gain in gain_mapping.items():
+        gain_table[gain_setting] = gain
+
+    gain_table.flags.writeable = False
+
+    return gain_table
+
+
+class DevicePlan(object):
+    """
+    Everything the processing of a device needs from the configuration, compiled once at startup:
+    the value names, the gain table and the scaling constants. Plans are not modified after they are compiled.
+    """
+    __slots__ = ["device_name", "device_type", "device_definition", "channels_definition", "channels",
+                 "channel_numbers", "row_channel_numbers", "gain_table", "device_keys", "processing_function",
+                 "ordered_processing_function", "x_scaling_factor", "x_scaling_offset", "y_scaling_factor",
+                 "y_scaling_offset", "scaling_factor", "scaling_offset", "keithley_intensity"]
+
+    def __init__(self, device_name, device_definition, gain_mapping=VOLTAGE_GAIN_MAPPING_PDIM,
+                 device_suffixes=INTENSITY_AND_POSITION_SUFFIXES, processing_function=None,
+                 ordered_processing_function=None, channels_definition=None):
+        """
+        :param device_name: Name of the device, the prefix of the device values.
+        :param device_definition: Device definition from the configuration.
+        :param gain_mapping: Mapping from the gain setting to the voltage gain factor.
+        :param device_suffixes: Suffixes of the device values, see device_keys.
+        :param processing_function: Function to process the device with.
+        :param ordered_processing_function: Function to call in pulse_id order after the processing function.
+        :param channels_definition: Channels to process, the channels of the device definition if None.
+        """
+        if channels_definition is None:
+            channels_definition = device_definition[config.CONFIG_DEVICE_CHANNELS]
+
+        self.device_name = sys.intern(device_name)
+        self.device_type = device_definition.get(config.CONFIG_DEVICE_TYPE)
+        self.device_definition = device_definition
+        self.channels_definition = channels_definition
+
+        self.channels = tuple(ChannelPlan(channel) for channel in channels_definition)
+        self.channel_numbers = numpy.array([channel.channel_number for channel in self.channels], dtype=numpy.int32)
+        self.channel_numbers.flags.writeable = False
+        # Channel numbers of the signal and background waveform rows.
+        self.row_channel_numbers = numpy.concatenate((self.channel_numbers, self.channel_numbers))
+        self.row_channel_numbers.flags.writeable = False
+        self.gain_table = compile_gain_table(gain_mapping)
+
+        # suffix: name of the device value
+        self.device_keys = {suffix: sys.intern(device_name + suffix) for suffix in device_suffixes}
+
+        self.processing_function = processing_function
+        self.ordered_processing_function = ordered_processing_function
+
+        self.x_scaling_factor = device_definition.get(config.CONFIG_DEVICE_X_SCALING_FACTOR)
+        self.x_scaling_offset = device_definition.get(config.CONFIG_DEVICE_X_SCALING_OFFSET)
+        self.y_scaling_factor = device_definition.get(config.CONFIG_DEVICE_Y_SCALING_FACTOR)
+        self.y_scaling_offset = device_definition.get(config.CONFIG_DEVICE_Y_SCALING_OFFSET)
+        self.scaling_factor = device_definition.get(config.CONFIG_DEVICE_SCALING_FACTOR)
+        self.scaling_offset = device_definition.get(config.CONFIG_DEVICE_SCALING_OFFSET)
+        self.keithley_intensity = device_definition.get(config.CONFIG_DEVICE_KEITHLEY_INTENSITY)
+
+
+class DeviceProcessor(object):
+    """
+    Processing of a device type, with the values it reads and writes declared up front.
+
+    The processing functions are called with message, device_name, device_definition, channels_definition,
+    calibration_data, buffers, plan and data_to_send as keyword arguments. They write their outputs into
+    data_to_send, which is shared by all the devices of a message, and return it. The batch processing function gets
+    batch and statistics instead of message and buffers, the values are arrays over the pulses.
+
+    Device types of other packages are registered with an entry point in DEVICE_PROCESSOR_ENTRY_POINT_GROUP, named
+    after the device type and pointing to their DeviceProcessor.
+    """
+    __slots__ = ["device_type", "processing_function", "parallel_processing_function", "ordered_processing_function",
+                 "grouped_processing_function", "batch_processing_function", "group_intensity_scaling_factor",
+                 "plan_function", "n_channels", "channel_inputs", "device_inputs", "channel_outputs",
+                 "device_outputs"]
+
+    def __init__(self, device_type, processing_function, parallel_processing_function=None,
+                 ordered_processing_function=None, grouped_processing_function=None, batch_processing_function=None,
+                 group_intensity_scaling_factor=None, plan_function=None, n_channels=None,
+                 channel_inputs=CALIBRATION_CHANNEL_INPUTS, device_inputs=(),
+                 channel_outputs=CALIBRATION_CHANNEL_OUTPUTS, device_outputs=()):
+        """
+        :param device_type: Device type in the configuration.
+        :param processing_function: Function to process a pulse of the device with, in pulse_id order.
+        :param parallel_processing_function: Function without state between pulses, processing_function if None.
+        :param ordered_processing_function: Function to call in pulse_id order after the parallel processing.
+        :param grouped_processing_function: Parallel processing function without the intensity and position, which
+                                            are calculated by the DeviceGroup. None if the device is not grouped.
+        :param batch_processing_function: Function to process many pulses at once, None if not supported.
+        :param group_intensity_scaling_factor: Intensity scaling factor of the device in the DeviceGroup.
+        :param plan_function: Function to compile the DevicePlan with, DevicePlan with device_outputs if None.
+        :param n_channels: Number of channels the device needs, None for any number.
+        :param channel_inputs: Suffixes of the message values read for each channel.
+        :param device_inputs: Names of the device definition entries with the names of message values read.
+        :param channel_outputs: Suffixes of the values written for each channel in every processed pulse.
+        :param device_outputs: Suffixes of the device values written in every processed pulse.
+        """
+        self.device_type = device_type
+        self.processing_function = processing_function
+        self.parallel_processing_function = parallel_processing_function or processing_function
+        self.ordered_processing_function = ordered_processing_function
+        self.grouped_processing_function = grouped_processing_function
+        self.batch_processing_function = batch_processing_function
+        self.group_intensity_scaling_factor = group_intensity_scaling_factor
+        self.plan_function = plan_function
+        self.n_channels = n_channels
+        self.channel_inputs = channel_inputs
+        self.device_inputs = device_inputs
+        self.channel_outputs = channel_outputs
+        self.device_outputs = device_outputs
+
+    def compile_plan(self, device_name, device_definition, **kwargs):
+        """
+        :return: DevicePlan of the device, the device_keys are the device outputs.
+        """
+        if self.plan_function is not None:
+            return self.plan_function(device_name, device_definition, **kwargs)
+
+        return DevicePlan(device_name, device_definition, device_suffixes=self.device_outputs, **kwargs)
+
+    def validate(self, device_name, device_definition):
+        n_channels = len(device_definition.get(config.CONFIG_DEVICE_CHANNELS) or ())
+
+        if self.n_channels is not None and n_channels != self.n_channels:
+            raise ValueError("Device '%s' of type '%s' needs %d channels, %d defined." %
+                             (device_name, self.device_type, self.n_channels, n_channels))
+
+    def get_input_names(self, plan):
+        """
+        :return: Names of the message values the device reads.
+        """
+        return [channel.pv_prefix + suffix for channel in plan.channels for suffix in self.channel_inputs] + \
+            [plan.device_definition[name] for name in self.device_inputs]
+
+    def get_output_names(self, plan):
+        """
+        :return: Names of the values the device writes in every processed pulse.
+        """
+        return [channel.pv_prefix + suffix for channel in plan.channels for suffix in self.channel_outputs] + \
+            [plan.device_keys[suffix] for suffix in self.device_outputs]
+
+
+def calibrate_channels(message, data_to_send, channels_definition, calibration_data,
+                       gain_mapping=VOLTAGE_GAIN_MAPPING_PDIM, buffers=None, plan=None, fused=None):
+    """
+    Calibrate all the channels of a device in one vectorized pass.
+    If the message has the background waveforms of all the channels, they are calibrated in the same pass, each with
+    its own trigger cell: the signal waveforms are the first n_channels rows, the background waveforms the next ones.
+    :param message: bsread message with the raw channel data.
+    :param data_to_send: Dictionary to add the calculated values to.
+    :param channels_definition: List of channel definitions (pv_prefix, channel_number) from the configuration.
+    :param calibration_data: CalibrationManager with the loaded voltage and time calibration.
+    :param gain_mapping: Mapping from the gain setting to the voltage gain factor.
+    :param buffers: CalibrationBuffers of the device, None to allocate the arrays for this message.
+    :param plan: DevicePlan of the channels, compiled from channels_definition and gain_mapping if None.
+    :param fused: Calibrate with the fused kernel, None to use it if Numba is installed.
+    :return: Dictionary with the calculated values.
+    """
+    if fused is None:
+        fused = config.USE_FUSED_CALIBRATION and NUMBA_AVAILABLE
+
+    if plan is None:
+        plan = DevicePlan("", {}, gain_mapping, device_suffixes=(), channels_definition=channels_definition)
+
+    channels = plan.channels
+    gain_table = plan.gain_table
+    message_data = message.data.data
+    n_channels = len(channels)
+
+    background = n_channels > 0 and all(channel.bg_data in message_data and channel.bg_trigger_cell in message_data
+                                        for channel in channels)
+
+    if background:
+        n_rows = 2 * n_channels
+        channel_numbers = plan.row_channel_numbers
+    else:
+        n_rows = n_channels
+        channel_numbers = plan.channel_numbers
+
+    if buffers is None:
+        data = numpy.empty((n_rows, WD_N_CELLS), dtype=numpy.float32)
+        trigger_cells = numpy.empty(n_rows, dtype=numpy.int32)
+        gains = numpy.empty(n_rows, dtype=numpy.float32)
+        minmax_windows = None
+    else:
+        data = buffers.next_output()[:n_rows]
+        trigger_cells = buffers.trigger_cells[:n_rows]
+        gains = buffers.gains[:n_rows]
+        minmax_windows = buffers.minmax_windows[:n_rows]
+
+    signal_rois = []
+    background_rois = []
 
     # Read from bsread message.
-    data = message.data.data[pv_prefix+SUFFIX_CHANNEL_DATA].value
-    data_trigger_cell = message.data.data[pv_prefix+SUFFIX_CHANNEL_DATA_TRIGGER].value
-    gain_setting = message.data.data[pv_prefix+SUFFIX_CHANNEL_WD_GAIN].value
+    for index, channel in enumerate(channels):
+        data[index] = message_data[channel.data].value
+        trigger_cells[index] = message_data[channel.trigger_cell].value
+        gains[index] = gain_table[message_data[channel.gain].value]
+
+        # make roi include the end point [start, end]
+        signal_rois.append(slice(message_data[channel.roi_signal_start].value,
+                                 message_data[channel.roi_signal_end].value + 1))
+        background_rois.append(slice(message_data[channel.roi_background_start].value,
+                                     message_data[channel.roi_background_end].value + 1))
+
+    if background:
+        # The background waveform is acquired with the same gain and processed with the same rois.
+        for index, channel in enumerate(channels, n_channels):
+            data[index] = message_data[channel.bg_data].value
+            trigger_cells[index] = message_data[channel.bg_trigger_cell].value
+
+        gains[n_channels:] = gains[:n_channels]
+
+    if fused:
+        rois = numpy.empty((n_rows, 4), dtype=numpy.intp)
+
+        for index in range(n_rows):
+            background_roi = background_rois[index % n_channels]
+            signal_roi = signal_rois[index % n_channels]
+            rois[index] = background_roi.start, background_roi.stop, signal_roi.start, signal_roi.stop
+
+        data_sums, data_min, data_max = calibrate_fused(data, trigger_cells, channel_numbers, gains, rois,
+                                                        calibration_data.vcal, MINMAX_WINDOW_SIZE)
+    else:
+        data_sums, data_min, data_max = calibrate_rows(data, trigger_cells, channel_numbers, gains, signal_rois,
+                                                       background_rois, calibration_data, buffers, minmax_windows)
 
-    # make roi include the end point [start, end]
-    signal_roi = slice(message.data.data[pv_prefix + SUFFIX_CHANNEL_ROI_SIG_START].value,
-                  message.data.data[pv_prefix + SUFFIX_CHANNEL_ROI_SIG_END].value + 1)
-    background_roi = slice(message.data.data[pv_prefix + SUFFIX_CHANNEL_ROI_BG_START].value,
-                  message.data.data[pv_prefix + SUFFIX_CHANNEL_ROI_BG_END].value + 1)
+    for index, channel in enumerate(channels):
+        data_to_send[channel.data_sum] = data_sums[index]
+        data_to_send[channel.data_calibrated] = data[index]
+        data_to_send[channel.data_min] = data_min[index]
+        data_to_send[channel.data_max] = data_max[index]
+        data_to_send[channel.data_amp] = data_max[index] - data_min[index]
+
+        data_to_send[channel.time_axis] = calibration_data.tcal.get_time_axis(trigger_cells[index],
+                                                                               channel.channel_number)
+
+    if background:
+        for index, channel in enumerate(channels, n_channels):
+            data_to_send[channel.bg_data_sum] = data_sums[index]
+            data_to_send[channel.bg_data_calibrated] = data[index]
+            data_to_send[channel.bg_data_min] = data_min[index]
+            data_to_send[channel.bg_data_max] = data_max[index]
+
+            data_to_send[channel.bg_time_axis] = calibration_data.tcal.get_time_axis(trigger_cells[index],
+                                                                                      channel.channel_number)
+
+    return data_to_send
+
+
+def calibrate_rows(data, trigger_cells, channel_numbers, gains, signal_rois, background_rois, calibration_data,
+                   buffers=None, minmax_windows=None):
+    """
+    Calibrate the raw waveforms in place with NumPy, the same processing as the fused kernel.
+    :param data: float32 array (n_rows x WD_N_CELLS) with the raw ADC values.
+    :param signal_rois: Signal region slice of each channel, the rows after the channels are their backgrounds.
+    :param background_rois: Background region slice of each channel.
+    :return: (sums, minimums, maximums) of the rows.
+    """
+    n_channels = len(signal_rois)
 
     # Offset and scale
-    data = (data.astype(numpy.float32) - 2048) / 4096
+    data -= 2048
+    data /= 4096
 
-    data = calibration_data.vcal.calibrate(data, data_trigger_cell, channel_number)
+    if buffers is None:
+        data = calibration_data.vcal.calibrate_many(data, trigger_cells, channel_numbers)
+    else:
+        data = calibration_data.vcal.calibrate_many(data, trigger_cells, channel_numbers, workspace=buffers)
 
     # reverse gain
-    data *= gain_mapping[gain_setting]
+    data *= gains[:, numpy.newaxis]
 
-    # baseline subtraction
-    background = data[background_roi]
-    base_line = numpy.average(background)
-    data -= base_line
+    data_sums = []
 
-    # integration
-    data_sum = data[signal_roi].sum()
+    for index in range(len(data)):
+        channel_data = data[index]
+
+        # baseline subtraction
+        base_line = numpy.average(channel_data[background_rois[index % n_channels]])
+        channel_data -= base_line
+
+        # integration
+        data_sums.append(channel_data[signal_rois[index % n_channels]].sum())
 
     # min max
-    [min, max] = find_minmax(data)
+    [data_min, data_max] = find_minmax(data, windows=minmax_windows)
+
+    return data_sums, data_min, data_max
+
+
+def calibrate_channel(message, data_to_send, pv_prefix, channel_number, calibration_data,
+                      gain_mapping=VOLTAGE_GAIN_MAPPING_PDIM, buffers=None):
+
+    channel_definition = {config.CONFIG_CHANNEL_PV_PREFIX: pv_prefix,
+                          config.CONFIG_CHANNEL_NUMBER: channel_number}
+
+    return calibrate_channels(message, data_to_send, [channel_definition], calibration_data, gain_mapping, buffers)
+
+
+def calibrate_channels_batch(batch, data_to_send, calibration_data, plan):
+    """
+    Calibrate the channels of a device for many pulses in one vectorized pass: pulses x rows x WD_N_CELLS.
+    Same processing as calibrate_channels, the values of each output are arrays over the pulses.
+    :param batch: Message with the values of all the pulses stacked: message.data.data[name].value[pulse].
+    :param data_to_send: Dictionary to add the calculated values to.
+    :param calibration_data: CalibrationManager with the loaded voltage and time calibration.
+    :param plan: DevicePlan of the device.
+    :return: Dictionary with the calculated values.
+    """
+    channels = plan.channels
+    batch_data = batch.data.data
+    n_channels = len(channels)
+    n_pulses = len(batch.data.pulse_id)
+
+    background = n_channels > 0 and all(channel.bg_data in batch_data and channel.bg_trigger_cell in batch_data
+                                        for channel in channels)
+    n_rows = 2 * n_channels if background else n_channels
+    channel_numbers = plan.row_channel_numbers if background else plan.channel_numbers
+
+    data = numpy.empty((n_pulses, n_rows, WD_N_CELLS), dtype=numpy.float32)
+    trigger_cells = numpy.empty((n_pulses, n_rows), dtype=numpy.int32)
+    gains = numpy.empty((n_pulses, n_rows), dtype=numpy.float32)
+
+    # [pulse, channel] start and end of the rois.
+    rois = {name: numpy.empty((n_pulses, n_channels), dtype=numpy.intp)
+            for name in ("roi_signal_start", "roi_signal_end", "roi_background_start", "roi_background_end")}
+
+    for index, channel in enumerate(channels):
+        data[:, index] = batch_data[channel.data].value
+        trigger_cells[:, index] = batch_data[channel.trigger_cell].value
+        gains[:, index] = plan.gain_table[batch_data[channel.gain].value]
+
+        for name, roi in rois.items():
+            roi[:, index] = batch_data[getattr(channel, name)].value
+
+        if background:
+            data[:, n_channels + index] = batch_data[channel.bg_data].value
+            trigger_cells[:, n_channels + index] = batch_data[channel.bg_trigger_cell].value
+            gains[:, n_channels + index] = gains[:, index]
+
+    # Offset and scale
+    data -= 2048
+    data /= 4096
 
-    data_to_send[pv_prefix + SUFFIX_CHANNEL_DATA_SUM] = data_sum
-    data_to_send[pv_prefix + SUFFIX_CHANNEL_DATA_CALIBRATED] = data
-    data_to_send[pv_prefix + SUFFIX_CHANNEL_DATA_MIN] = min
-    data_to_send[pv_prefix + SUFFIX_CHANNEL_DATA_MAX] = max
-    data_to_send[pv_prefix + SUFFIX_CHANNEL_DATA_AMP] = max - min
+    # The waveforms are calibrated in chunks that fit into the cache, with a preallocated workspace.
+    rows = data.reshape(-1, WD_N_CELLS)
+    row_trigger_cells = trigger_cells.reshape(-1)
+    row_channel_numbers = numpy.tile(channel_numbers, n_pulses)
+    workspace = CalibrationBuffers(BATCH_CHUNK_SIZE // 2, n_sets=1)
 
-    data_to_send[pv_prefix + SUFFIX_CHANNEL_TIME_AXIS] = \
-        calibration_data.tcal.get_time_axis(data_trigger_cell, channel_number)
+    for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+        chunk = slice(start, start + BATCH_CHUNK_SIZE)
+        calibration_data.vcal.calibrate_many(rows[chunk], row_trigger_cells[chunk], row_channel_numbers[chunk],
+                                             workspace=workspace)
+
+    # reverse gain
+    data *= gains[..., numpy.newaxis]
+
+    data_sums = numpy.empty((n_pulses, n_rows), dtype=numpy.float32)
+
+    for row in range(n_rows):
+        index = row % n_channels
+        roi_keys = numpy.stack([rois[name][:, index] for name in ("roi_background_start", "roi_background_end",
+                                                                  "roi_signal_start", "roi_signal_end")], axis=1)
+
+        # The rois rarely change - process the pulses with the same rois together.
+        for background_start, background_end, signal_start, signal_end in numpy.unique(roi_keys, axis=0):
+            pulses = numpy.flatnonzero((roi_keys == (background_start, background_end,
+                                                     signal_start, signal_end)).all(axis=1))
+            if len(pulses) == n_pulses:
+                pulses = slice(None)
+
+            rows_data = data[pulses, row]
+
+            # baseline subtraction
+            base_line = numpy.average(rows_data[:, background_start:background_end + 1], axis=-1)
+            rows_data -= base_line[:, numpy.newaxis]
+
+            # integration
+            data_sums[pulses, row] = rows_data[:, signal_start:signal_end + 1].sum(axis=-1)
+
+            # Fancy indexing copies the data.
+            if not isinstance(pulses, slice):
+                data[pulses, row] = rows_data
+
+    # min max
+    data_min = numpy.empty((n_pulses, n_rows), dtype=numpy.float32)
+    data_max = numpy.empty((n_pulses, n_rows), dtype=numpy.float32)
+
+    for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+        chunk = slice(start, start + BATCH_CHUNK_SIZE)
+        chunk_rows = rows[chunk]
+
+        [data_min.reshape(-1)[chunk], data_max.reshape(-1)[chunk]] = \
+            find_minmax(chunk_rows, windows=workspace.minmax_windows[:len(chunk_rows)])
+
+    def get_time_axes(row, channel):
+        return numpy.stack([calibration_data.tcal.get_time_axis(trigger_cell, channel.channel_number)
+                            for trigger_cell in trigger_cells[:, row]])
+
+    for index, channel in enumerate(channels):
+        data_to_send[channel.data_sum] = data_sums[:, index]
+        data_to_send[channel.data_calibrated] = data[:, index]
+        data_to_send[channel.data_min] = data_min[:, index]
+        data_to_send[channel.data_max] = data_max[:, index]
+        data_to_send[channel.data_amp] = data_max[:, index] - data_min[:, index]
+        data_to_send[channel.time_axis] = get_time_axes(index, channel)
+
+        if background:
+            row = n_channels + index
+            data_to_send[channel.bg_data_sum] = data_sums[:, row]
+            data_to_send[channel.bg_data_calibrated] = data[:, row]
+            data_to_send[channel.bg_data_min] = data_min[:, row]
+            data_to_send[channel.bg_data_max] = data_max[:, row]
+            data_to_send[channel.bg_time_axis] = get_time_axes(row, channel)
 
     return data_to_send
 
 
+def normalized_difference(a, b, out=None):
+    """
+    (a - b) / (a + b) of scalars or arrays, NaN where a + b is 0: there is no position without a signal.
+    :param out: Array to write the result to, allocated if None.
+    """
+    total = a + b
+
+    if numpy.ndim(total) == 0 and out is None:
+        if total == 0:
+            return numpy.result_type(total, numpy.float32).type(numpy.nan)
+
+        return (a - b) / total
+
+    if out is None:
+        out = numpy.empty(numpy.shape(total), dtype=numpy.result_type(total, numpy.float32))
+
+    out.fill(numpy.nan)
+
+    return numpy.divide(a - b, total, out=out, where=total != 0)
+
+
 def calculate_intensity_and_position(message, data_to_send, channel_names, device_name, device_definition,
-                                     intensity_scaling_factor=1):
+                                     intensity_scaling_factor=1, plan=None):
+
+    if plan is None:
+        channels_definition = [{config.CONFIG_CHANNEL_PV_PREFIX: channel_name, config.CONFIG_CHANNEL_NUMBER: 0}
+                               for channel_name in channel_names]
+        plan = DevicePlan(device_name, device_definition, channels_definition=channels_definition)
 
-    x_scaling_offset = device_definition["x_scaling_offset"]
-    y_scaling_offset = device_definition["y_scaling_offset"]
-    x_scaling_factor = device_definition["x_scaling_factor"]
-    y_scaling_factor = device_definition["y_scaling_factor"]
+    x_scaling_offset = plan.x_scaling_offset
+    y_scaling_offset = plan.y_scaling_offset
+    x_scaling_factor = plan.x_scaling_factor
+    y_scaling_factor = plan.y_scaling_factor
 
     # intensity and position calculations
-    channel1_sum = data_to_send[channel_names[0] + SUFFIX_CHANNEL_DATA_SUM]
-    channel2_sum = data_to_send[channel_names[1] + SUFFIX_CHANNEL_DATA_SUM]
-    channel3_sum = data_to_send[channel_names[2] + SUFFIX_CHANNEL_DATA_SUM]
-    channel4_sum = data_to_send[channel_names[3] + SUFFIX_CHANNEL_DATA_SUM]
+    channel1_sum = data_to_send[plan.channels[0].data_sum]
+    channel2_sum = data_to_send[plan.channels[1].data_sum]
+    channel3_sum = data_to_send[plan.channels[2].data_sum]
+    channel4_sum = data_to_send[plan.channels[3].data_sum]
 
     intensity = (channel1_sum + channel2_sum + channel3_sum + channel4_sum) * intensity_scaling_factor
     intensity = abs(intensity)
@@ -119,15 +605,16 @@ def calculate_intensity_and_position(message, data_to_send, channel_names, devic
     x_intensity = abs(channel1_sum + channel2_sum)
     y_intensity = abs(channel3_sum + channel4_sum)
 
-    x_position = ((channel1_sum - channel2_sum) / (channel1_sum + channel2_sum))
-    y_position = ((channel3_sum - channel4_sum) / (channel3_sum + channel4_sum))
+    x_position = normalized_difference(channel1_sum, channel2_sum)
+    y_position = normalized_difference(channel3_sum, channel4_sum)
 
     # Scaling
     x_position = (x_position * x_scaling_factor) + x_scaling_offset
     y_position = (y_position * y_scaling_factor) + y_scaling_offset
 
-    data_to_send[device_name + SUFFIX_DEVICE_INTENSITY] = intensity
-    data_to_send[device_name + SUFFIX_X_INTENSITY] = x_intensity
-    data_to_send[device_name + SUFFIX_Y_INTENSITY] = y_intensity
-    data_to_send[device_name + SUFFIX_DEVICE_XPOS] = x_position
-    data_to_send[device_name + SUFFIX_DEVICE_YPOS] = y_position
+    device_keys = plan.device_keys
+    data_to_send[device_keys[SUFFIX_DEVICE_INTENSITY]] = intensity
+    data_to_send[device_keys[SUFFIX_X_INTENSITY]] = x_intensity
+    data_to_send[device_keys[SUFFIX_Y_INTENSITY]] = y_intensity
+    data_to_send[device_keys[SUFFIX_DEVICE_XPOS]] = x_position
+    data_to_send[device_keys[SUFFIX_DEVICE_YPOS]] = y_position
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy
+
+# Dump file of a message part: message index, part index.
+DUMP_FILE_FORMAT = "%06d_%03d.raw"
+DUMP_FILE_PATTERN = re.compile(r"^(\d{6})_(\d{3})\.raw$")
+
+# Parts of a message: main header, data header, then the value and timestamp of each channel.
+PART_MAIN_HEADER = 0
+PART_DATA_HEADER = 1
+PART_FIRST_VALUE = 2
+
+# Byte order of the values by the encoding in the data header.
+ENCODING_BYTE_ORDER = {"big": ">", "little": "<"}
+
+
+def list_dump_messages(folder):
+    """
+    :param folder: Folder with a mflow dump.
+    :return: Sorted message indices of the messages in the dump.
+    """
+    message_indices = set()
+
+    for filename in os.listdir(folder):
+        match = DUMP_FILE_PATTERN.match(filename)
+
+        if match and int(match.group(2)) == PART_MAIN_HEADER:
+            message_indices.add(int(match.group(1)))
+
+    return sorted(message_indices)
+
+
+def read_part(folder, message_index, part_index):
+    with open(os.path.join(folder, DUMP_FILE_FORMAT % (message_index, part_index)), "rb") as part_file:
+        return part_file.read()
+
+
+def decode_value(raw_value, channel):
+    """
+    Decode the value of a channel as bsread does.
+    :param raw_value: Bytes of the value part.
+    :param channel: Channel definition from the data header.
+    :return: Value, None if the channel has no value in this message.
+    """
+    if not raw_value:
+        return None
+
+    compression = channel.get("compression", "none")
+    if compression not in (None, "none"):
+        raise ValueError("Compression '%s' of channel '%s' is not supported." % (compression, channel["name"]))
+
+    channel_type = channel.get("type", "float64")
+
+    if channel_type == "string":
+        return raw_value.decode()
+
+    dtype = numpy.dtype("bool" if channel_type == "bool" else channel_type)
+    dtype = dtype.newbyteorder(ENCODING_BYTE_ORDER[channel.get("encoding", "little")])
+
+    value = numpy.frombuffer(raw_value, dtype=dtype)
+    shape = channel.get("shape", [1])
+
+    if shape == [1]:
+        return value[0]
+
+    # The shape is given as [x, y], the array is [y, x].
+    return value.reshape(shape[::-1])
+
+
+class DumpReader(object):
+    """
+    Read the messages of a mflow dump folder, without replaying them over the network.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.message_indices = list_dump_messages(folder)
+
+        # Data headers by hash - the data header changes only when the channels change.
+        self.data_headers = {}
+
+    def __len__(self):
+        return len(self.message_indices)
+
+    def read_message(self, message_index):
+        """
+        :param message_index: Index of the message in the dump.
+        :return: (pulse_id, dictionary with name: value)
+        """
+        main_header = json.loads(read_part(self.folder, message_index, PART_MAIN_HEADER).decode())
+
+        data_header_hash = main_header.get("hash")
+        if data_header_hash is None or data_header_hash not in self.data_headers:
+            self.data_headers[data_header_hash] = json.loads(read_part(self.folder, message_index,
+                                                                       PART_DATA_HEADER).decode())
+
+        values = {}
+        for channel_index, channel in enumerate(self.data_headers[data_header_hash]["channels"]):
+            raw_value = read_part(self.folder, message_index, PART_FIRST_VALUE + 2 * channel_index)
+            values[channel["name"]] = decode_value(raw_value, channel)
+
+        return main_header["pulse_id"], values
+
+    def __iter__(self):
+        for message_index in self.message_indices:
+            yield self.read_message(message_index)
+
+
+def write_dump_message(folder, message_index, pulse_id, values):
+    """
+    Write a message in the mflow dump format, with big endian values.
+    :param folder: Dump folder.
+    :param message_index: Index of the message in the dump.
+    :param pulse_id: Pulse_id of the message.
+    :param values: Dictionary with name: value (scalar or numpy array), None for no value.
+    """
+    channels = []
+    parts = []
+
+    for name, value in values.items():
+        if value is None:
+            channels.append({"name": name, "type": "float64", "shape": [1], "encoding": "big"})
+            parts.append(b"")
+            continue
+
+        value = numpy.asarray(value)
+        channels.append({"name": name,
+                         "type": value.dtype.name,
+                         "shape": list(value.shape[::-1]) or [1],
+                         "encoding": "big",
+                         "compression": "none"})
+        parts.append(value.astype(value.dtype.newbyteorder(">")).tobytes())
+
+    data_header = json.dumps({"htype": "bsr_d-1.1", "channels": channels}).encode()
+    main_header = json.dumps({"htype": "bsr_m-1.1",
+                              "pulse_id": pulse_id,
+                              "global_timestamp": {"sec": 0, "ns": 0},
+                              "hash": hashlib.md5(data_header).hexdigest()}).encode()
+
+    for part_index, part in enumerate([main_header, data_header]):
+        with open(os.path.join(folder, DUMP_FILE_FORMAT % (message_index, part_index)), "wb") as part_file:
+            part_file.write(part)
+
+    # Timestamp of the values: seconds and nanoseconds.
+    timestamp = numpy.zeros(2, dtype=">i8").tobytes()
+
+    for channel_index, part in enumerate(parts):
+        for part_index, content in ((PART_FIRST_VALUE + 2 * channel_index, part),
+                                    (PART_FIRST_VALUE + 2 * channel_index + 1, timestamp)):
+            with open(os.path.join(folder, DUMP_FILE_FORMAT % (message_index, part_index)), "wb") as part_file:
+                part_file.write(content)
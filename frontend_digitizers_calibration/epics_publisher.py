@@ -0,0 +1,264 @@
+import logging
+from fnmatch import fnmatchcase
+from threading import Thread, Condition
+from time import monotonic
+
+import numpy
+
+from frontend_digitizers_calibration import config
+
+_logger = logging.getLogger(__name__)
+
+
+class FakePV(object):
+    """
+    PV stand-in that records the values put to it.
+    """
+
+    def __init__(self, pvname, connection_callback=None):
+        self.pvname = pvname
+        self.connected = True
+        self.values = []
+
+    def put(self, value, wait=False):
+        self.values.append(value)
+
+
+class FakePVBackend(object):
+    """
+    PV backend without a live IOC - creates FakePVs and keeps them by name.
+    """
+
+    def __init__(self):
+        self.pvs = {}
+        self.n_flushes = 0
+
+    def create_pv(self, pvname, connection_callback=None):
+        self.pvs[pvname] = FakePV(pvname, connection_callback=connection_callback)
+        return self.pvs[pvname]
+
+    def flush(self):
+        self.n_flushes += 1
+
+
+class PyepicsBackend(object):
+    """
+    PV backend using pyepics. The puts are not waited for and sent to the IOCs once per batch.
+    """
+
+    def __init__(self):
+        import epics
+        self.epics = epics
+
+    def create_pv(self, pvname, connection_callback=None):
+        return self.epics.PV(pvname, connection_callback=connection_callback)
+
+    def flush(self):
+        self.epics.ca.flush_io()
+
+
+def load_epics_publisher_config(ioc_host_config):
+    """
+    Read the EpicsPublisher parameters from the optional epics section of the configuration.
+    :return: Dictionary with the EpicsPublisher keyword arguments.
+    """
+    epics_config = ioc_host_config.get(config.CONFIG_SECTION_EPICS, {})
+
+    return {"whitelist": epics_config.get(config.CONFIG_EPICS_WHITELIST),
+            "max_rate": epics_config.get(config.CONFIG_EPICS_MAX_RATE),
+            "pv_max_rates": epics_config.get(config.CONFIG_EPICS_PV_MAX_RATES),
+            "skip_unchanged": epics_config.get(config.CONFIG_EPICS_SKIP_UNCHANGED, True)}
+
+
+class EpicsPublisher(object):
+    """
+    Publish values to EPICS from a background thread.
+    Only the latest value of each PV is kept until it is put, values replaced before being put are coalesced.
+    """
+
+    def __init__(self, backend=None, whitelist=None, max_rate=None, pv_max_rates=None, skip_unchanged=True,
+                 copy_arrays=False, clock=monotonic):
+        """
+        :param backend: PV backend, PyepicsBackend if None.
+        :param whitelist: List of PV name patterns (fnmatch) to publish, None to publish all.
+        :param max_rate: Maximum update rate in Hz for all PVs, None for no limit.
+        :param pv_max_rates: Dictionary with PV name pattern: maximum update rate in Hz, overrides max_rate.
+        :param skip_unchanged: Do not put values equal to the last value put to the PV.
+        :param copy_arrays: Copy the arrays when they are published - needed if they are preallocated output buffers,
+                            which can be overwritten by a later pulse before the rate limited or slow put.
+        :param clock: Monotonic clock in seconds.
+        """
+        self.backend = backend if backend is not None else PyepicsBackend()
+        self.whitelist = whitelist
+        self.max_rate = max_rate
+        self.pv_max_rates = pv_max_rates or {}
+        self.skip_unchanged = skip_unchanged
+        self.copy_arrays = copy_arrays
+        self.clock = clock
+
+        self.pvs = {}
+        # Decision per PV name, so the patterns are matched only once.
+        self.published_names = {}
+        self.min_intervals = {}
+        self.last_put_times = {}
+        self.last_values = {}
+
+        self.pending = {}
+        self.condition = Condition()
+
+        self.n_published = 0
+        self.n_coalesced = 0
+        self.n_unchanged = 0
+        self.n_dropped = 0
+
+        self.publisher_thread = None
+
+    def is_published(self, name):
+        if name not in self.published_names:
+            self.published_names[name] = self.whitelist is None or \
+                                         any(fnmatchcase(name, pattern) for pattern in self.whitelist)
+
+        return self.published_names[name]
+
+    def get_min_interval(self, name):
+        if name not in self.min_intervals:
+            max_rate = self.max_rate
+
+            for pattern, pv_max_rate in self.pv_max_rates.items():
+                if fnmatchcase(name, pattern):
+                    max_rate = pv_max_rate
+                    break
+
+            self.min_intervals[name] = 1.0 / max_rate if max_rate else 0
+
+        return self.min_intervals[name]
+
+    def publish(self, data_to_send):
+        """
+        Queue the values for publishing, without blocking.
+        :param data_to_send: Dictionary with PV_name: Value to set the channels to.
+        """
+        with self.condition:
+            for name, value in data_to_send.items():
+                if not self.is_published(name):
+                    continue
+
+                if name in self.pending:
+                    self.n_coalesced += 1
+
+                if self.copy_arrays and isinstance(value, numpy.ndarray):
+                    value = numpy.array(value)
+
+                self.pending[name] = value
+
+            self.condition.notify()
+
+    def take_ready(self, now):
+        """
+        Take the pending values that are not rate limited anymore.
+        :return: (ready values, seconds until the next rate limited value is ready or None)
+        """
+        ready = {}
+        next_ready = None
+
+        for name in list(self.pending):
+            ready_time = self.last_put_times.get(name, -float("inf")) + self.get_min_interval(name)
+
+            if ready_time <= now:
+                ready[name] = self.pending.pop(name)
+            elif next_ready is None or ready_time - now < next_ready:
+                next_ready = ready_time - now
+
+        return ready, next_ready
+
+    def put(self, ready, now):
+        """
+        Put the values to the PVs and flush them as one batch.
+        """
+        for name, value in ready.items():
+            if self.skip_unchanged and name in self.last_values and numpy.array_equal(self.last_values[name], value):
+                self.n_unchanged += 1
+                continue
+
+            if name not in self.pvs:
+                self.pvs[name] = self.backend.create_pv(name, connection_callback=pv_connection_callback)
+
+            pv = self.pvs[name]
+
+            # Do not wait for the connection - the value is dropped and the next one is put once connected.
+            if not pv.connected:
+                self.n_dropped += 1
+                continue
+
+            try:
+                _logger.debug("Setting epics channel '%s' to value '%s'.", name, value)
+                pv.put(value, wait=False)
+            except Exception as e:
+                _logger.warning("Cannot set epics channel '%s': %s", name, e)
+                self.n_dropped += 1
+                continue
+
+            self.last_put_times[name] = now
+            # Keep a copy of arrays - they can be preallocated output buffers that are overwritten later.
+            self.last_values[name] = numpy.array(value) if isinstance(value, numpy.ndarray) else value
+            self.n_published += 1
+
+        self.backend.flush()
+
+    def publish_pending(self, timeout=None):
+        """
+        Wait for pending values and put the ones that are ready.
+        :param timeout: Maximum time to wait for pending values, None to wait until there are some.
+        :return: Seconds until the next rate limited value is ready or None.
+        """
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+
+            now = self.clock()
+            ready, next_ready = self.take_ready(now)
+
+        if ready:
+            self.put(ready, now)
+
+        return next_ready
+
+    def start(self):
+        def run_publisher():
+            timeout = None
+
+            while True:
+                try:
+                    timeout = self.publish_pending(timeout)
+                except Exception:
+                    _logger.exception("EPICS publisher failed.")
+
+                if timeout is not None:
+                    # Wait for the rate limited values, new values are coalesced meanwhile.
+                    with self.condition:
+                        self.condition.wait(timeout)
+
+        self.publisher_thread = Thread(target=run_publisher, name="epics_publisher")
+        self.publisher_thread.daemon = True
+        self.publisher_thread.start()
+
+        return self
+
+    def get_statistics(self):
+        return {"published": self.n_published,
+                "coalesced": self.n_coalesced,
+                "unchanged": self.n_unchanged,
+                "dropped": self.n_dropped,
+                "pending": len(self.pending)}
+
+
+def pv_connection_callback(pvname, conn, **kws):
+    """
+    Notify about pv connection status
+    :param pvname: PV_name
+    :param conn: bool, connection status
+    """
+    if conn:
+        _logger.info("PV '%s' is now connected", pvname)
+    else:
+        _logger.info("PV '%s' is disconnected", pvname)
@@ -0,0 +1,213 @@
+"""
+Fused calibration kernel: the whole calibration of a waveform in one pass, compiled with Numba if it is installed.
+
+Bit compatible with the NumPy processing in calibrate_channels: the element operations are done in float32 in the
+same order, and the sums follow the pairwise summation of NumPy. Without Numba the kernel still runs as plain
+Python - far too slow for the stream, but it keeps the kernel testable against the NumPy processing.
+
+Numba is imported and the kernel compiled on the first use, not on the import - see warm_up_fused_calibration.
+"""
+from importlib.util import find_spec
+from threading import Lock
+
+import numpy
+
+from frontend_digitizers_calibration.smooth_minmax import get_window_index
+
+NUMBA_AVAILABLE = find_spec("numba") is not None
+
+# Block size below which NumPy sums without splitting the array in halves.
+PAIRWISE_BLOCK_SIZE = 128
+
+ADC_OFFSET = numpy.float32(2048)
+ADC_RANGE = numpy.float32(4096)
+
+# Columns of the rois argument of calibrate_rows: [start, end) of the background and signal region.
+ROI_BACKGROUND_START = 0
+ROI_BACKGROUND_END = 1
+ROI_SIGNAL_START = 2
+ROI_SIGNAL_END = 3
+
+
+# Kernel used by calibrate_fused, set by get_kernel.
+_kernel = None
+_kernel_lock = Lock()
+
+
+def pairwise_sum(values, start, n):
+    """
+    Sum of values[start:start + n] in float32, in the order of the NumPy pairwise summation.
+    """
+    if n < 8:
+        result = numpy.float32(0)
+        for index in range(start, start + n):
+            result += values[index]
+        return result
+
+    elif n <= PAIRWISE_BLOCK_SIZE:
+        r0 = values[start]
+        r1 = values[start + 1]
+        r2 = values[start + 2]
+        r3 = values[start + 3]
+        r4 = values[start + 4]
+        r5 = values[start + 5]
+        r6 = values[start + 6]
+        r7 = values[start + 7]
+
+        end = start + n - n % 8
+        for index in range(start + 8, end, 8):
+            r0 += values[index]
+            r1 += values[index + 1]
+            r2 += values[index + 2]
+            r3 += values[index + 3]
+            r4 += values[index + 4]
+            r5 += values[index + 5]
+            r6 += values[index + 6]
+            r7 += values[index + 7]
+
+        result = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        for index in range(end, start + n):
+            result += values[index]
+        return result
+
+    half = n // 2
+    half -= half % 8
+    return _pairwise_sum(values, start, half) + _pairwise_sum(values, start + half, n - half)
+
+
+# Sum called by the kernel and by the recursion of pairwise_sum: pairwise_sum, compiled by get_kernel with Numba.
+_pairwise_sum = pairwise_sum
+
+
+def calibrate_rows(data, trigger_cells, channels, gains, offset1, offset2, gain1, gain2, rois, window_starts,
+                   window_size, sums, minimums, maximums):
+    """
+    Calibrate the raw waveforms in place: ADC scaling, offset and gain calibration rotated by the trigger cell, gain
+    mapping and baseline subtraction. Then integrate the signal region and find the min and max of the windowed
+    medians, as find_minmax.
+    :param data: float32 array (n_rows x WD_N_CELLS) with the raw ADC values.
+    :param offset1, gain1, gain2: Calibration tables doubled along the cell axis, see VoltageCalibration.double_tables.
+    :param rois: Array (n_rows x 4) with the background and signal regions, see ROI_BACKGROUND_START.
+    :param window_starts: First sample of each minmax window.
+    :param sums, minimums, maximums: float32 arrays (n_rows) to write the results to.
+    """
+    n_rows, n_cells = data.shape
+    median_index = window_size // 2 + 1
+    window = numpy.empty(window_size, dtype=numpy.float32)
+
+    for row in range(n_rows):
+        channel = channels[row]
+        trigger_cell = trigger_cells[row]
+        gain = gains[row]
+        values = data[row]
+
+        for cell in range(n_cells):
+            value = (values[cell] - ADC_OFFSET) / ADC_RANGE
+            value -= offset1[channel, trigger_cell + cell]
+            value -= offset2[channel, cell]
+
+            if value > 0:
+                value /= gain1[channel, trigger_cell + cell]
+            else:
+                value /= gain2[channel, trigger_cell + cell]
+
+            values[cell] = value * gain
+
+        background = values[rois[row, ROI_BACKGROUND_START]:rois[row, ROI_BACKGROUND_END]]
+        n_background = len(background)
+
+        # numpy.average: float32 sum, divided in float64.
+        if n_background > 0:
+            base_line = numpy.float32(numpy.float64(_pairwise_sum(background, 0, n_background)) / n_background)
+        else:
+            base_line = numpy.float32(numpy.nan)
+
+        for cell in range(n_cells):
+            values[cell] -= base_line
+
+        signal = values[rois[row, ROI_SIGNAL_START]:rois[row, ROI_SIGNAL_END]]
+        sums[row] = _pairwise_sum(signal, 0, len(signal))
+
+        for index in range(len(window_starts)):
+            window_start = window_starts[index]
+            for sample in range(window_size):
+                window[sample] = values[window_start + sample]
+
+            window.sort()
+            median = window[median_index]
+
+            # A NaN median makes the min and max NaN, as in numpy.min and numpy.max.
+            if index == 0 or median < minimums[row] or median != median:
+                minimums[row] = median
+            if index == 0 or median > maximums[row] or median != median:
+                maximums[row] = median
+
+
+def get_kernel():
+    """
+    Compile the kernel with Numba on the first call, or from the Numba cache of a previous process.
+    :return: calibrate_rows, compiled if Numba is installed.
+    """
+    global _kernel, _pairwise_sum
+
+    with _kernel_lock:
+        if _kernel is None:
+            if NUMBA_AVAILABLE:
+                import numba
+                jit = numba.njit(cache=True, error_model="numpy")
+
+                # Numba resolves the functions called by the kernel from the module globals when it compiles it.
+                _pairwise_sum = jit(pairwise_sum)
+                _kernel = jit(calibrate_rows)
+            else:
+                _kernel = calibrate_rows
+
+        return _kernel
+
+
+def warm_up_fused_calibration(vcal):
+    """
+    Compile the kernel for the tables of the calibration by calibrating a waveform of zeros, so the first message
+    does not wait for the compilation. Numba compiles for the types of the tables, including whether they are
+    read-only - see VoltageCalibration.zeros. Does nothing without Numba.
+    :param vcal: VoltageCalibration with the tables.
+    """
+    if not NUMBA_AVAILABLE:
+        return
+
+    data = numpy.zeros((1, vcal.wf_offset2.shape[-1]), dtype=numpy.float32)
+    rois = numpy.zeros((1, 4), dtype=numpy.intp)
+    # Read only, as the channel numbers of the DevicePlan - Numba compiles them as a different type.
+    channels = numpy.zeros(1, dtype=numpy.int32)
+    channels.flags.writeable = False
+
+    with numpy.errstate(all="ignore"):
+        calibrate_fused(data, numpy.zeros(1, dtype=numpy.int32), channels, numpy.ones(1, dtype=numpy.float32), rois,
+                        vcal)
+
+
+def calibrate_fused(data, trigger_cells, channels, gains, rois, vcal, window_size=21):
+    """
+    Calibrate the raw waveforms in place with the fused kernel.
+    :param data: float32 array (n_rows x WD_N_CELLS) with the raw ADC values.
+    :param trigger_cells: Trigger cell of each row.
+    :param channels: Channel number of each row.
+    :param gains: Gain factor of each row.
+    :param rois: Array (n_rows x 4) with the background and signal regions, see ROI_BACKGROUND_START.
+    :param vcal: VoltageCalibration with the doubled tables.
+    :param window_size: Number of samples in each minmax window.
+    :return: (sums, minimums, maximums) of the rows.
+    """
+    n_rows = len(data)
+    sums = numpy.empty(n_rows, dtype=numpy.float32)
+    minimums = numpy.empty(n_rows, dtype=numpy.float32)
+    maximums = numpy.empty(n_rows, dtype=numpy.float32)
+
+    window_starts = get_window_index(data.shape[-1], window_size)[:, 0]
+
+    get_kernel()(data, numpy.asarray(trigger_cells), numpy.asarray(channels), numpy.asarray(gains),
+                 numpy.asarray(vcal.doubled_wf_offset1), numpy.asarray(vcal.wf_offset2),
+                 numpy.asarray(vcal.doubled_wf_gain1), numpy.asarray(vcal.doubled_wf_gain2), rois, window_starts,
+                 window_size, sums, minimums, maximums)
+
+    return sums, minimums, maximums
@@ -0,0 +1,368 @@
+import logging
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Event
+from time import monotonic
+
+_logger = logging.getLogger(__name__)
+
+# Stages of the stream timed by StreamMetrics.
+STAGE_RECEIVE = "receive"
+STAGE_PROCESS = "process"
+STAGE_EPICS = "epics"
+STAGE_SEND = "send"
+STAGE_CALIBRATION_LOAD = "calibration_load"
+
+# Message counters of StreamMetrics.
+MESSAGES_RECEIVED = "received"
+MESSAGES_SENT = "sent"
+MESSAGES_DROPPED = "dropped"
+MESSAGES_UNCALIBRATED = "uncalibrated"
+MESSAGES_SKIPPED = "skipped"
+
+# Upper bounds of the histogram buckets in seconds - from the calibration of a waveform to the load of a calibration.
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+METRICS_PREFIX = "digitizer_calibration_"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets, as Prometheus histograms. Observing a value does not allocate.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Sorted upper bounds of the buckets, the last bucket (+Inf) is added.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else float("nan")
+
+    def quantile(self, q):
+        """
+        :param q: Quantile, between 0 and 1.
+        :return: Upper bound of the bucket with the quantile, inf if above the last bucket, nan if empty.
+        """
+        if not self.count:
+            return float("nan")
+
+        rank = q * self.count
+        cumulative_count = 0
+
+        for index, count in enumerate(self.counts):
+            cumulative_count += count
+
+            if cumulative_count >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+
+        return float("inf")
+
+
+class StageTimer(object):
+    """
+    Context manager adding the duration of the block to a histogram. Reused for each block, so timing a stage does
+    not allocate - the same timer must not be used by two threads at once.
+    """
+    __slots__ = ["histogram", "clock", "start_time"]
+
+    def __init__(self, histogram, clock=monotonic):
+        self.histogram = histogram
+        self.clock = clock
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = self.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(self.clock() - self.start_time)
+
+
+class PulseIdMonitor(object):
+    """
+    Detect gaps in the pulse_ids of the received messages and changes of the sampling frequency, so slowdowns can be
+    correlated with them. Has to be updated in receive order.
+
+    The expected pulse_id step is the smallest step seen - a beam rate below the pulse_id rate is not a gap.
+    """
+
+    def __init__(self):
+        self.last_pulse_id = None
+        self.pulse_id_step = None
+
+        self.n_gaps = 0
+        self.n_missing = 0
+        self.n_reordered = 0
+        self.last_gap_pulse_id = None
+
+        self.sampling_frequency = None
+        self.n_frequency_changes = 0
+        self.last_frequency_change_pulse_id = None
+
+    def update(self, pulse_id, sampling_frequency=None):
+        last_pulse_id, self.last_pulse_id = self.last_pulse_id, pulse_id
+
+        if last_pulse_id is not None:
+            step = pulse_id - last_pulse_id
+
+            if step <= 0:
+                self.n_reordered += 1
+                _logger.warning("Pulse_id '%s' received after pulse_id '%s'.", pulse_id, last_pulse_id)
+
+            elif self.pulse_id_step is None or step < self.pulse_id_step:
+                self.pulse_id_step = step
+
+            elif step > self.pulse_id_step:
+                n_missing = step // self.pulse_id_step - 1
+
+                self.n_gaps += 1
+                self.n_missing += n_missing
+                self.last_gap_pulse_id = pulse_id
+                _logger.warning("Pulse_id gap of %d pulses before pulse_id '%s'.", n_missing, pulse_id)
+
+        if sampling_frequency is not None and sampling_frequency != self.sampling_frequency:
+            if self.sampling_frequency is not None:
+                self.n_frequency_changes += 1
+                self.last_frequency_change_pulse_id = pulse_id
+                _logger.info("Sampling frequency changed from '%s' to '%s' at pulse_id '%s'.",
+                             self.sampling_frequency, sampling_frequency, pulse_id)
+
+            self.sampling_frequency = sampling_frequency
+
+
+class StreamMetrics(object):
+    """
+    Stage timers, message counters, queue depths and pulse_id gaps of the stream.
+    Each stage timer and counter is updated by a single thread, the readers may see a snapshot that is off by the
+    updates in progress.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, clock=monotonic):
+        self.buckets = buckets
+        self.clock = clock
+
+        self.histograms = OrderedDict()
+        self.timers = {}
+        self.counters = OrderedDict((name, 0) for name in (MESSAGES_RECEIVED, MESSAGES_SENT, MESSAGES_DROPPED,
+                                                          MESSAGES_UNCALIBRATED, MESSAGES_SKIPPED))
+        # queue name: queue with qsize() and optionally n_dropped
+        self.queues = OrderedDict()
+        self.pulse_ids = PulseIdMonitor()
+
+        self.start_time = clock()
+
+    def get_histogram(self, stage):
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram(self.buckets)
+
+        return self.histograms[stage]
+
+    def timer(self, stage):
+        """
+        :return: StageTimer of the stage, to use as: with metrics.timer(STAGE_PROCESS): ...
+        """
+        if stage not in self.timers:
+            self.timers[stage] = StageTimer(self.get_histogram(stage), self.clock)
+
+        return self.timers[stage]
+
+    def observe(self, stage, duration):
+        self.get_histogram(stage).observe(duration)
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_queue(self, name, queue):
+        """
+        Report the depth of a queue, and its drops if it has a n_dropped attribute.
+        """
+        self.queues[name] = queue
+
+    def get_statistics(self):
+        """
+        :return: Dictionary with a snapshot of the metrics.
+        """
+        pulse_ids = self.pulse_ids
+
+        return {"uptime": self.clock() - self.start_time,
+                "stages": {stage: {"count": histogram.count,
+                                   "mean": histogram.mean,
+                                   "p50": histogram.quantile(0.5),
+                                   "p99": histogram.quantile(0.99)}
+                           for stage, histogram in list(self.histograms.items())},
+                "messages": dict(self.counters),
+                "queues": {name: {"depth": queue.qsize(), "dropped": getattr(queue, "n_dropped", 0)}
+                           for name, queue in list(self.queues.items())},
+                "pulse_ids": {"last_pulse_id": pulse_ids.last_pulse_id,
+                              "gaps": pulse_ids.n_gaps,
+                              "missing": pulse_ids.n_missing,
+                              "reordered": pulse_ids.n_reordered,
+                              "last_gap_pulse_id": pulse_ids.last_gap_pulse_id,
+                              "sampling_frequency": pulse_ids.sampling_frequency,
+                              "frequency_changes": pulse_ids.n_frequency_changes,
+                              "last_frequency_change_pulse_id": pulse_ids.last_frequency_change_pulse_id}}
+
+    def format_prometheus(self):
+        """
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def add_family(name, metric_type, help_text):
+            lines.append("# HELP %s%s %s" % (METRICS_PREFIX, name, help_text))
+            lines.append("# TYPE %s%s %s" % (METRICS_PREFIX, name, metric_type))
+
+        def add_sample(name, value, labels=""):
+            lines.append("%s%s%s %s" % (METRICS_PREFIX, name, labels, format_value(value)))
+
+        add_family("stage_seconds", "histogram", "Time spent in each stage of the stream.")
+        for stage, histogram in list(self.histograms.items()):
+            cumulative_count = 0
+            for upper_bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative_count += count
+                add_sample("stage_seconds_bucket", cumulative_count,
+                           '{stage="%s",le="%s"}' % (stage, format_value(upper_bound)))
+
+            add_sample("stage_seconds_sum", histogram.sum, '{stage="%s"}' % stage)
+            add_sample("stage_seconds_count", histogram.count, '{stage="%s"}' % stage)
+
+        add_family("messages_total", "counter", "Messages by what happened to them.")
+        for name, value in list(self.counters.items()):
+            add_sample("messages_total", value, '{status="%s"}' % name)
+
+        if self.queues:
+            add_family("queue_depth", "gauge", "Items waiting in each queue.")
+            for name, queue in list(self.queues.items()):
+                add_sample("queue_depth", queue.qsize(), '{queue="%s"}' % name)
+
+            add_family("queue_dropped_total", "counter", "Items dropped by each queue.")
+            for name, queue in list(self.queues.items()):
+                add_sample("queue_dropped_total", getattr(queue, "n_dropped", 0), '{queue="%s"}' % name)
+
+        pulse_ids = self.pulse_ids
+
+        add_family("pulse_id_gaps_total", "counter", "Gaps in the received pulse_ids.")
+        add_sample("pulse_id_gaps_total", pulse_ids.n_gaps)
+        add_family("missing_pulses_total", "counter", "Pulses missing in the gaps of the received pulse_ids.")
+        add_sample("missing_pulses_total", pulse_ids.n_missing)
+        add_family("pulse_id_reordered_total", "counter", "Pulse_ids received after a later pulse_id.")
+        add_sample("pulse_id_reordered_total", pulse_ids.n_reordered)
+        add_family("frequency_changes_total", "counter", "Changes of the sampling frequency.")
+        add_sample("frequency_changes_total", pulse_ids.n_frequency_changes)
+
+        for name, value, help_text in (("last_pulse_id", pulse_ids.last_pulse_id, "Last received pulse_id."),
+                                       ("last_gap_pulse_id", pulse_ids.last_gap_pulse_id,
+                                        "Pulse_id after the last gap."),
+                                       ("last_frequency_change_pulse_id", pulse_ids.last_frequency_change_pulse_id,
+                                        "Pulse_id of the last sampling frequency change.")):
+            if value is not None:
+                add_family(name, "gauge", help_text)
+                add_sample(name, value)
+
+        return "\n".join(lines) + "\n"
+
+    def format_summary(self):
+        """
+        :return: One line summary of the metrics, for the log.
+        """
+        statistics = self.get_statistics()
+
+        stages = ", ".join("%s %d x %.3f ms (p99 <= %.3f ms)" % (stage, values["count"], values["mean"] * 1000,
+                                                                 values["p99"] * 1000)
+                           for stage, values in statistics["stages"].items())
+        messages = ", ".join("%s %d" % item for item in statistics["messages"].items())
+        queues = ", ".join("%s %d (dropped %d)" % (name, values["depth"], values["dropped"])
+                           for name, values in statistics["queues"].items())
+
+        pulse_ids = statistics["pulse_ids"]
+        pulse_ids = "last %s, gaps %d (%d missing, last at %s), reordered %d, frequency %s (%d changes, last at %s)" % (
+            pulse_ids["last_pulse_id"], pulse_ids["gaps"], pulse_ids["missing"], pulse_ids["last_gap_pulse_id"],
+            pulse_ids["reordered"], pulse_ids["sampling_frequency"], pulse_ids["frequency_changes"],
+            pulse_ids["last_frequency_change_pulse_id"])
+
+        return "Messages: %s. Stages: %s. Queues: %s. Pulse_ids: %s." % (messages, stages, queues or "none",
+                                                                         pulse_ids)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(value)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(metrics, port, host="0.0.0.0"):
+    """
+    Serve the metrics in the Prometheus text format on http://host:port/metrics, from a daemon thread.
+    :param metrics: StreamMetrics to serve.
+    :param port: Port to listen on, 0 for any free port.
+    :return: The HTTP server - server.server_address has the port.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            content = metrics.format_prometheus().encode()
+
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            _logger.debug("Metrics request: " + format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+
+    server_thread = Thread(target=server.serve_forever, name="metrics_server")
+    server_thread.daemon = True
+    server_thread.start()
+
+    _logger.info("Serving metrics on port %d.", server.server_address[1])
+
+    return server
+
+
+def start_metrics_logging(metrics, interval):
+    """
+    Log a summary of the metrics every interval seconds, from a daemon thread.
+    :return: Event to set to stop the logging.
+    """
+    stop_event = Event()
+
+    def log_metrics():
+        while not stop_event.wait(interval):
+            # A failing summary must not stop the logging for the rest of the stream.
+            try:
+                _logger.info(metrics.format_summary())
+            except Exception:
+                _logger.exception("Failed to log the stream metrics.")
+
+    logging_thread = Thread(target=log_metrics, name="metrics_logging")
+    logging_thread.daemon = True
+    logging_thread.start()
+
+    return stop_event
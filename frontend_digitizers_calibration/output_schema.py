@@ -0,0 +1,114 @@
+from fnmatch import fnmatchcase
+
+from frontend_digitizers_calibration import config
+
+ALL_KEYS = ["*"]
+
+
+class OutputSelection(object):
+    """
+    Selection of the computed and pass-through values for one output, by fnmatch patterns.
+    The patterns are matched once into a key list, which is compiled again only if the set of available keys changes.
+    """
+
+    def __init__(self, computed=None, pass_through=None):
+        """
+        :param computed: Patterns of the computed values to select, None for all.
+        :param pass_through: Patterns of the values from the input message to select, None for all.
+        """
+        self.computed = computed if computed is not None else ALL_KEYS
+        self.pass_through = pass_through if pass_through is not None else ALL_KEYS
+
+        # Key sets the key lists were compiled for. Comparing a dict keys view to a frozenset does not copy the keys.
+        self.available_keys = None
+        self.available_message_keys = None
+        self.keys = None
+        self.message_keys = None
+        self.pass_through_keys = None
+
+    @staticmethod
+    def matches(name, patterns):
+        return any(fnmatchcase(name, pattern) for pattern in patterns)
+
+    def get_pass_through_keys(self, message_data):
+        """
+        :param message_data: Values of the input message.
+        :return: Names of the selected input message values.
+        """
+        if self.message_keys is None or message_data.keys() != self.message_keys:
+            self.pass_through_keys = [name for name in message_data if self.matches(name, self.pass_through)]
+            self.message_keys = frozenset(message_data)
+
+        return self.pass_through_keys
+
+    def get_keys(self, data_to_send, message_data):
+        """
+        :param data_to_send: Computed and pass-through values.
+        :param message_data: Values of the input message - to tell the pass-through values from the computed ones.
+        :return: Names of the selected values.
+        """
+        # Whether a value is computed or passed through depends on the names of the input message as well.
+        if self.available_keys is None or data_to_send.keys() != self.available_keys or \
+                message_data.keys() != self.available_message_keys:
+            self.keys = [name for name in data_to_send
+                         if self.matches(name, self.pass_through if name in message_data else self.computed)]
+            self.available_keys = frozenset(data_to_send)
+            self.available_message_keys = frozenset(message_data)
+
+        return self.keys
+
+
+class OutputSchema(object):
+    """
+    Which computed and pass-through values go to the output stream and which to EPICS.
+    """
+
+    def __init__(self, stream, epics):
+        """
+        :param stream: OutputSelection of the output stream.
+        :param epics: OutputSelection of EPICS.
+        """
+        self.stream = stream
+        self.epics = epics
+
+    def append_message_data(self, message, destination):
+        """
+        Append the values from the input message selected for any of the outputs.
+        """
+        message_data = message.data.data
+
+        for selection in (self.stream, self.epics):
+            for name in selection.get_pass_through_keys(message_data):
+                destination[name] = message_data[name].value
+
+    def split(self, message, data_to_send):
+        """
+        Split the processed data into the data for the output stream and for EPICS.
+        :return: (stream_data, epics_data)
+        """
+        return self.select(self.stream, message, data_to_send), self.select(self.epics, message, data_to_send)
+
+    @staticmethod
+    def select(selection, message, data_to_send):
+        return {name: data_to_send[name] for name in selection.get_keys(data_to_send, message.data.data)}
+
+
+def load_output_schema(ioc_host_config):
+    """
+    Compile the optional output section of the configuration.
+    :return: OutputSchema, None if the configuration does not define it - all values go to all outputs.
+    """
+    output_config = ioc_host_config.get(config.CONFIG_SECTION_OUTPUT)
+
+    if output_config is None:
+        return None
+
+    selections = []
+
+    for output_name in (config.CONFIG_OUTPUT_STREAM, config.CONFIG_OUTPUT_EPICS):
+        output_definition = output_config.get(output_name, {})
+
+        selections.append(OutputSelection(computed=output_definition.get(config.CONFIG_OUTPUT_COMPUTED),
+                                          pass_through=output_definition.get(config.CONFIG_OUTPUT_PASS_THROUGH)))
+
+    return OutputSchema(*selections)
@@ -0,0 +1,158 @@
+import logging
+from queue import Queue, Full, Empty
+from threading import Thread
+
+from frontend_digitizers_calibration import config
+
+_logger = logging.getLogger(__name__)
+
+
+class PipelineStageError(Exception):
+    """
+    A pipeline stage stopped after failing to process too many items in a row.
+    """
+
+
+class StageQueue(object):
+    """
+    Bounded FIFO queue between two pipeline stages.
+    The backpressure policy defines what happens when the queue is full:
+     - block: wait until the next stage takes an item.
+     - drop_oldest: drop the oldest queued item to make room for the new one.
+     - drop_newest: drop the new item.
+    Items are never reordered, so the order of the items that pass the queue is preserved.
+    """
+
+    def __init__(self, maxsize, policy=config.BACKPRESSURE_BLOCK):
+        if policy not in config.BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy '%s', use one of %s." % (policy,
+                                                                                  config.BACKPRESSURE_POLICIES))
+
+        self.queue = Queue(maxsize)
+        self.policy = policy
+        self.n_dropped = 0
+        # Set when the stage taking the items stopped, the items put afterwards would never be processed.
+        self.closed = False
+
+    def put(self, item):
+        if self.closed:
+            raise PipelineStageError("The stage of the queue is stopped.")
+
+        if self.policy == config.BACKPRESSURE_BLOCK:
+            # Wake up regularly, so the producer does not wait forever for a stopped stage.
+            while True:
+                try:
+                    self.queue.put(item, timeout=config.PIPELINE_POLL_INTERVAL)
+                    return
+                except Full:
+                    if self.closed:
+                        raise PipelineStageError("The stage of the queue is stopped.")
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                pass
+
+            if self.policy == config.BACKPRESSURE_DROP_NEWEST:
+                self.n_dropped += 1
+                return
+
+            try:
+                self.queue.get_nowait()
+                self.n_dropped += 1
+            except Empty:
+                pass
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        self.closed = True
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class PipelineStage(object):
+    """
+    Thread calling a function for each item of its input queue.
+    A failing item is logged and skipped, but after max_consecutive_failures failures in a row the stage stops and
+    check raises PipelineStageError - a persistent failure stops the stream instead of logging every pulse.
+    """
+
+    def __init__(self, name, function, input_queue,
+                 max_consecutive_failures=config.PIPELINE_MAX_CONSECUTIVE_FAILURES):
+        self.name = name
+        self.function = function
+        self.input_queue = input_queue
+        self.max_consecutive_failures = max_consecutive_failures
+
+        self.n_consecutive_failures = 0
+        # Last exception of the stage, once it stopped because of the failures.
+        self.failure = None
+        self.stopping = False
+
+        self.thread = Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            try:
+                item = self.input_queue.get(timeout=config.PIPELINE_POLL_INTERVAL)
+            except Empty:
+                # Stop only once the queued items are processed.
+                if self.stopping:
+                    return
+                continue
+
+            try:
+                self.function(item)
+                self.n_consecutive_failures = 0
+
+            except Exception as e:
+                _logger.exception("Pipeline stage '%s' failed to process an item.", self.name)
+                self.n_consecutive_failures += 1
+
+                if self.n_consecutive_failures >= self.max_consecutive_failures:
+                    _logger.error("Pipeline stage '%s' failed %d times in a row, stopping it.", self.name,
+                                  self.n_consecutive_failures)
+                    self.failure = e
+                    self.input_queue.close()
+                    return
+
+    def check(self):
+        """
+        Raise PipelineStageError if the stage stopped because of the failures.
+        """
+        if self.failure is not None:
+            raise PipelineStageError("Pipeline stage '%s' failed %d times in a row." %
+                                     (self.name, self.n_consecutive_failures)) from self.failure
+
+    def stop(self, timeout=None):
+        """
+        Process the queued items and stop the stage.
+        :param timeout: Seconds to wait for the stage to stop, None to wait until it stops.
+        :return: True if the stage stopped.
+        """
+        self.stopping = True
+        self.thread.join(timeout)
+
+        return not self.thread.is_alive()
+
+
+def start_stage(name, function, input_queue, max_consecutive_failures=config.PIPELINE_MAX_CONSECUTIVE_FAILURES):
+    """
+    Start a pipeline stage thread that calls the function for each item of the input queue.
+    :param name: Name of the stage, used for the thread name and logging.
+    :param function: Function to call with each item.
+    :param input_queue: StageQueue to take the items from.
+    :param max_consecutive_failures: Number of items failing in a row after which the stage stops.
+    :return: The started PipelineStage.
+    """
+    return PipelineStage(name, function, input_queue, max_consecutive_failures).start()
@@ -0,0 +1,270 @@
+import logging
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import CalibrationManager
+from frontend_digitizers_calibration.devices.mapping import compile_device_plans, get_device_processor, \
+    device_type_batch_processing_function_mapping
+from frontend_digitizers_calibration.dump import DumpReader
+from frontend_digitizers_calibration.running_statistics import allocate_device_statistics
+from frontend_digitizers_calibration.workers import WorkerMessage
+
+_logger = logging.getLogger(__name__)
+
+OUTPUT_FORMAT_HDF5 = "hdf5"
+OUTPUT_FORMAT_NPY = "npy"
+OUTPUT_FORMATS = [OUTPUT_FORMAT_HDF5, OUTPUT_FORMAT_NPY]
+
+HDF5_EXTENSIONS = (".h5", ".hdf5")
+
+# Name of the output with the pulse_id of each row.
+OUTPUT_PULSE_ID = "pulse_id"
+
+
+def stack_messages(messages):
+    """
+    Stack the values of many messages into a single message, with the values as arrays over the messages.
+    Values missing in any of the messages are left out - iterate_batches groups the messages with the same values.
+    :param messages: List of (pulse_id, dictionary with name: value).
+    :return: WorkerMessage with the pulse_ids and the stacked values.
+    """
+    pulse_ids = numpy.array([pulse_id for pulse_id, _ in messages], dtype=numpy.uint64)
+
+    stacked_values = {}
+    for name in messages[0][1]:
+        values = [message_values.get(name) for _, message_values in messages]
+
+        if any(value is None for value in values):
+            continue
+
+        stacked_values[name] = numpy.stack(values)
+
+    return WorkerMessage(pulse_ids, stacked_values)
+
+
+class NpyOutput(object):
+    """
+    Write each output to a .npy file in the output folder, one row per pulse.
+    """
+
+    def __init__(self, folder, max_pulses):
+        """
+        :param folder: Folder to write the files to.
+        :param max_pulses: Maximum number of pulses that will be written.
+        """
+        self.folder = folder
+        self.max_pulses = max_pulses
+        self.arrays = {}
+
+        os.makedirs(folder, exist_ok=True)
+
+    def get_filename(self, name):
+        return os.path.join(self.folder, name.replace("/", "_") + ".npy")
+
+    def write(self, offset, data):
+        for name, values in data.items():
+            values = numpy.asarray(values)
+
+            if name not in self.arrays:
+                self.arrays[name] = open_memmap(self.get_filename(name), mode="w+", dtype=values.dtype,
+                                                shape=(self.max_pulses,) + values.shape[1:])
+
+            self.arrays[name][offset:offset + len(values)] = values
+
+    def close(self, n_pulses):
+        arrays, self.arrays = self.arrays, {}
+
+        for name, array in arrays.items():
+            array.flush()
+
+            if n_pulses < self.max_pulses:
+                # Pulses were skipped - write the file again with only the written rows.
+                filename = self.get_filename(name)
+                numpy.save(filename + ".tmp.npy", array[:n_pulses])
+                os.replace(filename + ".tmp.npy", filename)
+
+
+class Hdf5Output(object):
+    """
+    Write each output to a dataset of a HDF5 file, one row per pulse.
+    """
+
+    def __init__(self, filename):
+        import h5py
+
+        self.file = h5py.File(filename, "w")
+        self.datasets = {}
+
+    def write(self, offset, data):
+        for name, values in data.items():
+            values = numpy.asarray(values)
+
+            if name not in self.datasets:
+                self.datasets[name] = self.file.create_dataset(name, shape=(0,) + values.shape[1:],
+                                                               maxshape=(None,) + values.shape[1:],
+                                                               dtype=values.dtype, chunks=True)
+
+            dataset = self.datasets[name]
+            if len(dataset) < offset + len(values):
+                dataset.resize(offset + len(values), axis=0)
+
+            dataset[offset:offset + len(values)] = values
+
+    def close(self, n_pulses):
+        for dataset in self.datasets.values():
+            dataset.resize(n_pulses, axis=0)
+
+        self.file.close()
+
+
+def open_output(output, output_format, max_pulses):
+    """
+    :param output: Output file (HDF5) or folder (npy).
+    :param output_format: One of OUTPUT_FORMATS, None to use HDF5 for files with a HDF5 extension and npy otherwise.
+    :param max_pulses: Maximum number of pulses that will be written.
+    """
+    if output_format is None:
+        output_format = OUTPUT_FORMAT_HDF5 if output.endswith(HDF5_EXTENSIONS) else OUTPUT_FORMAT_NPY
+
+    if output_format == OUTPUT_FORMAT_HDF5:
+        return Hdf5Output(output)
+    elif output_format == OUTPUT_FORMAT_NPY:
+        return NpyOutput(output, max_pulses)
+
+    raise ValueError("Output format '%s' not supported, use one of %s." % (output_format, OUTPUT_FORMATS))
+
+
+def process_batch(messages, device_plans, device_statistics, calibration_manager, frequency_value_name):
+    """
+    Process the messages of a batch, all with the same sampling frequency.
+    :return: Dictionary with the outputs as arrays over the messages, None if there is no calibration.
+    """
+    batch = stack_messages(messages)
+    sampling_frequency = messages[0][1][frequency_value_name]
+
+    if not calibration_manager.load_calibration_data(sampling_frequency):
+        return None
+
+    data = {OUTPUT_PULSE_ID: batch.data.pulse_id}
+
+    for device_name, plan in device_plans.items():
+        statistics = device_statistics[device_name]
+
+        plan.processing_function(batch=batch,
+                                 device_name=device_name,
+                                 device_definition=plan.device_definition,
+                                 channels_definition=plan.channels_definition,
+                                 calibration_data=calibration_manager,
+                                 plan=plan,
+                                 statistics=statistics,
+                                 data_to_send=data)
+
+        statistics.update_batch(data)
+
+    return data
+
+
+def get_input_names(device_plans, frequency_value_name):
+    """
+    :return: Names of the values each message needs to be processed.
+    """
+    input_names = [frequency_value_name]
+
+    for plan in device_plans.values():
+        input_names.extend(get_device_processor(plan.device_type).get_input_names(plan))
+
+    return input_names
+
+
+def iterate_batches(messages, frequency_value_name, batch_size, input_names=(), incomplete=None):
+    """
+    Group consecutive messages into batches with the same sampling frequency and the same value names.
+    :param input_names: Names of the values each message needs, the messages without them are left out.
+    :param incomplete: List to append the pulse_ids of the messages left out to.
+    """
+    batch = []
+    batch_names = None
+
+    for pulse_id, values in messages:
+        missing_names = [name for name in input_names if values.get(name) is None]
+
+        if missing_names:
+            if incomplete is not None:
+                if not incomplete:
+                    _logger.warning("Pulse_id %s misses the values %s, the pulses with missing values are skipped.",
+                                    pulse_id, missing_names)
+                incomplete.append(pulse_id)
+            continue
+
+        if batch and (len(batch) == batch_size or
+                      values.get(frequency_value_name) != batch[0][1].get(frequency_value_name) or
+                      values.keys() != batch_names):
+            yield batch
+            batch = []
+
+        if not batch:
+            batch_names = frozenset(values)
+
+        batch.append((pulse_id, values))
+
+    if batch:
+        yield batch
+
+
+def recalibrate_dump(dump_folder, ioc_host_config, config_folder, output, output_format=None,
+                     batch_size=config.DEFAULT_RECALIBRATION_BATCH_SIZE,
+                     calibration_cache_folder=config.DEFAULT_CALIBRATION_CACHE_FOLDER):
+    """
+    Process the messages of a mflow dump with the device processing of the stream, in batches of many pulses.
+    :param dump_folder: Folder with the mflow dump.
+    :param ioc_host_config: Configuration of the ioc host.
+    :param config_folder: Folder with the calibration files.
+    :param output: Output file (HDF5) or folder (npy).
+    :param output_format: One of OUTPUT_FORMATS, None to choose by the output name.
+    :param batch_size: Maximum number of pulses to process at once.
+    :param calibration_cache_folder: Folder to store the tables derived from the calibration files in.
+    :return: (number of pulses written, number of pulses skipped for missing calibration or missing values)
+    """
+    devices = ioc_host_config[config.CONFIG_SECTION_DEVICES]
+    frequency_value_name = ioc_host_config[config.CONFIG_SECTION_FREQUENCY]
+
+    calibration_manager = CalibrationManager(ioc_host_config, config_folder, cache_folder=calibration_cache_folder)
+    device_plans = compile_device_plans(devices, device_type_batch_processing_function_mapping, {})
+    device_statistics = allocate_device_statistics(devices)
+    input_names = get_input_names(device_plans, frequency_value_name)
+
+    reader = DumpReader(dump_folder)
+    _logger.info("Recalibrating %d messages from '%s'.", len(reader), dump_folder)
+
+    writer = open_output(output, output_format, len(reader))
+    n_written = 0
+    n_skipped = 0
+    # Pulse_ids of the messages without all the values the devices need.
+    incomplete = []
+
+    try:
+        for messages in iterate_batches(reader, frequency_value_name, batch_size, input_names, incomplete):
+            data = process_batch(messages, device_plans, device_statistics, calibration_manager,
+                                 frequency_value_name)
+
+            if data is None:
+                _logger.warning("No calibration for frequency '%s', %d pulses skipped.",
+                                messages[0][1].get(frequency_value_name), len(messages))
+                n_skipped += len(messages)
+                continue
+
+            writer.write(n_written, data)
+            n_written += len(messages)
+
+            _logger.info("%d pulses recalibrated.", n_written)
+
+    finally:
+        writer.close(n_written)
+
+    if incomplete:
+        _logger.warning("%d pulses skipped for missing values.", len(incomplete))
+
+    return n_written, n_skipped + len(incomplete)
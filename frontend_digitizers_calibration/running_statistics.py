@@ -0,0 +1,198 @@
+import math
+
+import numpy
+
+from frontend_digitizers_calibration import config
+
+SUFFIX_STATISTICS_MEAN = "-MEAN"
+SUFFIX_STATISTICS_STD = "-STD"
+SUFFIX_STATISTICS_EWMA = "-EWMA"
+
+
+class RunningStatistics(object):
+    """
+    Mean and variance of the last window values, updated in O(1) per value.
+    The values are kept in a circular buffer, with a running sum and sum of squares. The sums are recomputed from
+    the buffer once per window, so the rounding errors of the updates do not accumulate.
+    Non finite values (NaN, inf) are not added.
+    """
+
+    def __init__(self, window, ewma_alpha=None):
+        """
+        :param window: Number of values to compute the statistics of.
+        :param ewma_alpha: Weight of the new value in the exponentially weighted moving average, None to not
+                           compute it.
+        """
+        if window < 1:
+            raise ValueError("Running statistics window must be at least 1, not %s." % window)
+
+        self.window = window
+        self.ewma_alpha = ewma_alpha
+
+        self.values = numpy.zeros(window, dtype=numpy.float64)
+        self.index = 0
+        self.count = 0
+
+        self.sum = 0.0
+        self.sum_of_squares = 0.0
+        self.n_updates = 0
+
+        self.ewma = None
+
+    def add(self, value):
+        """
+        Add a value, replacing the oldest one if the window is full.
+        """
+        value = float(value)
+
+        if not math.isfinite(value):
+            return
+
+        if self.count == self.window:
+            old_value = self.values[self.index]
+            self.sum -= old_value
+            self.sum_of_squares -= old_value * old_value
+        else:
+            self.count += 1
+
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.window
+
+        self.sum += value
+        self.sum_of_squares += value * value
+
+        self.n_updates += 1
+        if self.n_updates == self.window:
+            self.recompute()
+
+        if self.ewma_alpha is not None:
+            self.ewma = value if self.ewma is None else self.ewma_alpha * value + (1 - self.ewma_alpha) * self.ewma
+
+    def recompute(self):
+        """
+        Recompute the sums from the values in the window.
+        """
+        values = self.values[:self.count]
+
+        self.sum = float(values.sum())
+        self.sum_of_squares = float(numpy.dot(values, values))
+        self.n_updates = 0
+
+    @property
+    def mean(self):
+        if not self.count:
+            return float("nan")
+
+        return self.sum / self.count
+
+    @property
+    def variance(self):
+        """
+        Population variance of the values in the window.
+        """
+        if not self.count:
+            return float("nan")
+
+        mean = self.sum / self.count
+        # The difference of the sums can be slightly negative for (almost) constant values.
+        return max(self.sum_of_squares / self.count - mean * mean, 0.0)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class DeviceStatistics(object):
+    """
+    Running statistics of the outputs of a device. Has to be updated in pulse_id order.
+
+    The outputs are selected with the optional running_statistics section of the device definition:
+        "running_statistics": {"values": ["XPOS", "YPOS", "INTENSITY-CAL"], "window": 100, "ewma_alpha": 0.1}
+    For each value, the device_name + value + -MEAN, -STD and (with ewma_alpha) -EWMA outputs are added.
+    """
+
+    def __init__(self, device_name, device_definition):
+        statistics_config = device_definition.get(config.CONFIG_DEVICE_RUNNING_STATISTICS, {})
+
+        self.device_name = device_name
+        self.window = statistics_config.get(config.CONFIG_STATISTICS_WINDOW, config.DEFAULT_STATISTICS_WINDOW)
+        self.ewma_alpha = statistics_config.get(config.CONFIG_STATISTICS_EWMA_ALPHA)
+
+        # output name: (RunningStatistics, mean name, std name, ewma name)
+        self.outputs = {}
+        for suffix in statistics_config.get(config.CONFIG_STATISTICS_VALUES, []):
+            name = device_name + suffix
+            self.outputs[name] = (RunningStatistics(self.window, self.ewma_alpha),
+                                  name + SUFFIX_STATISTICS_MEAN,
+                                  name + SUFFIX_STATISTICS_STD,
+                                  name + SUFFIX_STATISTICS_EWMA)
+
+        # Statistics used by the processing functions, see get.
+        self.statistics = {}
+
+    def get(self, name, window=None):
+        """
+        Running statistics for a processing function, created on first use.
+        :param name: Name of the statistics.
+        :param window: Window of the statistics, the window of the device if None.
+        """
+        if name not in self.statistics:
+            self.statistics[name] = RunningStatistics(window or self.window, self.ewma_alpha)
+
+        return self.statistics[name]
+
+    def update(self, data_to_send):
+        """
+        Add the selected outputs of the device to their statistics and add the statistics to the data.
+        """
+        for name, (statistics, mean_name, std_name, ewma_name) in self.outputs.items():
+            if name not in data_to_send:
+                continue
+
+            statistics.add(data_to_send[name])
+
+            data_to_send[mean_name] = statistics.mean
+            data_to_send[std_name] = statistics.std
+
+            if statistics.ewma is not None:
+                data_to_send[ewma_name] = statistics.ewma
+
+        return data_to_send
+
+    def update_batch(self, data_to_send):
+        """
+        Same as update, for the outputs of many pulses - the values are arrays over the pulses.
+        """
+        for name, (statistics, mean_name, std_name, ewma_name) in self.outputs.items():
+            if name not in data_to_send:
+                continue
+
+            values = data_to_send[name]
+            means = numpy.empty(len(values), dtype=numpy.float64)
+            stds = numpy.empty(len(values), dtype=numpy.float64)
+            ewmas = numpy.empty(len(values), dtype=numpy.float64)
+
+            for index, value in enumerate(values):
+                statistics.add(value)
+
+                means[index] = statistics.mean
+                stds[index] = statistics.std
+                ewmas[index] = statistics.ewma if statistics.ewma is not None else float("nan")
+
+            data_to_send[mean_name] = means
+            data_to_send[std_name] = stds
+
+            if statistics.ewma_alpha is not None:
+                data_to_send[ewma_name] = ewmas
+
+        return data_to_send
+
+
+def allocate_device_statistics(devices):
+    """
+    Create the running statistics of all the devices from the configuration.
+    :param devices: Devices section of the configuration.
+    :return: Dictionary with device_name: DeviceStatistics.
+    """
+    return {device_name: DeviceStatistics(device_name, device_definition)
+            for device_name, device_definition in devices.items()}
@@ -2,7 +2,7 @@ import argparse
 import logging
 
 from frontend_digitizers_calibration import config
-from frontend_digitizers_calibration.stream import start_stream
+from frontend_digitizers_calibration.startup import StartupProfile
 
 _logger = logging.getLogger(__name__)
 
@@ -17,19 +17,106 @@ def main():
                         help="Port to run the output stream on.")
     parser.add_argument("--config_folder", type=str, default=config.DEFAULT_CONFIG_FOLDER,
                         help="Folder where the configuration files are.")
+    parser.add_argument("--calibration_cache_folder", type=str, default=config.DEFAULT_CALIBRATION_CACHE_FOLDER,
+                        help="Folder to store the tables derived from the calibration files in, shared by all "
+                             "processes using the same folder.")
     parser.add_argument("--log_level", default="INFO", choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
                         help="Log level to use.")
     parser.add_argument("--non_blocking", action='count',
                         help="Send bsread stream in non blocking mode")
+    parser.add_argument("--calibration_cache_size", type=int, default=config.DEFAULT_CALIBRATION_CACHE_SIZE,
+                        help="Number of sampling frequencies to keep the loaded calibration of.")
+    parser.add_argument("--preload_calibrations", action='store_true',
+                        help="Load the calibrations of all configured frequencies at startup.")
+    parser.add_argument("--background_calibration_loading", action='store_true',
+                        help="Load the calibration of a new frequency without blocking the stream.")
+    parser.add_argument("--uncalibrated_fallback", default=config.DEFAULT_UNCALIBRATED_FALLBACK,
+                        choices=config.UNCALIBRATED_FALLBACKS,
+                        help="Drop or forward raw messages received while the calibration is loaded.")
+    parser.add_argument("--pipelined", action='store_true',
+                        help="Run receive, compute, send and EPICS notification in separate threads.")
+    parser.add_argument("--pipeline_queue_size", type=int, default=config.DEFAULT_PIPELINE_QUEUE_SIZE,
+                        help="Size of the queues between the pipeline stages.")
+    parser.add_argument("--compute_backpressure", default=config.DEFAULT_COMPUTE_BACKPRESSURE,
+                        choices=config.BACKPRESSURE_POLICIES,
+                        help="What to do with received messages when the compute stage is behind.")
+    parser.add_argument("--send_backpressure", default=config.DEFAULT_SEND_BACKPRESSURE,
+                        choices=config.BACKPRESSURE_POLICIES,
+                        help="What to do with processed messages when the send stage is behind.")
+    parser.add_argument("--epics_backpressure", default=config.DEFAULT_EPICS_BACKPRESSURE,
+                        choices=config.BACKPRESSURE_POLICIES,
+                        help="What to do with processed messages when the EPICS stage is behind.")
+    parser.add_argument("--workers", type=int, default=config.DEFAULT_WORKERS,
+                        help="Number of processes to calibrate the messages in.")
+    parser.add_argument("--async_epics", action='store_true',
+                        help="Publish to EPICS from a background thread, with the whitelist, rate limits and change "
+                             "detection from the epics section of the configuration.")
+    parser.add_argument("--output_buffer_sets", type=int, default=config.DEFAULT_OUTPUT_BUFFER_SETS,
+                        help="Number of preallocated output arrays per device used in rotation, 0 to allocate "
+                             "them for each message.")
+    parser.add_argument("--time_axis_mode", default=config.DEFAULT_TIME_AXIS_MODE, choices=config.TIME_AXIS_MODES,
+                        help="Send the time axes in each message, only when they change, or only references to "
+                             "them.")
+    parser.add_argument("--metrics_port", type=int, default=config.DEFAULT_METRICS_PORT,
+                        help="Port to serve the stream metrics on in the Prometheus text format, 0 to not serve them.")
+    parser.add_argument("--metrics_log_interval", type=float, default=config.DEFAULT_METRICS_LOG_INTERVAL,
+                        help="Seconds between the metrics summaries in the log, 0 to not log them.")
+    parser.add_argument("--catch_up_max_lag", type=float, default=config.DEFAULT_CATCH_UP_MAX_LAG,
+                        help="Skip the processing of the messages older than this many seconds until the stream has "
+                             "caught up, 0 to not check the age of the messages.")
+    parser.add_argument("--catch_up_max_queue_depth", type=int, default=config.DEFAULT_CATCH_UP_MAX_QUEUE_DEPTH,
+                        help="Skip the processing of the messages while more than this many messages wait to be "
+                             "processed (pipelined and worker modes), 0 to not check it.")
+    parser.add_argument("--catch_up_mode", default=config.DEFAULT_CATCH_UP_MODE, choices=config.CATCH_UP_MODES,
+                        help="Forward only the input values of the skipped messages, or drop them. The skipped "
+                             "messages are never sent to EPICS.")
+    parser.add_argument("--group_devices", action='store_true',
+                        help="Calculate the intensity and position of all the pbps and pbpg devices at once.")
+    parser.add_argument("--startup_profile", "--startup-profile", action='store_true',
+                        help="Log the time spent in the imports and the initialization stages at startup.")
     arguments = parser.parse_args()
 
+    if arguments.workers > 1:
+        # The workers process the messages in order, without the pipeline stages and their queues.
+        pipeline_options = [name for name in ("pipelined", "pipeline_queue_size", "compute_backpressure",
+                                              "send_backpressure", "epics_backpressure")
+                            if getattr(arguments, name) != parser.get_default(name)]
+        if pipeline_options:
+            parser.error("--%s cannot be used with --workers." % ", --".join(pipeline_options))
+
     logging.basicConfig(level=arguments.log_level, format='[%(levelname)s] %(message)s')
 
+    startup_profile = StartupProfile(enabled=arguments.startup_profile)
+
+    # Imported after the arguments are parsed, so --help does not wait for numpy and the processing modules.
+    start_stream = startup_profile.import_module("frontend_digitizers_calibration.stream").start_stream
+
     start_stream(config_folder=arguments.config_folder,
                  config_file=arguments.config_file_name,
                  input_stream_port=arguments.input_stream_port,
                  output_stream_port=arguments.output_stream_port,
-                 non_blocking=arguments.non_blocking)
+                 non_blocking=arguments.non_blocking,
+                 calibration_cache_size=arguments.calibration_cache_size,
+                 preload_calibrations=arguments.preload_calibrations,
+                 background_calibration_loading=arguments.background_calibration_loading,
+                 uncalibrated_fallback=arguments.uncalibrated_fallback,
+                 calibration_cache_folder=arguments.calibration_cache_folder,
+                 pipelined=arguments.pipelined,
+                 pipeline_queue_size=arguments.pipeline_queue_size,
+                 compute_backpressure=arguments.compute_backpressure,
+                 send_backpressure=arguments.send_backpressure,
+                 epics_backpressure=arguments.epics_backpressure,
+                 workers=arguments.workers,
+                 async_epics=arguments.async_epics,
+                 output_buffer_sets=arguments.output_buffer_sets,
+                 time_axis_mode=arguments.time_axis_mode,
+                 metrics_port=arguments.metrics_port,
+                 metrics_log_interval=arguments.metrics_log_interval,
+                 catch_up_mode=arguments.catch_up_mode,
+                 catch_up_max_lag=arguments.catch_up_max_lag,
+                 catch_up_max_queue_depth=arguments.catch_up_max_queue_depth,
+                 group_devices=arguments.group_devices,
+                 startup_profile=startup_profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import precompile_calibrations
+from frontend_digitizers_calibration.utils import load_ioc_host_config
+
+_logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify the calibration files of the configurations and store their '
+                                                 'precompiled form in the calibration cache folder.')
+
+    parser.add_argument("config_file_names", type=str, nargs='*',
+                        help="Configuration files of the ioc hosts, all the .json files in the configuration folder "
+                             "if none are given.")
+    parser.add_argument("--config_folder", type=str, default=config.DEFAULT_CONFIG_FOLDER,
+                        help="Folder where the configuration and calibration files are.")
+    parser.add_argument("--calibration_cache_folder", type=str, default=config.DEFAULT_CALIBRATION_CACHE_FOLDER,
+                        help="Folder to store the precompiled calibrations in, the calibration_cache_folder of the "
+                             "streams.")
+    parser.add_argument("--log_level", default="INFO", choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Log level to use.")
+    arguments = parser.parse_args()
+
+    if arguments.calibration_cache_folder is None:
+        parser.error("the calibration cache folder is required.")
+
+    logging.basicConfig(level=arguments.log_level, format='[%(levelname)s] %(message)s')
+
+    config_file_names = arguments.config_file_names
+    if not config_file_names:
+        config_file_names = sorted(os.path.basename(config_file)
+                                   for config_file in glob.glob(os.path.join(arguments.config_folder, "*.json")))
+
+    n_precompiled = 0
+    invalid_files = []
+
+    for config_file_name in config_file_names:
+        ioc_host, ioc_host_config = load_ioc_host_config(config_folder=arguments.config_folder,
+                                                         config_file_name=config_file_name)
+
+        n_config_precompiled, config_invalid_files = precompile_calibrations(
+            ioc_host_config=ioc_host_config,
+            config_folder=arguments.config_folder,
+            cache_folder=arguments.calibration_cache_folder)
+
+        _logger.info("Precompiled %d calibration files of ioc_host '%s'.", n_config_precompiled, ioc_host)
+
+        n_precompiled += n_config_precompiled
+        invalid_files.extend(config_invalid_files)
+
+    _logger.info("Precompiled %d calibration files to '%s'.", n_precompiled, arguments.calibration_cache_folder)
+
+    if invalid_files:
+        _logger.error("Missing or invalid calibration files: %s", invalid_files)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import logging
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.recalibration import recalibrate_dump, OUTPUT_FORMATS
+from frontend_digitizers_calibration.utils import load_ioc_host_config
+
+_logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recalibrate the messages of a mflow dump folder.')
+
+    parser.add_argument("dump_folder", type=str, help="Folder with the mflow dump to recalibrate.")
+    parser.add_argument("config_file_name", type=str, help="Configuration file of the ioc host of the dump.")
+    parser.add_argument("output", type=str, help="Output HDF5 file or folder for the .npy files.")
+    parser.add_argument("--output_format", default=None, choices=OUTPUT_FORMATS,
+                        help="Output format - by default HDF5 (requires h5py) for outputs ending in .h5 or .hdf5, "
+                             "npy otherwise.")
+    parser.add_argument("--config_folder", type=str, default=config.DEFAULT_CONFIG_FOLDER,
+                        help="Folder where the configuration and calibration files are.")
+    parser.add_argument("--calibration_cache_folder", type=str, default=config.DEFAULT_CALIBRATION_CACHE_FOLDER,
+                        help="Folder to store the tables derived from the calibration files in.")
+    parser.add_argument("--batch_size", type=int, default=config.DEFAULT_RECALIBRATION_BATCH_SIZE,
+                        help="Number of pulses to process at once.")
+    parser.add_argument("--log_level", default="INFO", choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Log level to use.")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=arguments.log_level, format='[%(levelname)s] %(message)s')
+
+    _, ioc_host_config = load_ioc_host_config(config_folder=arguments.config_folder,
+                                              config_file_name=arguments.config_file_name)
+
+    n_written, n_skipped = recalibrate_dump(dump_folder=arguments.dump_folder,
+                                            ioc_host_config=ioc_host_config,
+                                            config_folder=arguments.config_folder,
+                                            output=arguments.output,
+                                            output_format=arguments.output_format,
+                                            batch_size=arguments.batch_size,
+                                            calibration_cache_folder=arguments.calibration_cache_folder)
+
+    _logger.info("Recalibrated %d pulses to '%s', %d pulses skipped.", n_written, arguments.output, n_skipped)
+
+
+if __name__ == "__main__":
+    main()
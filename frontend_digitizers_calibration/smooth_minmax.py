@@ -1,26 +1,44 @@
-import bisect
+from functools import lru_cache
 
+import numpy
 
-def find_minmax(data, window_size=21):
 
-    min_val = None
-    max_val = None
-    sorted_list = []
+@lru_cache(maxsize=None)
+def get_window_index(n_samples, window_size):
+    """
+    Sample indices of the windows: [window, sample]. The last window is aligned to the end of the data.
+    """
+    window_starts = numpy.arange(0, n_samples, window_size)
+    # the last window is aligned to the end of the data
+    window_starts[window_starts + window_size >= n_samples] = n_samples - window_size
 
-    # fill in the window
-    for i in range(0, len(data), window_size):
-        del sorted_list[:]
-        if i + window_size < (len(data)):
-            for j in range(i, i + window_size):
-                bisect.insort_left(sorted_list, data[j])
-        else:
-            for j in range(len(data)-window_size, len(data)):
-                bisect.insort_left(sorted_list, data[j])
+    window_index = window_starts[:, numpy.newaxis] + numpy.arange(window_size)
+    window_index.flags.writeable = False
 
-        median = sorted_list[(window_size//2)+1]
-        if min_val is None or median < min_val:
-            min_val = median
-        if max_val is None or median > max_val:
-            max_val = median
+    return window_index
 
-    return [min_val, max_val]
+
+def find_minmax(data, window_size=21, windows=None):
+    """
+    Find the min and max of the windowed medians of the data.
+    The data is split into consecutive windows of window_size samples, the last window is aligned to the end of
+    the data. The median of each window is the element (window_size//2)+1 of the sorted window.
+    :param data: 1D array (samples) or 2D array (channels x samples).
+    :param window_size: Number of samples in each window.
+    :param windows: Preallocated array for the windows [..., window, sample], None to allocate it.
+    :return: [min, max] of the medians, per channel for 2D data.
+    """
+    data = numpy.asarray(data)
+    window_index = get_window_index(data.shape[-1], window_size)
+
+    # windows copy of the data: [..., window, sample]
+    if windows is None:
+        windows = data[..., window_index]
+    else:
+        numpy.take(data, window_index, axis=-1, out=windows, mode='clip')
+
+    median_index = (window_size//2)+1
+    windows.partition(median_index, axis=-1)
+    medians = windows[..., median_index]
+
+    return [medians.min(axis=-1), medians.max(axis=-1)]
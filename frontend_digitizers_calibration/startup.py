@@ -0,0 +1,93 @@
+import importlib
+import logging
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import monotonic
+
+_logger = logging.getLogger(__name__)
+
+
+class StartupProfile(object):
+    """
+    Timings of the startup stages: imports, connections and the preparation of the calibration. A disabled profile
+    runs the stages without timing them.
+    """
+
+    def __init__(self, enabled=True, clock=monotonic):
+        self.enabled = enabled
+        self.clock = clock
+        self.start_time = clock()
+
+        # [(stage name, duration)] in the order the stages finished.
+        self.stages = []
+        # Time from the start of the profile to the report, None until it is reported.
+        self.startup_time = None
+        self.lock = Lock()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start_time = self.clock()
+        try:
+            yield
+        finally:
+            self.add_stage(name, self.clock() - start_time)
+
+    def add_stage(self, name, duration):
+        with self.lock:
+            self.stages.append((name, duration))
+            reported = self.startup_time is not None
+
+        # Stages running in the background can finish after the report.
+        if reported:
+            _logger.info("Startup profile: '%s' finished in %.3f s, %.3f s after the start.", name, duration,
+                         self.clock() - self.start_time)
+
+    def import_module(self, module_name):
+        with self.stage("import " + module_name):
+            return importlib.import_module(module_name)
+
+    def format(self):
+        with self.lock:
+            stages = ", ".join("%s %.3f s" % (name, duration) for name, duration in self.stages)
+            startup_time = self.startup_time if self.startup_time is not None else self.clock() - self.start_time
+
+        return "%s; ready after %.3f s" % (stages, startup_time)
+
+    def report(self):
+        """
+        Log the stages finished so far, the stages finishing later are logged one by one.
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.startup_time = self.clock() - self.start_time
+
+        _logger.info("Startup profile: %s", self.format())
+
+
+def import_in_background(module_name, startup_profile=None):
+    """
+    Import a module in a daemon thread, so it is imported by the time it is first used. An import error is logged
+    here and raised again by the import where the module is used.
+    :param module_name: Name of the module to import.
+    :param startup_profile: StartupProfile to time the import with, None to not time it.
+    :return: The import thread.
+    """
+    startup_profile = startup_profile if startup_profile is not None else StartupProfile(enabled=False)
+
+    def run_import():
+        try:
+            startup_profile.import_module(module_name)
+        except ImportError as e:
+            _logger.warning("Cannot import '%s': %s", module_name, e)
+
+    import_thread = Thread(target=run_import, name="import " + module_name)
+    import_thread.daemon = True
+    import_thread.start()
+
+    return import_thread
@@ -1,20 +1,45 @@
 import logging
-
-from bsread import source
-from bsread.sender import sender
+import shutil
+import tempfile
+from time import monotonic
 
 from frontend_digitizers_calibration import config
-from frontend_digitizers_calibration.devices.mapping import device_type_processing_function_mapping
+from frontend_digitizers_calibration.devices.mapping import device_type_processing_function_mapping, \
+    device_type_parallel_processing_function_mapping, device_type_grouped_processing_function_mapping, \
+    compile_device_plans, compile_device_group, compile_output_template
 from frontend_digitizers_calibration.utils import load_ioc_host_config, append_message_data
+from frontend_digitizers_calibration.buffers import allocate_device_buffers
 from frontend_digitizers_calibration.calibration import CalibrationManager
+from frontend_digitizers_calibration.catch_up import CatchUpPolicy
+from frontend_digitizers_calibration.epics_publisher import EpicsPublisher, load_epics_publisher_config
+from frontend_digitizers_calibration.metrics import StreamMetrics, start_metrics_server, start_metrics_logging, \
+    STAGE_RECEIVE, STAGE_PROCESS, STAGE_EPICS, STAGE_SEND, MESSAGES_RECEIVED, MESSAGES_SENT, MESSAGES_DROPPED, \
+    MESSAGES_UNCALIBRATED, MESSAGES_SKIPPED
+from frontend_digitizers_calibration.output_schema import load_output_schema
+from frontend_digitizers_calibration.pipeline import StageQueue, start_stage
+from frontend_digitizers_calibration.running_statistics import allocate_device_statistics
+from frontend_digitizers_calibration.startup import StartupProfile, import_in_background
+from frontend_digitizers_calibration.time_axis import add_time_axis_references, TimeAxisDeduplicator
+from frontend_digitizers_calibration.workers import WorkerMessage, WorkerPool
 from frontend_digitizers_calibration.utils import notify_epics
 
 _logger = logging.getLogger(__name__)
+# State of a worker process, set by init_worker.
+_worker_state = {}
 
 SUFFIX_CAPUT_ENABLE = "CAPUT-BOOL"
+SUFFIX_CALIBRATED = "CALIBRATED-BOOL"
 
 
-def process_message(message, devices, frequency_value_name, calibration_manager):
+def process_message(message, devices, frequency_value_name, calibration_manager,
+                    processing_function_mapping=device_type_processing_function_mapping, device_buffers=None,
+                    time_axis_mode=config.DEFAULT_TIME_AXIS_MODE, output_schema=None, device_plans=None,
+                    device_group=None, output_template=None):
+    """
+    :param device_group: DeviceGroup to calculate the intensity and position of the grouped devices with, if the
+                         device plans are compiled with the grouped processing functions.
+    :param output_template: Declared outputs of the devices to fill in, see compile_output_template.
+    """
     sampling_frequency = message.data.data[frequency_value_name].value
 
     if not calibration_manager.load_calibration_data(sampling_frequency):
@@ -22,26 +47,75 @@ def process_message(message, devices, frequency_value_name, calibration_manager)
 
     _logger.debug("Sampling frequency '%s'.", sampling_frequency)
 
-    data_to_send = {}
+    if device_plans is None:
+        device_plans = compile_device_plans(devices, processing_function_mapping)
 
-    for device_name, device_definition in devices.items():
-        device_type = device_definition[config.CONFIG_DEVICE_TYPE]
-        channels_definition = device_definition[config.CONFIG_DEVICE_CHANNELS]
+    data_to_send = output_template.copy() if output_template is not None else {}
 
-        _logger.debug("Processing device_type '%s'.", device_type)
+    for device_name, plan in device_plans.items():
+        _logger.debug("Processing device_type '%s'.", plan.device_type)
 
-        processing_function = device_type_processing_function_mapping[device_type]
+        plan.processing_function(message=message,
+                                 device_name=device_name,
+                                 device_definition=plan.device_definition,
+                                 channels_definition=plan.channels_definition,
+                                 calibration_data=calibration_manager,
+                                 buffers=device_buffers[device_name] if device_buffers else None,
+                                 plan=plan,
+                                 data_to_send=data_to_send)
 
-        processed_data = processing_function(message=message,
-                                             device_name=device_name,
-                                             device_definition=device_definition,
-                                             channels_definition=channels_definition,
-                                             calibration_data=calibration_manager)
+    if device_group is not None:
+        device_group.calculate(data_to_send)
 
-        data_to_send.update(processed_data)
+    if time_axis_mode != config.TIME_AXIS_MODE_FULL:
+        add_time_axis_references(message, device_plans, data_to_send, calibration_manager.tcal.calibration_id,
+                                 keep_time_axis=time_axis_mode == config.TIME_AXIS_MODE_ON_CHANGE)
 
     # Append the data from the original message.
-    append_message_data(message, data_to_send)
+    if output_schema is None:
+        append_message_data(message, data_to_send)
+    else:
+        output_schema.append_message_data(message, data_to_send)
+
+    return data_to_send
+
+
+def compile_stream_plans(devices, group_devices=False):
+    """
+    Compile the plans of the parallel processing of the devices - the ordered processing is applied by
+    post_process_message.
+    :param group_devices: Calculate the intensity and position of the 4 channel devices at once.
+    :return: (device_plans, device_group) - device_group is None if the devices are not grouped.
+    """
+    if not group_devices:
+        return compile_device_plans(devices, device_type_parallel_processing_function_mapping), None
+
+    device_plans = compile_device_plans(devices, device_type_grouped_processing_function_mapping)
+
+    return device_plans, compile_device_group(device_plans)
+
+
+def post_process_message(message, devices, data_to_send, device_plans=None, device_statistics=None):
+    """
+    Apply the ordered processing functions to the output of the parallel processing functions, and update the
+    running statistics of the devices. Has to be called in pulse_id order.
+    """
+    if device_plans is None:
+        device_plans = compile_device_plans(devices, device_type_parallel_processing_function_mapping)
+
+    for device_name, plan in device_plans.items():
+        statistics = device_statistics[device_name] if device_statistics else None
+
+        if plan.ordered_processing_function is not None:
+            plan.ordered_processing_function(message=message,
+                                             device_name=device_name,
+                                             device_definition=plan.device_definition,
+                                             data_to_send=data_to_send,
+                                             plan=plan,
+                                             statistics=statistics)
+
+        if statistics is not None:
+            statistics.update(data_to_send)
 
     return data_to_send
 
@@ -50,53 +124,625 @@ def no_client_function():
         _logger.info("No clients connected")
 
 
-def start_stream(config_folder, config_file, input_stream_port, output_stream_port, non_blocking=False):
-    ioc_host, ioc_host_config = load_ioc_host_config(config_folder=config_folder, config_file_name=config_file)
+def process_stream_message(message, ioc_host, devices, frequency_value_name, calibration_manager,
+                           forward_uncalibrated=False, device_buffers=None,
+                           time_axis_mode=config.DEFAULT_TIME_AXIS_MODE, time_axis_deduplicator=None,
+                           output_schema=None, device_plans=None, device_statistics=None, metrics=None,
+                           device_group=None, output_template=None):
+    """
+    Process a received message into the data to send to the output stream and to EPICS.
+    Has to be called in pulse_id order.
+    :return: (output_data, epics_data) - output_data is None if the message is dropped,
+             epics_data is None if EPICS should not be notified.
+    """
+    data = process_message(message=message,
+                           devices=devices,
+                           frequency_value_name=frequency_value_name,
+                           calibration_manager=calibration_manager,
+                           processing_function_mapping=device_type_parallel_processing_function_mapping,
+                           device_buffers=device_buffers,
+                           time_axis_mode=time_axis_mode,
+                           output_schema=output_schema,
+                           device_plans=device_plans,
+                           device_group=device_group,
+                           output_template=output_template)
+
+    if data is not None:
+        data = post_process_message(message, devices, data, device_plans, device_statistics)
+
+    _logger.debug("Message with pulse_id '%s' processed.", message.data.pulse_id)
+
+    return finish_stream_message(message=message,
+                                 data=data,
+                                 ioc_host=ioc_host,
+                                 forward_uncalibrated=forward_uncalibrated,
+                                 calibration_loading=calibration_manager.loading_frequency is not None,
+                                 time_axis_deduplicator=time_axis_deduplicator,
+                                 output_schema=output_schema,
+                                 metrics=metrics)
+
+
+def finish_stream_message(message, data, ioc_host, forward_uncalibrated=False, calibration_loading=False,
+                          time_axis_deduplicator=None, output_schema=None, metrics=None):
+    """
+    Split the processed data into the data to send to the output stream and to EPICS.
+    :param data: Processed data, None if the message was not processed.
+    :param calibration_loading: True if a calibration is being loaded in the background.
+    :param time_axis_deduplicator: TimeAxisDeduplicator to remove the unchanged time axes, None to keep them.
+    :param output_schema: OutputSchema to select the data for each output, None to send all data to all outputs.
+    :param metrics: StreamMetrics to count the dropped and uncalibrated messages in, None to not count them.
+    :return: (output_data, epics_data) - output_data is None if the message is dropped,
+             epics_data is None if EPICS should not be notified.
+    """
+    if data is None:
+        # Forward the raw data while the calibration is being loaded.
+        if forward_uncalibrated and calibration_loading:
+            if metrics is not None:
+                metrics.increment(MESSAGES_UNCALIBRATED)
+
+            return get_uncalibrated_data(message, ioc_host, output_schema), None
+
+        if metrics is not None:
+            metrics.increment(MESSAGES_DROPPED)
+
+        return None, None
+
+    if time_axis_deduplicator is not None:
+        time_axis_deduplicator.apply(data)
+
+    if output_schema is None:
+        epics_data = data
+    else:
+        data, epics_data = output_schema.split(message, data)
+
+    # Notify EPICS channels with the new calculated data, unless caput is disabled.
+    if ioc_host + ":" + SUFFIX_CAPUT_ENABLE in message.data.data:
+        if message.data.data[ioc_host + ":" + SUFFIX_CAPUT_ENABLE].value != 1:
+            _logger.debug("Caput is suppressed for pulse_id '%s'.", message.data.pulse_id)
+            epics_data = None
+
+    # Mark the output as calibrated, if uncalibrated data is forwarded as well.
+    if forward_uncalibrated:
+        data = dict(data)
+        data[ioc_host + ":" + SUFFIX_CALIBRATED] = 1
+
+    return data, epics_data
+
+
+def get_uncalibrated_data(message, ioc_host, output_schema=None):
+    """
+    :return: The values from the input message for the output stream, marked as not calibrated.
+    """
+    data = {ioc_host + ":" + SUFFIX_CALIBRATED: 0}
+
+    if output_schema is None:
+        append_message_data(message, data)
+    else:
+        raw_data = {}
+        output_schema.append_message_data(message, raw_data)
+        data.update(output_schema.split(message, raw_data)[0])
+
+    return data
+
+
+def skip_stream_message(message, ioc_host, catch_up_mode=config.DEFAULT_CATCH_UP_MODE, output_schema=None,
+                        metrics=None):
+    """
+    Data to send for a message skipped to catch up - it is not processed and not sent to EPICS.
+    :return: (output_data, None) - output_data is None if the message is dropped.
+    """
+    if metrics is not None:
+        metrics.increment(MESSAGES_SKIPPED)
+
+    if catch_up_mode == config.CATCH_UP_MODE_DROP:
+        return None, None
+
+    return get_uncalibrated_data(message, ioc_host, output_schema), None
+
+
+def init_worker(ioc_host_config, config_folder, calibration_cache_size, calibration_cache_folder,
+                background_calibration_loading, preload_calibrations, output_buffer_sets=0,
+                time_axis_mode=config.DEFAULT_TIME_AXIS_MODE, group_devices=False):
+    """
+    Initialize the calibration of a worker process.
+    """
+    calibration_manager = CalibrationManager(ioc_host_config, config_folder, cache_size=calibration_cache_size,
+                                             background_loading=background_calibration_loading,
+                                             cache_folder=calibration_cache_folder)
+
+    if preload_calibrations:
+        calibration_manager.start_preloading()
+    else:
+        calibration_manager.start_warming_up()
+
+    _worker_state["calibration_manager"] = calibration_manager
+    _worker_state["devices"] = ioc_host_config[config.CONFIG_SECTION_DEVICES]
+    _worker_state["frequency_value_name"] = ioc_host_config[config.CONFIG_SECTION_FREQUENCY]
+    _worker_state["device_buffers"] = allocate_device_buffers(_worker_state["devices"], output_buffer_sets)
+    _worker_state["time_axis_mode"] = time_axis_mode
+    _worker_state["output_schema"] = load_output_schema(ioc_host_config)
+    _worker_state["device_plans"], _worker_state["device_group"] = compile_stream_plans(_worker_state["devices"],
+                                                                                         group_devices)
+    _worker_state["output_template"] = compile_output_template(_worker_state["device_plans"])
+
+
+def process_in_worker(pulse_id, values):
+    """
+    Run the parallel processing functions on a message in a worker process.
+    :param pulse_id: Pulse_id of the message.
+    :param values: Dictionary with the message values.
+    :return: (data, calibration_loading) - data is None if the message was not processed.
+    """
+    calibration_manager = _worker_state["calibration_manager"]
+
+    data = process_message(message=WorkerMessage(pulse_id, values),
+                           devices=_worker_state["devices"],
+                           frequency_value_name=_worker_state["frequency_value_name"],
+                           calibration_manager=calibration_manager,
+                           processing_function_mapping=device_type_parallel_processing_function_mapping,
+                           device_buffers=_worker_state["device_buffers"],
+                           time_axis_mode=_worker_state["time_axis_mode"],
+                           output_schema=_worker_state["output_schema"],
+                           device_plans=_worker_state["device_plans"],
+                           device_group=_worker_state["device_group"],
+                           output_template=_worker_state["output_template"])
+
+    return data, calibration_manager.loading_frequency is not None
+
+
+def send_message(output_stream, message, data):
+    # send out bsread stream
+    output_stream.send(timestamp=(message.data.global_timestamp, message.data.global_timestamp_offset),
+                       pulse_id=message.data.pulse_id,
+                       data=data)
+
+    _logger.debug("Message with pulse_id '%s' sent out, if someone is listening", message.data.pulse_id)
+
+
+def receive_message(input_stream, metrics, frequency_value_name):
+    """
+    Receive the next message and update the metrics with its pulse_id and sampling frequency.
+    """
+    with metrics.timer(STAGE_RECEIVE):
+        message = input_stream.receive()
+
+    _logger.debug("Received message with pulse_id '%s'.", message.data.pulse_id)
+
+    frequency_value = message.data.data.get(frequency_value_name)
+
+    metrics.increment(MESSAGES_RECEIVED)
+    metrics.pulse_ids.update(message.data.pulse_id, frequency_value.value if frequency_value is not None else None)
+
+    return message
+
+
+def timed(metrics, stage, function):
+    """
+    Wrap the function to time its calls as the stage - the calls have to be made from a single thread.
+    """
+    timer = metrics.timer(stage)
+
+    def timed_function(*args):
+        with timer:
+            return function(*args)
+
+    return timed_function
+
+
+def start_metrics(metrics, metrics_port, metrics_log_interval):
+    if metrics_port:
+        start_metrics_server(metrics, metrics_port)
+
+    if metrics_log_interval:
+        _logger.info("Logging a metrics summary every %s seconds.", metrics_log_interval)
+        start_metrics_logging(metrics, metrics_log_interval)
+
+
+def log_catch_up_policy(catch_up_policy, catch_up_mode):
+    if catch_up_policy.enabled:
+        _logger.info("Catching up with mode '%s' at a lag of %s seconds or %s waiting messages.", catch_up_mode,
+                     catch_up_policy.max_lag, catch_up_policy.max_queue_depth)
+
+
+def start_epics_publishing(ioc_host_config, async_epics, copy_arrays, startup_profile):
+    """
+    :param async_epics: Publish from the thread of an EpicsPublisher, otherwise with notify_epics in the caller.
+    :param copy_arrays: Copy the arrays to publish, see EpicsPublisher.
+    :return: (epics_publisher, publish_epics) - epics_publisher is None if the values are published synchronously.
+    """
+    if not async_epics:
+        # notify_epics imports pyepics on the first message.
+        import_in_background("epics", startup_profile)
+        return None, notify_epics
+
+    epics_publisher_config = load_epics_publisher_config(ioc_host_config)
+    _logger.info("Publishing to EPICS asynchronously with %s.", epics_publisher_config)
+
+    with startup_profile.stage("epics publisher"):
+        epics_publisher = EpicsPublisher(copy_arrays=copy_arrays, **epics_publisher_config).start()
+
+    return epics_publisher, epics_publisher.publish
+
+
+def connect_input_stream(ioc_host, input_stream_port, startup_profile=None):
+    """
+    Connect to the input stream. It is connected before the rest of the startup: the connection is established while
+    the calibration is prepared, and the messages received in the meantime wait in the receive queue.
+    :return: Connected bsread source, to disconnect at the end of the stream.
+    """
+    startup_profile = startup_profile if startup_profile is not None else StartupProfile(enabled=False)
+
+    # bsread is imported here, so the processing can be imported without it.
+    source = startup_profile.import_module("bsread").source
+
+    with startup_profile.stage("connect input"):
+        input_stream = source(host=ioc_host, port=input_stream_port, queue_size=config.INPUT_STREAM_QUEUE_SIZE)
+        input_stream.connect()
+
+    return input_stream
+
+
+def connect_output_stream(output_stream_port, non_blocking=False, startup_profile=None):
+    """
+    :return: Open bsread sender of the output stream, to close at the end of the stream.
+    """
+    startup_profile = startup_profile if startup_profile is not None else StartupProfile(enabled=False)
+    sender = startup_profile.import_module("bsread.sender").sender
+
+    with startup_profile.stage("connect output"):
+        output_stream = sender(port=output_stream_port, block=(not non_blocking))
+        output_stream.open()
+
+    return output_stream
+
+
+def start_stream(config_folder, config_file, input_stream_port, output_stream_port, non_blocking=False,
+                 calibration_cache_size=config.DEFAULT_CALIBRATION_CACHE_SIZE, preload_calibrations=False,
+                 background_calibration_loading=False, uncalibrated_fallback=config.DEFAULT_UNCALIBRATED_FALLBACK,
+                 calibration_cache_folder=config.DEFAULT_CALIBRATION_CACHE_FOLDER, pipelined=False,
+                 pipeline_queue_size=config.DEFAULT_PIPELINE_QUEUE_SIZE,
+                 compute_backpressure=config.DEFAULT_COMPUTE_BACKPRESSURE,
+                 send_backpressure=config.DEFAULT_SEND_BACKPRESSURE,
+                 epics_backpressure=config.DEFAULT_EPICS_BACKPRESSURE, workers=config.DEFAULT_WORKERS,
+                 async_epics=False, output_buffer_sets=config.DEFAULT_OUTPUT_BUFFER_SETS,
+                 time_axis_mode=config.DEFAULT_TIME_AXIS_MODE, metrics_port=config.DEFAULT_METRICS_PORT,
+                 metrics_log_interval=config.DEFAULT_METRICS_LOG_INTERVAL, catch_up_mode=config.DEFAULT_CATCH_UP_MODE,
+                 catch_up_max_lag=config.DEFAULT_CATCH_UP_MAX_LAG,
+                 catch_up_max_queue_depth=config.DEFAULT_CATCH_UP_MAX_QUEUE_DEPTH, group_devices=False,
+                 startup_profile=None):
+    startup_profile = startup_profile if startup_profile is not None else StartupProfile(enabled=False)
+
+    with startup_profile.stage("configuration"):
+        ioc_host, ioc_host_config = load_ioc_host_config(config_folder=config_folder, config_file_name=config_file)
     _logger.info("Configuration defines ioc_host '%s'.", ioc_host)
 
-    CM = CalibrationManager(ioc_host_config, config_folder)
-    _logger.info("Configuration defined frequency_files: %s", CM.vcal_files)
-    _logger.info("Configuration defined frequency_files: %s", CM.tcal_files)
+    if workers > 1:
+        if pipelined:
+            _logger.warning("The pipeline options are ignored when running with %d workers.", workers)
+
+        # The workers share the derived calibration tables through memory mapped files in the cache folder.
+        temporary_cache_folder = None
+        if calibration_cache_folder is None:
+            temporary_cache_folder = calibration_cache_folder = tempfile.mkdtemp(prefix="calibration_cache_")
+            _logger.info("Using temporary calibration cache folder '%s' for the workers.", calibration_cache_folder)
+
+        try:
+            # The calibration is loaded by the workers.
+            start_worker_stream(ioc_host=ioc_host,
+                                ioc_host_config=ioc_host_config,
+                                config_folder=config_folder,
+                                input_stream_port=input_stream_port,
+                                output_stream_port=output_stream_port,
+                                non_blocking=non_blocking,
+                                calibration_cache_size=calibration_cache_size,
+                                preload_calibrations=preload_calibrations,
+                                background_calibration_loading=background_calibration_loading,
+                                uncalibrated_fallback=uncalibrated_fallback,
+                                calibration_cache_folder=calibration_cache_folder,
+                                workers=workers,
+                                async_epics=async_epics,
+                                output_buffer_sets=output_buffer_sets,
+                                time_axis_mode=time_axis_mode,
+                                metrics_port=metrics_port,
+                                metrics_log_interval=metrics_log_interval,
+                                catch_up_policy=CatchUpPolicy(catch_up_max_lag, catch_up_max_queue_depth),
+                                catch_up_mode=catch_up_mode,
+                                group_devices=group_devices,
+                                startup_profile=startup_profile)
+        finally:
+            # The workers are stopped by now.
+            if temporary_cache_folder is not None:
+                shutil.rmtree(temporary_cache_folder, ignore_errors=True)
+        return
+
+    metrics = StreamMetrics()
+    catch_up_policy = CatchUpPolicy(catch_up_max_lag, catch_up_max_queue_depth)
+    epics_publisher = None
+    output_stream = None
+
+    # Pipeline stages, in the order to stop them.
+    stages = []
+
+    input_stream = connect_input_stream(ioc_host, input_stream_port, startup_profile)
+
+    # The input stream is disconnected in the finally block also when the rest of the startup fails.
+    try:
+        start_metrics(metrics, metrics_port, metrics_log_interval)
+
+        log_catch_up_policy(catch_up_policy, catch_up_mode)
+
+        # The preallocated output buffers are reused before the rate limited values are put.
+        epics_publisher, publish_epics = start_epics_publishing(ioc_host_config, async_epics,
+                                                                copy_arrays=bool(output_buffer_sets),
+                                                                startup_profile=startup_profile)
+
+        with startup_profile.stage("calibration manager"):
+            CM = CalibrationManager(ioc_host_config, config_folder, cache_size=calibration_cache_size,
+                                    background_loading=background_calibration_loading,
+                                    cache_folder=calibration_cache_folder, metrics=metrics)
+        _logger.info("Configuration defined frequency_files: %s", CM.vcal_files)
+        _logger.info("Configuration defined frequency_files: %s", CM.tcal_files)
+
+        if preload_calibrations:
+            # The first message waits for the preloading, if it is not finished by then.
+            CM.start_preloading()
+        else:
+            CM.start_warming_up()
+
+        devices = ioc_host_config[config.CONFIG_SECTION_DEVICES]
+        _logger.info("Configuration defined devices: %s", list(devices.keys()))
+
+        frequency_value_name = ioc_host_config[config.CONFIG_SECTION_FREQUENCY]
+        _logger.info("Configuration defines frequency value name '%s'.", frequency_value_name)
+
+        forward_uncalibrated = uncalibrated_fallback == config.UNCALIBRATED_FALLBACK_RAW
+
+        if output_buffer_sets and pipelined:
+            # The calibrated data waiting in the send and EPICS queues must not be overwritten.
+            output_buffer_sets = max(output_buffer_sets, 2 * pipeline_queue_size + 3)
+
+        with startup_profile.stage("plans and buffers"):
+            device_buffers = allocate_device_buffers(devices, output_buffer_sets)
+
+            time_axis_deduplicator = TimeAxisDeduplicator() \
+                if time_axis_mode == config.TIME_AXIS_MODE_ON_CHANGE else None
+            output_schema = load_output_schema(ioc_host_config)
+            # The ordered processing is applied by process_stream_message.
+            device_plans, device_group = compile_stream_plans(devices, group_devices)
+            output_template = compile_output_template(device_plans)
+            device_statistics = allocate_device_statistics(devices)
+
+        if device_buffers:
+            _logger.info("Using %d preallocated output buffer sets.", output_buffer_sets)
+        if device_group is not None:
+            _logger.info("Calculating the intensity and position of devices %s at once.", device_group.device_names)
+
+        def process(message, queue_depth=None):
+            if catch_up_policy.skip(message, queue_depth):
+                return skip_stream_message(message, ioc_host, catch_up_mode, output_schema, metrics)
+
+            return process_stream_message(message=message,
+                                          ioc_host=ioc_host,
+                                          devices=devices,
+                                          frequency_value_name=frequency_value_name,
+                                          calibration_manager=CM,
+                                          forward_uncalibrated=forward_uncalibrated,
+                                          device_buffers=device_buffers,
+                                          time_axis_mode=time_axis_mode,
+                                          time_axis_deduplicator=time_axis_deduplicator,
+                                          output_schema=output_schema,
+                                          device_plans=device_plans,
+                                          device_statistics=device_statistics,
+                                          metrics=metrics,
+                                          device_group=device_group,
+                                          output_template=output_template)
+
+        output_stream = connect_output_stream(output_stream_port, non_blocking, startup_profile)
+
+        def send(item):
+            send_message(output_stream, *item)
+            metrics.increment(MESSAGES_SENT)
+
+        startup_profile.report()
+
+        if pipelined:
+            _logger.info("Running in pipelined mode.")
+
+            # The stages are connected with FIFO queues and a single compute stage, so the pulse_id
+            # order is preserved on the output stream.
+            compute_queue = StageQueue(pipeline_queue_size, compute_backpressure)
+            send_queue = StageQueue(pipeline_queue_size, send_backpressure)
+            epics_queue = StageQueue(pipeline_queue_size, epics_backpressure)
+
+            metrics.add_queue("compute", compute_queue)
+            metrics.add_queue("send", send_queue)
+            metrics.add_queue("epics", epics_queue)
+
+            def compute(message):
+                data, epics_data = process(message, compute_queue.qsize())
+
+                if epics_data is not None:
+                    epics_queue.put(epics_data)
+
+                if data is not None:
+                    send_queue.put((message, data))
+
+            stages.append(start_stage("compute", timed(metrics, STAGE_PROCESS, compute), compute_queue))
+            stages.append(start_stage("epics", timed(metrics, STAGE_EPICS, publish_epics), epics_queue))
+            stages.append(start_stage("send", timed(metrics, STAGE_SEND, send), send_queue))
+
+            while True:
+                compute_queue.put(receive_message(input_stream, metrics, frequency_value_name))
+
+                # A stage failing persistently stops the stream.
+                for stage in stages:
+                    stage.check()
+
+        process_timer = metrics.timer(STAGE_PROCESS)
+        epics_timer = metrics.timer(STAGE_EPICS)
+        send_timer = metrics.timer(STAGE_SEND)
+
+        while True:
+            message = receive_message(input_stream, metrics, frequency_value_name)
+
+            with process_timer:
+                data, epics_data = process(message)
+
+            if epics_data is not None:
+                with epics_timer:
+                    publish_epics(epics_data)
+
+            if data is not None:
+                with send_timer:
+                    send((message, data))
+
+    except KeyboardInterrupt:
+        _logger.info("Terminating due to user request.")
+
+    finally:
+        # The send stage has to finish before the output stream is closed.
+        for stage in stages:
+            if not stage.stop(config.PIPELINE_STOP_TIMEOUT):
+                _logger.warning("Pipeline stage '%s' did not stop in %s seconds.", stage.name,
+                                config.PIPELINE_STOP_TIMEOUT)
+
+        if output_stream is not None:
+            output_stream.close()
+        input_stream.disconnect()
+
+    _logger.info("Stream metrics: %s", metrics.format_summary())
+
+    if catch_up_policy.enabled:
+        _logger.info("Catch up statistics: %s", catch_up_policy.get_statistics())
+
+    if epics_publisher is not None:
+        _logger.info("EPICS publisher statistics: %s", epics_publisher.get_statistics())
+
+
+def start_worker_stream(ioc_host, ioc_host_config, config_folder, input_stream_port, output_stream_port,
+                        non_blocking, calibration_cache_size, preload_calibrations, background_calibration_loading,
+                        uncalibrated_fallback, calibration_cache_folder, workers, async_epics=False,
+                        output_buffer_sets=0, time_axis_mode=config.DEFAULT_TIME_AXIS_MODE,
+                        metrics_port=config.DEFAULT_METRICS_PORT,
+                        metrics_log_interval=config.DEFAULT_METRICS_LOG_INTERVAL, catch_up_policy=None,
+                        catch_up_mode=config.DEFAULT_CATCH_UP_MODE, group_devices=False, startup_profile=None):
+    """
+    Process the messages in a pool of worker processes. The results are reordered by pulse_id, before the ordered
+    processing functions are applied and the results are sent out.
+    The process stage of the metrics is the time from the submission of a message to its output, including the wait
+    for the earlier pulse_ids. The messages skipped to catch up are not sent to the workers, but still pass the
+    reordering.
+    The worker processes are forked before this process starts any thread or connects any socket, so the workers do
+    not inherit them.
+    """
+    startup_profile = startup_profile if startup_profile is not None else StartupProfile(enabled=False)
 
     devices = ioc_host_config[config.CONFIG_SECTION_DEVICES]
     _logger.info("Configuration defined devices: %s", list(devices.keys()))
 
     frequency_value_name = ioc_host_config[config.CONFIG_SECTION_FREQUENCY]
-    _logger.info("Configuration defines frequency value name '%s'.", frequency_value_name)
+    metrics = StreamMetrics()
+    catch_up_policy = catch_up_policy if catch_up_policy is not None else CatchUpPolicy()
+    log_catch_up_policy(catch_up_policy, catch_up_mode)
+
+    forward_uncalibrated = uncalibrated_fallback == config.UNCALIBRATED_FALLBACK_RAW
+
+    time_axis_deduplicator = TimeAxisDeduplicator() if time_axis_mode == config.TIME_AXIS_MODE_ON_CHANGE else None
+    output_schema = load_output_schema(ioc_host_config)
+    device_plans, _ = compile_stream_plans(devices, group_devices)
+    device_statistics = allocate_device_statistics(devices)
+
+    # Called by the worker pool for the results, only once the output stream is connected below.
+    def output(item, result):
+        message, submit_time, skipped = item
+
+        if skipped:
+            data, epics_data = skip_stream_message(message, ioc_host, catch_up_mode, output_schema, metrics)
+        else:
+            metrics.observe(STAGE_PROCESS, monotonic() - submit_time)
+
+            if result is None:
+                return
+
+            data, calibration_loading = result
+
+            if data is not None:
+                data = post_process_message(message, devices, data, device_plans, device_statistics)
 
+            data, epics_data = finish_stream_message(message=message,
+                                                     data=data,
+                                                     ioc_host=ioc_host,
+                                                     forward_uncalibrated=forward_uncalibrated,
+                                                     calibration_loading=calibration_loading,
+                                                     time_axis_deduplicator=time_axis_deduplicator,
+                                                     output_schema=output_schema,
+                                                     metrics=metrics)
+
+        if epics_data is not None:
+            with metrics.timer(STAGE_EPICS):
+                publish_epics(epics_data)
+
+        if data is not None:
+            with metrics.timer(STAGE_SEND):
+                send_message(output_stream, message, data)
+
+            metrics.increment(MESSAGES_SENT)
+
+    _logger.info("Running with %d workers.", workers)
+
+    with startup_profile.stage("start workers"):
+        worker_pool = WorkerPool(n_workers=workers,
+                                 worker_function=process_in_worker,
+                                 output_function=output,
+                                 max_in_flight=workers * config.WORKER_MAX_IN_FLIGHT,
+                                 initializer=init_worker,
+                                 initargs=(ioc_host_config, config_folder, calibration_cache_size,
+                                           calibration_cache_folder, background_calibration_loading,
+                                           preload_calibrations, output_buffer_sets, time_axis_mode,
+                                           group_devices))
+
+    metrics.add_queue("workers", worker_pool)
+
+    epics_publisher = None
+    input_stream = None
+    output_stream = None
+
+    # The workers and the streams are stopped in the finally block also when the rest of the startup fails.
     try:
-        with source(host=ioc_host, port=input_stream_port, queue_size=config.INPUT_STREAM_QUEUE_SIZE) as input_stream:
-            with sender(port=output_stream_port, block=(not non_blocking)) as output_stream:
-                while True:
-                    message = input_stream.receive()
-
-                    _logger.debug("Received message with pulse_id '%s'.", message.data.pulse_id)
-
-                    data = process_message(message=message,
-                                           devices=devices,
-                                           frequency_value_name=frequency_value_name,
-                                           calibration_manager=CM)
-                    if data is None:
-                        _logger.debug("Message with pulse_id '%s' processed.", message.data.pulse_id)
-                        continue
-
-                    _logger.debug("Message with pulse_id '%s' processed.", message.data.pulse_id)
-
-                    # Notify EPICS channels with the new calculated data.
-                    if ioc_host + ":" + SUFFIX_CAPUT_ENABLE in message.data.data:
-                        if message.data.data[ioc_host + ":" + SUFFIX_CAPUT_ENABLE].value == 1:
-                            notify_epics(data)
-                        else:
-                            _logger.debug("Caput is suppressed", message.data.pulse_id)
-                    else:
-                        notify_epics(data)
-
-                    # send out bsread stream
-                    output_stream.send(timestamp=(message.data.global_timestamp, message.data.global_timestamp_offset),
-                                       pulse_id=message.data.pulse_id,
-                                       data=data)
-
-                    _logger.debug("Message with pulse_id '%s' sent out, if someone is listening", message.data.pulse_id)
+        start_metrics(metrics, metrics_port, metrics_log_interval)
+
+        # The values to publish are copies received from the workers.
+        epics_publisher, publish_epics = start_epics_publishing(ioc_host_config, async_epics, copy_arrays=False,
+                                                                startup_profile=startup_profile)
+
+        input_stream = connect_input_stream(ioc_host, input_stream_port, startup_profile)
+        output_stream = connect_output_stream(output_stream_port, non_blocking, startup_profile)
+
+        startup_profile.report()
+
+        while True:
+            message = receive_message(input_stream, metrics, frequency_value_name)
+
+            if catch_up_policy.skip(message, worker_pool.qsize()):
+                worker_pool.submit_result((message, None, True), None)
+            else:
+                worker_pool.submit((message, monotonic(), False), *WorkerMessage.get_values(message))
 
     except KeyboardInterrupt:
         _logger.info("Terminating due to user request.")
+
+    finally:
+        worker_pool.close()
+
+        if output_stream is not None:
+            output_stream.close()
+        if input_stream is not None:
+            input_stream.disconnect()
+
+    _logger.info("Stream metrics: %s", metrics.format_summary())
+
+    if catch_up_policy.enabled:
+        _logger.info("Catch up statistics: %s", catch_up_policy.get_statistics())
+
+    if epics_publisher is not None:
+        _logger.info("EPICS publisher statistics: %s", epics_publisher.get_statistics())
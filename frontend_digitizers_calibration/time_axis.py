@@ -0,0 +1,124 @@
+import os
+
+import numpy
+
+from frontend_digitizers_calibration.calibration import TimeCalibration
+from frontend_digitizers_calibration.calibration_cache import file_cache_key
+from frontend_digitizers_calibration.devices.utils import SUFFIX_CHANNEL_TIME_AXIS, \
+    SUFFIX_CHANNEL_TIME_AXIS_REFERENCE, SUFFIX_CHANNEL_TIME_AXIS_CALIBRATION
+
+# Calibration id of the default calibrations, see TimeCalibration.load_default.
+DEFAULT_CALIBRATION_ID_PREFIX = "default-"
+DEFAULT_CALIBRATION_ID_SUFFIX = "MHz"
+
+
+def is_uniform_calibration_id(calibration_id):
+    """
+    :return: True if the time axis of the calibration is the same for all the trigger cells - the default calibrations.
+    """
+    return calibration_id.startswith(DEFAULT_CALIBRATION_ID_PREFIX)
+
+
+def add_time_axis_references(message, device_plans, data_to_send, calibration_id, keep_time_axis):
+    """
+    Add the time axis reference of each channel to the data to send. The background time axis, pv_prefix-BG-TIME-AXIS,
+    is referenced by pv_prefix-BG-TIME-AXIS-REF and pv_prefix-BG-TIME-AXIS-CALIBRATION.
+    :param message: bsread message with the trigger cells.
+    :param device_plans: Dictionary with device_name: DevicePlan.
+    :param data_to_send: Processed data with the time axes.
+    :param calibration_id: Identity of the time calibration used.
+    :param keep_time_axis: Keep the time axes in the data, otherwise only the references are sent.
+    """
+    message_data = message.data.data
+
+    for plan in device_plans.values():
+        for channel in plan.channels:
+            for time_axis, trigger_cell, reference, calibration in channel.time_axis_references:
+                # Not calibrated in this message, the declared outputs are None until they are written.
+                if data_to_send.get(time_axis) is None:
+                    continue
+
+                data_to_send[reference] = numpy.array([channel.channel_number, message_data[trigger_cell].value],
+                                                      dtype=numpy.int32)
+                data_to_send[calibration] = calibration_id
+
+                if not keep_time_axis:
+                    del data_to_send[time_axis]
+
+
+class TimeAxisDeduplicator(object):
+    """
+    Remove the time axes that did not change since they were last sent. Has to be applied in pulse_id order.
+    """
+
+    def __init__(self):
+        # pv_prefix: (calibration_id, channel_number, trigger_cell) of the last time axis sent, without the trigger
+        # cell for the uniform calibrations
+        self.sent_time_axes = {}
+
+    def apply(self, data_to_send):
+        for name in [name for name in data_to_send if name.endswith(SUFFIX_CHANNEL_TIME_AXIS_REFERENCE)]:
+            pv_prefix = name[:-len(SUFFIX_CHANNEL_TIME_AXIS_REFERENCE)]
+
+            reference = data_to_send[name]
+            calibration_id = data_to_send[pv_prefix + SUFFIX_CHANNEL_TIME_AXIS_CALIBRATION]
+
+            # The time axis of a uniform calibration does not change with the trigger cell.
+            if is_uniform_calibration_id(calibration_id):
+                key = (calibration_id, int(reference[0]))
+            else:
+                key = (calibration_id, int(reference[0]), int(reference[1]))
+
+            if self.sent_time_axes.get(pv_prefix) == key:
+                data_to_send.pop(pv_prefix + SUFFIX_CHANNEL_TIME_AXIS, None)
+            else:
+                self.sent_time_axes[pv_prefix] = key
+
+        return data_to_send
+
+
+class TimeAxisResolver(object):
+    """
+    Resolve the time axis references of the output stream - for the consumers of the stream.
+    """
+
+    def __init__(self, calibration_folder):
+        """
+        :param calibration_folder: Folder with the .tcal files used by the stream.
+        """
+        self.calibration_folder = calibration_folder
+        self.calibrations = {}
+
+    def get_calibration(self, calibration_id):
+        if calibration_id in self.calibrations:
+            return self.calibrations[calibration_id]
+
+        if calibration_id.startswith(DEFAULT_CALIBRATION_ID_PREFIX):
+            frequency_MHz = float(calibration_id[len(DEFAULT_CALIBRATION_ID_PREFIX):
+                                                 -len(DEFAULT_CALIBRATION_ID_SUFFIX)])
+
+            time_calibration = TimeCalibration()
+            time_calibration.load_default(frequency_MHz)
+
+        else:
+            # The calibration id is the file name followed by the CRC of the file.
+            filename = os.path.join(self.calibration_folder, calibration_id.rsplit("-", 1)[0])
+
+            if not os.path.exists(filename) or file_cache_key(filename) != calibration_id:
+                raise ValueError("Time calibration '%s' not available in '%s'." % (calibration_id,
+                                                                                   self.calibration_folder))
+
+            time_calibration = TimeCalibration(filename)
+
+        self.calibrations[calibration_id] = time_calibration
+        return time_calibration
+
+    def resolve(self, calibration_id, reference):
+        """
+        :param calibration_id: Value of the -TIME-AXIS-CALIBRATION channel.
+        :param reference: Value of the -TIME-AXIS-REF channel.
+        :return: Time axis in ns.
+        """
+        channel_number, trigger_cell = int(reference[0]), int(reference[1])
+
+        return self.get_calibration(calibration_id).get_time_axis(trigger_cell, channel_number)
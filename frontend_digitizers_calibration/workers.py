@@ -0,0 +1,202 @@
+import logging
+from collections import OrderedDict
+from multiprocessing import Pool
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+
+from frontend_digitizers_calibration import config
+
+_logger = logging.getLogger(__name__)
+
+
+class WorkerPoolError(Exception):
+    """
+    The result of a submitted item did not arrive in time, its worker process probably died.
+    """
+
+
+class WorkerValue(object):
+    """
+    Picklable stand-in for a bsread message value.
+    """
+    __slots__ = ["value"]
+
+    def __init__(self, value):
+        self.value = value
+
+
+class WorkerMessageData(object):
+    __slots__ = ["pulse_id", "data"]
+
+    def __init__(self, pulse_id, data):
+        self.pulse_id = pulse_id
+        self.data = data
+
+
+class WorkerMessage(object):
+    """
+    Picklable stand-in for a bsread message, with the fields the device processing functions use:
+    message.data.pulse_id and message.data.data[name].value.
+    """
+    __slots__ = ["data"]
+
+    def __init__(self, pulse_id, values):
+        self.data = WorkerMessageData(pulse_id, {name: WorkerValue(value) for name, value in values.items()})
+
+    @staticmethod
+    def get_values(message):
+        """
+        Values of a bsread message to send to a worker.
+        :param message: bsread message.
+        :return: (pulse_id, dictionary with name: value)
+        """
+        return message.data.pulse_id, {name: value.value for name, value in message.data.data.items()}
+
+
+class ReorderBuffer(object):
+    """
+    Collect items completed out of order and release them strictly in sequence order.
+    """
+
+    def __init__(self, next_sequence=0):
+        self.next_sequence = next_sequence
+        self.pending = {}
+
+    def add(self, sequence, item):
+        """
+        Add a completed item.
+        :param sequence: Sequence number of the item.
+        :param item: Completed item.
+        :return: List of items that are ready, in sequence order.
+        """
+        self.pending[sequence] = item
+
+        ready = []
+        while self.next_sequence in self.pending:
+            ready.append(self.pending.pop(self.next_sequence))
+            self.next_sequence += 1
+
+        return ready
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class WorkerPool(object):
+    """
+    Run a function in a pool of worker processes and pass the results to the output function in submission order.
+    The output function is called for one item at a time, so it can keep state between items.
+    A worker process that dies (crash, killed for memory) does not report the items it was processing, the later items
+    would wait for them forever: submit raises WorkerPoolError once the oldest item waits longer than result_timeout.
+    """
+
+    def __init__(self, n_workers, worker_function, output_function, max_in_flight, initializer=None, initargs=(),
+                 result_timeout=config.WORKER_RESULT_TIMEOUT, poll_interval=config.WORKER_POLL_INTERVAL):
+        """
+        :param n_workers: Number of worker processes.
+        :param worker_function: Top level (picklable) function to run in the workers.
+        :param output_function: Function called with (item, result) in submission order. The result is None if
+                                the worker function failed.
+        :param max_in_flight: Maximum number of submitted items not yet passed to the output function - submit
+                              blocks when reached.
+        :param initializer: Function to call in each worker process at start.
+        :param initargs: Arguments of the initializer.
+        :param result_timeout: Seconds to wait for the result of an item.
+        :param poll_interval: Seconds between the checks for a missing result while submit waits.
+        """
+        self.worker_function = worker_function
+        self.output_function = output_function
+
+        self.in_flight = BoundedSemaphore(max_in_flight)
+        self.reorder_buffer = ReorderBuffer()
+        self.lock = Lock()
+        self.next_sequence = 0
+
+        self.result_timeout = result_timeout
+        self.poll_interval = poll_interval
+        # sequence: submit time of the items in the workers, in submission order.
+        self.submit_times = OrderedDict()
+
+        self.pool = Pool(n_workers, initializer, initargs)
+
+    def submit(self, item, *args):
+        """
+        Submit an item for processing.
+        :param item: Item passed to the output function together with the result.
+        :param args: Arguments of the worker function.
+        """
+        self.acquire()
+
+        sequence = self.next_sequence
+        self.next_sequence += 1
+
+        with self.lock:
+            self.submit_times[sequence] = monotonic()
+
+        def on_result(result):
+            self.complete(sequence, item, result)
+
+        def on_error(error):
+            _logger.error("Worker failed to process item %s: %s", sequence, error)
+            self.complete(sequence, item, None)
+
+        self.pool.apply_async(self.worker_function, args, callback=on_result, error_callback=on_error)
+
+    def submit_result(self, item, result):
+        """
+        Submit an item that is not processed by the workers - it is passed to the output function with the result
+        once all the items submitted before it were.
+        """
+        self.acquire()
+
+        sequence = self.next_sequence
+        self.next_sequence += 1
+
+        self.complete(sequence, item, result)
+
+    def acquire(self):
+        """
+        Wait for a free slot for an item, checking for the results that do not arrive.
+        """
+        self.check()
+
+        while not self.in_flight.acquire(timeout=self.poll_interval):
+            self.check()
+
+    def check(self):
+        """
+        Raise WorkerPoolError if the oldest item in the workers waits for its result longer than result_timeout.
+        """
+        with self.lock:
+            if not self.submit_times:
+                return
+
+            sequence, submit_time = next(iter(self.submit_times.items()))
+
+        waiting_time = monotonic() - submit_time
+        if waiting_time > self.result_timeout:
+            raise WorkerPoolError("No result for item %d after %.1f seconds, a worker process probably died." %
+                                  (sequence, waiting_time))
+
+    def complete(self, sequence, item, result):
+        with self.lock:
+            self.submit_times.pop(sequence, None)
+            ready = self.reorder_buffer.add(sequence, (item, result))
+
+            for ready_item, ready_result in ready:
+                try:
+                    self.output_function(ready_item, ready_result)
+                except Exception:
+                    _logger.exception("Failed to output the result of a worker.")
+                finally:
+                    self.in_flight.release()
+
+    def qsize(self):
+        """
+        Number of submitted items not yet passed to the output function.
+        """
+        return self.next_sequence - self.reorder_buffer.next_sequence
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
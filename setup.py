@@ -8,4 +8,15 @@ setup(name="frontend_digitizers_calibration",
       packages=['frontend_digitizers_calibration',
                 'frontend_digitizers_calibration.devices',
                 'frontend_digitizers_calibration.scripts'],
+      extras_require={
+          # Fused calibration kernel, see fused_calibration.
+          "numba": ["numba"]
+      },
+      entry_points={
+          "frontend_digitizers_calibration.devices": [
+              "pbps = frontend_digitizers_calibration.devices.pbps:pbps_processor",
+              "pbpg = frontend_digitizers_calibration.devices.pbpg:pbpg_processor",
+              "single_channel = frontend_digitizers_calibration.devices.single_channel:single_channel_processor"
+          ]
+      },
       )
@@ -0,0 +1,431 @@
+"""
+Benchmark of the calibration pipeline, with regression thresholds.
+
+Each case runs in its own process, so the peak RSS is the one of the case. The results are printed as JSON and
+compared against a stored baseline - any regression beyond the tolerances makes the run fail. The baseline depends on
+the machine, store a new one with --update-baseline before comparing on a different machine.
+
+    python -m tests.benchmark                      # run all cases, compare against tests/data/benchmark_baseline.json
+    python -m tests.benchmark --case calibrate     # run only some cases
+    python -m tests.benchmark --update-baseline    # store the results as the new baseline
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.buffers import allocate_device_buffers, CalibrationBuffers
+from frontend_digitizers_calibration.calibration import VoltageCalibration, CalibrationManager, WD_N_CELLS
+from frontend_digitizers_calibration.devices.mapping import compile_device_plans, \
+    device_type_processing_function_mapping
+from frontend_digitizers_calibration.devices.utils import calibrate_channel, calibrate_channels
+from frontend_digitizers_calibration.fused_calibration import NUMBA_AVAILABLE
+from frontend_digitizers_calibration.dump import DumpReader
+from frontend_digitizers_calibration.running_statistics import allocate_device_statistics
+from frontend_digitizers_calibration.smooth_minmax import find_minmax
+from frontend_digitizers_calibration.workers import WorkerMessage, WorkerValue
+from tests.test_buffers import generate_message
+
+CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FOLDER = os.path.join(CURRENT_FOLDER, "data/configs")
+CONFIG_FILE = os.path.join(CONFIG_FOLDER, "test_SAROP21-CVME-PBPS1.json")
+DUMP_FOLDER = os.path.join(CURRENT_FOLDER, "data/SAROP21-CVME-PBPS1_ioc_dump")
+VCAL_FILE = os.path.join(CONFIG_FOLDER, "wd135-5120.vcal")
+BASELINE_FILE = os.path.join(CURRENT_FOLDER, "data/benchmark_baseline.json")
+
+# Number of different synthetic messages the cases cycle through.
+N_SYNTHETIC_MESSAGES = 100
+
+# The dump predates the gain and ROI channels - the dump messages are completed with these values.
+DUMP_MISSING_VALUES = {"-WD-gain-RBa": 3,
+                       "-ROI_sig_min": 100,
+                       "-ROI_sig_max": 300,
+                       "-ROI_bg_min": 0,
+                       "-ROI_bg_max": 90}
+
+# Number of times the calls of a case are repeated, the median of the repetitions is reported.
+DEFAULT_N_REPEAT = 5
+
+# Metric: True if higher is better.
+METRICS = OrderedDict([("pulses_per_second", True),
+                       ("latency_p50_us", False),
+                       ("latency_p99_us", False),
+                       ("peak_rss_kb", False)])
+
+# Relative change of each metric tolerated before it counts as a regression.
+DEFAULT_TOLERANCES = {"pulses_per_second": 0.3,
+                      "latency_p50_us": 0.35,
+                      "latency_p99_us": 1.0,
+                      "peak_rss_kb": 0.2}
+
+
+class CaseSkipped(Exception):
+    pass
+
+
+def load_ioc_host_config():
+    with open(CONFIG_FILE) as config_file:
+        return json.load(config_file)["localhost"]
+
+
+def get_channels_definition(devices):
+    return [channel for device_definition in devices.values()
+            for channel in device_definition[config.CONFIG_DEVICE_CHANNELS]]
+
+
+def generate_synthetic_messages(ioc_host_config, n_messages=N_SYNTHETIC_MESSAGES):
+    random_state = numpy.random.RandomState(0)
+    channels_definition = get_channels_definition(ioc_host_config[config.CONFIG_SECTION_DEVICES])
+
+    messages = []
+    for pulse_id in range(n_messages):
+        message = generate_message(random_state, channels_definition, background=True)
+        values = {name: value.value for name, value in message.data.data.items()}
+        values[ioc_host_config[config.CONFIG_SECTION_FREQUENCY]] = 5120
+
+        messages.append(WorkerMessage(pulse_id, values))
+
+    return messages
+
+
+def load_dump_messages(ioc_host_config):
+    channels_definition = get_channels_definition(ioc_host_config[config.CONFIG_SECTION_DEVICES])
+
+    messages = []
+    for pulse_id, values in DumpReader(DUMP_FOLDER):
+        for channel in channels_definition:
+            for suffix, value in DUMP_MISSING_VALUES.items():
+                values.setdefault(channel[config.CONFIG_CHANNEL_PV_PREFIX] + suffix, value)
+
+        messages.append(WorkerMessage(pulse_id, values))
+
+    return messages
+
+
+def load_calibration_manager(ioc_host_config):
+    calibration_manager = CalibrationManager(ioc_host_config, CONFIG_FOLDER, cache_folder=None)
+    calibration_manager.load_calibration_data(5120)
+
+    return calibration_manager
+
+
+def cycle(messages):
+    """
+    Function returning the next message on each call, starting again after the last one.
+    """
+    state = {"index": -1}
+
+    def next_message():
+        state["index"] = (state["index"] + 1) % len(messages)
+        return messages[state["index"]]
+
+    return next_message
+
+
+def setup_vcal_load():
+    return lambda: VoltageCalibration(VCAL_FILE)
+
+
+def setup_vcal_load_cached():
+    cache_folder = tempfile.mkdtemp()
+    # Store the derived tables, so the measured loads only map them.
+    VoltageCalibration(VCAL_FILE, cache_folder)
+
+    return lambda: VoltageCalibration(VCAL_FILE, cache_folder)
+
+
+def setup_calibrate():
+    vcal = VoltageCalibration(VCAL_FILE)
+    random_state = numpy.random.RandomState(0)
+    data = random_state.randint(1800, 2300, WD_N_CELLS).astype(numpy.float32)
+    trigger_cells = random_state.randint(0, WD_N_CELLS, N_SYNTHETIC_MESSAGES)
+    next_trigger_cell = cycle(trigger_cells)
+
+    return lambda: vcal.calibrate(data.copy(), next_trigger_cell(), 15)
+
+
+def setup_find_minmax():
+    random_state = numpy.random.RandomState(0)
+    data = random_state.normal(0, 0.1, (4, WD_N_CELLS)).astype(numpy.float32)
+
+    return lambda: find_minmax(data)
+
+
+def setup_calibrate_channel():
+    ioc_host_config = load_ioc_host_config()
+    calibration_manager = load_calibration_manager(ioc_host_config)
+    channel = get_channels_definition(ioc_host_config[config.CONFIG_SECTION_DEVICES])[0]
+    next_message = cycle(generate_synthetic_messages(ioc_host_config))
+
+    return lambda: calibrate_channel(next_message(), {}, channel[config.CONFIG_CHANNEL_PV_PREFIX],
+                                     channel[config.CONFIG_CHANNEL_NUMBER], calibration_manager)
+
+
+def setup_calibrate_channels(fused):
+    """
+    Calibration of the channels of the first device, with the fused kernel or with NumPy.
+    """
+    if fused and not NUMBA_AVAILABLE:
+        raise CaseSkipped("numba not installed")
+
+    ioc_host_config = load_ioc_host_config()
+    calibration_manager = load_calibration_manager(ioc_host_config)
+    plan = next(iter(compile_device_plans(ioc_host_config[config.CONFIG_SECTION_DEVICES]).values()))
+    buffers = CalibrationBuffers(len(plan.channels))
+    next_message = cycle(generate_synthetic_messages(ioc_host_config))
+
+    return lambda: calibrate_channels(next_message(), {}, plan.channels_definition, calibration_manager,
+                                      buffers=buffers, plan=plan, fused=fused)
+
+
+def setup_device_processing(device_type, messages_source):
+    """
+    Processing of a single device as the stream does it, with the plan and the default buffers of the device.
+    """
+    ioc_host_config = load_ioc_host_config()
+    calibration_manager = load_calibration_manager(ioc_host_config)
+
+    # The test configuration has a pbps device - process its channels as the device type to measure.
+    device_name, device_definition = next(iter(ioc_host_config[config.CONFIG_SECTION_DEVICES].items()))
+    device_definition = dict(device_definition, device_type=device_type, keithley_intensity=device_name + "KEITHLEY",
+                             scaling_factor=1, scaling_offset=0)
+
+    if device_type == "single_channel":
+        device_definition[config.CONFIG_DEVICE_CHANNELS] = device_definition[config.CONFIG_DEVICE_CHANNELS][:1]
+
+    devices = {device_name: device_definition}
+
+    messages = messages_source(ioc_host_config)
+    for message in messages:
+        message.data.data[device_name + "KEITHLEY"] = WorkerValue(1.0)
+
+    plan = compile_device_plans(devices)[device_name]
+    device_buffers = allocate_device_buffers(devices, config.DEFAULT_OUTPUT_BUFFER_SETS)
+    buffers = device_buffers[device_name] if device_buffers else None
+    statistics = allocate_device_statistics(devices)[device_name]
+    next_message = cycle(messages)
+
+    arguments = {"statistics": statistics} if device_type == "pbpg" else {}
+
+    def process():
+        return plan.processing_function(message=next_message(),
+                                        device_name=device_name,
+                                        device_definition=plan.device_definition,
+                                        channels_definition=plan.channels_definition,
+                                        calibration_data=calibration_manager,
+                                        buffers=buffers,
+                                        plan=plan,
+                                        **arguments)
+
+    return process
+
+
+def setup_process_message(messages_source):
+    try:
+        from frontend_digitizers_calibration.stream import process_message
+    except ImportError as e:
+        raise CaseSkipped("stream not available: %s" % e)
+
+    ioc_host_config = load_ioc_host_config()
+    devices = ioc_host_config[config.CONFIG_SECTION_DEVICES]
+    frequency_value_name = ioc_host_config[config.CONFIG_SECTION_FREQUENCY]
+    calibration_manager = load_calibration_manager(ioc_host_config)
+
+    device_plans = compile_device_plans(devices, device_type_processing_function_mapping)
+    device_buffers = allocate_device_buffers(devices, config.DEFAULT_OUTPUT_BUFFER_SETS)
+    next_message = cycle(messages_source(ioc_host_config))
+
+    return lambda: process_message(next_message(), devices, frequency_value_name, calibration_manager,
+                                   device_buffers=device_buffers, device_plans=device_plans)
+
+
+# name: (setup function returning the function to measure, number of calls)
+BENCHMARK_CASES = OrderedDict([
+    ("vcal_load", (setup_vcal_load, 200)),
+    ("vcal_load_cached", (setup_vcal_load_cached, 200)),
+    ("calibrate", (setup_calibrate, 5000)),
+    ("find_minmax", (setup_find_minmax, 2000)),
+    ("calibrate_channel", (setup_calibrate_channel, 2000)),
+    ("calibrate_channels_numpy", (lambda: setup_calibrate_channels(False), 2000)),
+    ("calibrate_channels_fused", (lambda: setup_calibrate_channels(True), 2000)),
+    ("process_pbps", (lambda: setup_device_processing("pbps", generate_synthetic_messages), 2000)),
+    ("process_pbpg", (lambda: setup_device_processing("pbpg", generate_synthetic_messages), 2000)),
+    ("process_single_channel", (lambda: setup_device_processing("single_channel", generate_synthetic_messages),
+                                2000)),
+    ("process_pbps_dump", (lambda: setup_device_processing("pbps", load_dump_messages), 2000)),
+    ("process_message", (lambda: setup_process_message(generate_synthetic_messages), 2000)),
+    ("process_message_dump", (lambda: setup_process_message(load_dump_messages), 2000)),
+])
+
+
+def measure(function, n_calls, n_repeat=DEFAULT_N_REPEAT, n_warmup=10):
+    """
+    Measure the latency of each call of the function. The calls are repeated n_repeat times and the median of each
+    metric over the repetitions is reported, so the results are less affected by the other load on the machine.
+    :return: Dictionary with the metrics of the calls.
+    """
+    for _ in range(min(n_warmup, n_calls)):
+        function()
+
+    latencies = numpy.empty(n_calls, dtype=numpy.float64)
+    # [pulses/s, p50, p99] of each repetition.
+    repetitions = numpy.empty((n_repeat, 3), dtype=numpy.float64)
+
+    for repetition in range(n_repeat):
+        start_time = time.perf_counter()
+        for index in range(n_calls):
+            call_start_time = time.perf_counter()
+            function()
+            latencies[index] = time.perf_counter() - call_start_time
+        duration = time.perf_counter() - start_time
+
+        repetitions[repetition] = [n_calls / duration] + list(numpy.percentile(latencies, [50, 99]) * 1e6)
+
+    pulses_per_second, latency_p50, latency_p99 = numpy.median(repetitions, axis=0)
+
+    return OrderedDict([("n_calls", n_calls),
+                        ("pulses_per_second", round(float(pulses_per_second), 1)),
+                        ("latency_p50_us", round(float(latency_p50), 1)),
+                        ("latency_p99_us", round(float(latency_p99), 1)),
+                        ("peak_rss_kb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)])
+
+
+def run_case(name, n_calls=None):
+    """
+    Run a case in this process.
+    :return: Metrics of the case, or {"skipped": reason}.
+    """
+    setup, default_n_calls = BENCHMARK_CASES[name]
+
+    try:
+        function = setup()
+    except CaseSkipped as e:
+        return {"skipped": str(e)}
+
+    return measure(function, n_calls or default_n_calls)
+
+
+def run_case_in_process(name, n_calls=None):
+    """
+    Run a case in a new process, so the peak RSS is not shared with the other cases.
+    """
+    command = [sys.executable, "-m", "tests.benchmark", "--run-case", name]
+    if n_calls:
+        command += ["--n-calls", str(n_calls)]
+
+    output = subprocess.check_output(command, cwd=os.path.dirname(CURRENT_FOLDER))
+    return json.loads(output.decode(), object_pairs_hook=OrderedDict)
+
+
+def compare_results(results, baseline, tolerances=None):
+    """
+    Compare the results against the baseline.
+    :param results: Dictionary with case name: metrics.
+    :param baseline: Dictionary with case name: metrics of the baseline.
+    :param tolerances: Relative change tolerated for each metric, DEFAULT_TOLERANCES if None.
+    :return: List of the regressions and of the measured cases without baseline numbers, as messages.
+    """
+    tolerances = tolerances or DEFAULT_TOLERANCES
+    regressions = []
+
+    for name, metrics in results.items():
+        if "skipped" in metrics:
+            continue
+
+        # A case measured now but not in the baseline would never be checked - the baseline has to be updated.
+        if name not in baseline:
+            regressions.append("%s: not in the baseline" % name)
+        elif "skipped" in baseline[name]:
+            regressions.append("%s: skipped in the baseline (%s)" % (name, baseline[name]["skipped"]))
+
+    for name, baseline_metrics in baseline.items():
+        metrics = results.get(name)
+
+        if metrics is None or "skipped" in metrics or "skipped" in baseline_metrics:
+            continue
+
+        for metric, higher_is_better in METRICS.items():
+            if metric not in baseline_metrics:
+                continue
+
+            value, baseline_value = metrics[metric], baseline_metrics[metric]
+            tolerance = tolerances.get(metric, 0)
+
+            if higher_is_better:
+                regressed = value < baseline_value * (1 - tolerance)
+            else:
+                regressed = value > baseline_value * (1 + tolerance)
+
+            if regressed:
+                regressions.append("%s %s: %.1f, baseline %.1f (tolerance %d%%)" % (
+                    name, metric, value, baseline_value, tolerance * 100))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the calibration pipeline.")
+    parser.add_argument("--case", action="append", choices=list(BENCHMARK_CASES),
+                        help="Case to run, can be given many times. All cases by default.")
+    parser.add_argument("--n-calls", type=int, help="Number of calls of each case, instead of the case default.")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline to compare the results against.")
+    parser.add_argument("--output", help="File to write the JSON results to.")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the baseline.")
+    parser.add_argument("--run-case", choices=list(BENCHMARK_CASES), help=argparse.SUPPRESS)
+
+    arguments = parser.parse_args()
+
+    if arguments.run_case:
+        print(json.dumps(run_case(arguments.run_case, arguments.n_calls)))
+        return
+
+    results = OrderedDict()
+    for name in arguments.case or BENCHMARK_CASES:
+        results[name] = run_case_in_process(name, arguments.n_calls)
+        print("%-24s %s" % (name, json.dumps(results[name])), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            output_file.write(output)
+
+    if arguments.update_baseline:
+        baseline = {"tolerances": DEFAULT_TOLERANCES, "cases": results}
+
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+
+        print("Baseline stored in '%s'." % arguments.baseline, file=sys.stderr)
+        return
+
+    if not os.path.exists(arguments.baseline):
+        print("No baseline '%s' to compare against." % arguments.baseline, file=sys.stderr)
+        return
+
+    with open(arguments.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = compare_results(results, baseline["cases"], baseline.get("tolerances"))
+
+    if regressions:
+        print("PERFORMANCE REGRESSION against '%s':" % arguments.baseline, file=sys.stderr)
+        for regression in regressions:
+            print("    " + regression, file=sys.stderr)
+
+        sys.exit(1)
+
+    print("No regressions against '%s'." % arguments.baseline, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+class FakeClock(object):
+    """
+    Clock to pass instead of time.monotonic, its time is set by the test. Kept out of tests.utils, so the tests using
+    it do not need bsread.
+    """
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
@@ -0,0 +1,62 @@
+import os
+import tracemalloc
+
+import numpy
+
+from frontend_digitizers_calibration.buffers import CalibrationBuffers
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.utils import calibrate_channels, DevicePlan
+from tests.test_buffers import CalibrationData, generate_message
+
+
+def measure_allocations(function, n_measurements):
+    # Warm up, so the one time allocations (caches, lazy initializations) are not counted.
+    function()
+
+    tracemalloc.start()
+    start_size, _ = tracemalloc.get_traced_memory()
+    snapshot_before = tracemalloc.take_snapshot()
+
+    for _ in range(n_measurements):
+        function()
+
+    snapshot_after = tracemalloc.take_snapshot()
+    _, peak_size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Peak memory allocated while processing a pulse, and memory not freed after all the pulses.
+    retained = sum(stat.size_diff for stat in snapshot_after.compare_to(snapshot_before, "filename"))
+
+    return peak_size - start_size, retained
+
+
+def main():
+    n_channels = 4
+    n_measurements = 1000
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+
+    channels_definition = [{"pv_prefix": "channel%d" % index, "channel_number": index}
+                           for index in range(n_channels)]
+    message = generate_message(numpy.random.RandomState(0), channels_definition)
+
+    tcal = TimeCalibration()
+    tcal.load_default(5120)
+    calibration_data = CalibrationData(VoltageCalibration(current_folder + "/data/configs/wd135-5120.vcal"), tcal)
+
+    buffers = CalibrationBuffers(n_channels)
+    plan = DevicePlan("device", {}, channels_definition=channels_definition)
+
+    def allocating():
+        calibrate_channels(message, {}, channels_definition, calibration_data)
+
+    def preallocated():
+        calibrate_channels(message, {}, channels_definition, calibration_data, buffers=buffers, plan=plan)
+
+    for name, function in [("allocating", allocating), ("preallocated", preallocated)]:
+        peak_size, retained = measure_allocations(function, n_measurements)
+        print("%-12s peak allocated: %8d bytes, retained after %d pulses: %8d bytes" % (
+            name, peak_size, n_measurements, retained))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+from timeit import timeit
+
+import numpy
+
+from frontend_digitizers_calibration.buffers import CalibrationBuffers
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.utils import calibrate_channels
+from tests.test_buffers import CalibrationData, generate_message
+
+
+def main():
+    n_channels = 4
+    n_measurements = 5000
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+
+    channels_definition = [{"pv_prefix": "channel%d" % index, "channel_number": index}
+                           for index in range(n_channels)]
+    signal_message = generate_message(numpy.random.RandomState(0), channels_definition)
+    background_message = generate_message(numpy.random.RandomState(0), channels_definition, background=True)
+
+    tcal = TimeCalibration()
+    tcal.load_default(5120)
+    calibration_data = CalibrationData(VoltageCalibration(current_folder + "/data/configs/wd135-5120.vcal"), tcal)
+
+    buffers = CalibrationBuffers(n_channels)
+
+    def signal():
+        calibrate_channels(signal_message, {}, channels_definition, calibration_data, buffers=buffers)
+
+    def separate_calls():
+        # The background waveforms calibrated with a second call, as a second set of channels.
+        calibrate_channels(signal_message, {}, channels_definition, calibration_data, buffers=buffers)
+        calibrate_channels(signal_message, {}, channels_definition, calibration_data, buffers=buffers)
+
+    def batched():
+        calibrate_channels(background_message, {}, channels_definition, calibration_data, buffers=buffers)
+
+    # Warm up the time axis cache.
+    batched()
+
+    durations = [(name, timeit(function, number=n_measurements))
+                 for name, function in [("signal only", signal), ("two calls", separate_calls), ("batched", batched)]]
+
+    for name, duration in durations:
+        print("%-12s %8.1f us per message (%.2f x signal only)" % (
+            name, duration / n_measurements * 1e6, duration / durations[0][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import os
+from timeit import timeit
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.mapping import compile_device_plans
+from tests.test_buffers import CalibrationData, generate_message
+
+
+def process(message, device_plans, calibration_data, devices=None):
+    # Without precompiled plans, the plans are compiled for each message - as the keys were built before.
+    if device_plans is None:
+        device_plans = compile_device_plans(devices)
+
+    for device_name, plan in device_plans.items():
+        plan.processing_function(message=message,
+                                 device_name=device_name,
+                                 device_definition=plan.device_definition,
+                                 channels_definition=plan.channels_definition,
+                                 calibration_data=calibration_data,
+                                 plan=plan)
+
+
+def main():
+    n_devices = 8
+    n_measurements = 2000
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+
+    devices = {}
+    for device_index in range(n_devices):
+        devices["device%d-" % device_index] = {
+            "device_type": "pbps",
+            "x_scaling_offset": 0,
+            "y_scaling_offset": 0,
+            "x_scaling_factor": 1,
+            "y_scaling_factor": 1,
+            "channels": [{"pv_prefix": "device%d-channel%d" % (device_index, index), "channel_number": index}
+                         for index in range(4)]}
+
+    channels_definition = [channel for device_definition in devices.values()
+                           for channel in device_definition[config.CONFIG_DEVICE_CHANNELS]]
+    message = generate_message(numpy.random.RandomState(0), channels_definition)
+
+    tcal = TimeCalibration()
+    tcal.load_default(5120)
+    calibration_data = CalibrationData(VoltageCalibration(current_folder + "/data/configs/wd135-5120.vcal"), tcal)
+
+    device_plans = compile_device_plans(devices)
+
+    for name, plans in [("per message", None), ("precompiled", device_plans)]:
+        duration = timeit(lambda: process(message, plans, calibration_data, devices), number=n_measurements)
+        print("%-12s %8.1f us per message (%d devices)" % (name, duration / n_measurements * 1e6, n_devices))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ def mock_notify_epics(data):
 import frontend_digitizers_calibration.utils
 frontend_digitizers_calibration.utils.notify_epics = mock_notify_epics
 
-from frontend_digitizers_calibration.devices.utils import calibrate_channel
+from frontend_digitizers_calibration.devices.utils import calibrate_channels
 from frontend_digitizers_calibration.calibration import VoltageCalibration
 from frontend_digitizers_calibration.devices.pbps import process_pbps
 from tests.utils import generate_test_message, generate_test_channels_definition
@@ -37,8 +37,8 @@ def main():
 
     profiler = LineProfiler()
     process_pbps_wrapper = profiler(process_pbps)
-    profiler.add_function(calibrate_channel)
-    profiler.add_function(calibration_data.calibrate)
+    profiler.add_function(calibrate_channels)
+    profiler.add_function(calibration_data.calibrate_many)
 
     for _ in range(n_measurements):
         process_pbps_wrapper(message, device_name, device_definition, channels_definition, calibration_data)
@@ -0,0 +1,50 @@
+import os
+from timeit import timeit
+
+import numpy
+
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.pbps import process_pbps, process_pbps_batch
+from frontend_digitizers_calibration.devices.utils import DevicePlan
+from frontend_digitizers_calibration.recalibration import stack_messages
+from tests.test_buffers import CalibrationData, generate_message
+
+
+def main():
+    n_pulses = 1000
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+
+    device_definition = {"device_type": "pbps",
+                         "x_scaling_offset": 0,
+                         "y_scaling_offset": 0,
+                         "x_scaling_factor": 1,
+                         "y_scaling_factor": 1,
+                         "channels": [{"pv_prefix": "channel%d" % index, "channel_number": index}
+                                      for index in range(4)]}
+    channels_definition = device_definition["channels"]
+
+    random_state = numpy.random.RandomState(0)
+    messages = [generate_message(random_state, channels_definition, background=True) for _ in range(n_pulses)]
+    batch = stack_messages([(pulse_id, {name: value.value for name, value in message.data.data.items()})
+                            for pulse_id, message in enumerate(messages)])
+
+    tcal = TimeCalibration()
+    tcal.load_default(5120)
+    calibration_data = CalibrationData(VoltageCalibration(current_folder + "/data/configs/wd135-5120.vcal"), tcal)
+
+    plan = DevicePlan("device-", device_definition)
+
+    def per_pulse():
+        for message in messages:
+            process_pbps(message, "device-", device_definition, channels_definition, calibration_data, plan=plan)
+
+    def batched():
+        process_pbps_batch(batch, "device-", device_definition, channels_definition, calibration_data, plan=plan)
+
+    for name, function in [("per pulse", per_pulse), ("batched", batched)]:
+        duration = timeit(function, number=3) / 3
+        print("%-10s %8.0f pulses/s" % (name, n_pulses / duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.buffers import CalibrationBuffers
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.utils import calibrate_channels, calibrate_channels_batch, DevicePlan, \
+    SUFFIX_CHANNEL_BG_DATA_SUM, SUFFIX_CHANNEL_BG_DATA_CALIBRATED, SUFFIX_CHANNEL_BG_DATA_MIN, \
+    SUFFIX_CHANNEL_BG_DATA_MAX, SUFFIX_CHANNEL_BG_TIME_AXIS, SUFFIX_CHANNEL_DATA_SUM, SUFFIX_CHANNEL_DATA_CALIBRATED, SUFFIX_CHANNEL_DATA_MIN, \
+    SUFFIX_CHANNEL_DATA_MAX, SUFFIX_CHANNEL_TIME_AXIS
+from frontend_digitizers_calibration.recalibration import stack_messages
+from frontend_digitizers_calibration.workers import WorkerMessage
+from tests.test_buffers import CalibrationData, generate_message
+
+# Background output: the signal output it has to be equal to, for the background waveform.
+BACKGROUND_SUFFIXES = {SUFFIX_CHANNEL_BG_DATA_SUM: SUFFIX_CHANNEL_DATA_SUM,
+                       SUFFIX_CHANNEL_BG_DATA_CALIBRATED: SUFFIX_CHANNEL_DATA_CALIBRATED,
+                       SUFFIX_CHANNEL_BG_DATA_MIN: SUFFIX_CHANNEL_DATA_MIN,
+                       SUFFIX_CHANNEL_BG_DATA_MAX: SUFFIX_CHANNEL_DATA_MAX,
+                       SUFFIX_CHANNEL_BG_TIME_AXIS: SUFFIX_CHANNEL_TIME_AXIS}
+
+
+class TestBackground(unittest.TestCase):
+    def setUp(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+
+        tcal = TimeCalibration()
+        tcal.load_default(5120)
+        self.calibration_data = CalibrationData(VoltageCalibration(os.path.join(current_folder,
+                                                                                "data/configs/wd135-5120.vcal")),
+                                                tcal)
+
+        self.channels_definition = [{config.CONFIG_CHANNEL_PV_PREFIX: "channel%d" % index,
+                                     config.CONFIG_CHANNEL_NUMBER: index} for index in range(4)]
+
+    @staticmethod
+    def get_signal_message(message):
+        # Message without the background waveforms.
+        return WorkerMessage(message.data.pulse_id, {name: value.value for name, value in message.data.data.items()
+                                                     if "-BG-" not in name})
+
+    def get_background_message(self, message):
+        # Message with the background waveforms as signal waveforms.
+        values = {name: value.value for name, value in message.data.data.items()}
+
+        for channel in self.channels_definition:
+            pv_prefix = channel[config.CONFIG_CHANNEL_PV_PREFIX]
+            values[pv_prefix + "-DATA"] = values.pop(pv_prefix + "-BG-DATA")
+            values[pv_prefix + "-DRS_TC"] = values.pop(pv_prefix + "-BG-DRS_TC")
+
+        return WorkerMessage(message.data.pulse_id, values)
+
+    def test_background(self):
+        random_state = numpy.random.RandomState(0)
+        buffers = CalibrationBuffers(len(self.channels_definition), n_sets=2)
+
+        for _ in range(3):
+            message = generate_message(random_state, self.channels_definition, background=True)
+
+            signal = calibrate_channels(self.get_signal_message(message), {}, self.channels_definition, self.calibration_data)
+            background = calibrate_channels(self.get_background_message(message), {}, self.channels_definition,
+                                            self.calibration_data)
+            calibrated = calibrate_channels(message, {}, self.channels_definition, self.calibration_data)
+            calibrated_in_place = calibrate_channels(message, {}, self.channels_definition, self.calibration_data,
+                                                     buffers=buffers)
+
+            for result in (calibrated, calibrated_in_place):
+                self.assertEqual(len(signal) + len(background) - len(self.channels_definition), len(result))
+
+                for channel in self.channels_definition:
+                    pv_prefix = channel[config.CONFIG_CHANNEL_PV_PREFIX]
+
+                    for background_suffix, suffix in BACKGROUND_SUFFIXES.items():
+                        numpy.testing.assert_array_equal(background[pv_prefix + suffix],
+                                                         result[pv_prefix + background_suffix])
+                        numpy.testing.assert_array_equal(signal[pv_prefix + suffix], result[pv_prefix + suffix])
+
+    def test_no_background(self):
+        message = generate_message(numpy.random.RandomState(0), self.channels_definition)
+
+        result = calibrate_channels(message, {}, self.channels_definition, self.calibration_data)
+
+        self.assertFalse([name for name in result if "-BG-" in name])
+
+    def test_background_without_trigger_cell(self):
+        message = generate_message(numpy.random.RandomState(0), self.channels_definition, background=True)
+        # Background waveform, but not its trigger cell - calibrated without the background.
+        message = WorkerMessage(message.data.pulse_id, {name: value.value for name, value in message.data.data.items()
+                                                        if not name.endswith("-BG-DRS_TC")})
+
+        result = calibrate_channels(message, {}, self.channels_definition, self.calibration_data)
+        self.assertFalse([name for name in result if "-BG-" in name])
+        numpy.testing.assert_array_equal(
+            calibrate_channels(self.get_signal_message(message), {}, self.channels_definition,
+                               self.calibration_data)["channel0" + SUFFIX_CHANNEL_DATA_SUM],
+            result["channel0" + SUFFIX_CHANNEL_DATA_SUM])
+
+        plan = DevicePlan("device", {config.CONFIG_DEVICE_CHANNELS: self.channels_definition})
+        result = calibrate_channels_batch(stack_messages([WorkerMessage.get_values(message)] * 2), {}, self.calibration_data, plan)
+        self.assertFalse([name for name in result if "-BG-" in name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from tests.benchmark import compare_results, run_case, METRICS
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.baseline = {"calibrate": {"pulses_per_second": 1000.0,
+                                       "latency_p50_us": 100.0,
+                                       "latency_p99_us": 200.0,
+                                       "peak_rss_kb": 40000},
+                         "process_message": {"skipped": "stream not available"}}
+
+        self.tolerances = {"pulses_per_second": 0.2, "latency_p50_us": 0.2, "latency_p99_us": 0.5,
+                           "peak_rss_kb": 0.1}
+
+    def test_no_regression(self):
+        results = {"calibrate": {"pulses_per_second": 850.0,
+                                 "latency_p50_us": 110.0,
+                                 "latency_p99_us": 290.0,
+                                 "peak_rss_kb": 30000},
+                   "process_message": {"skipped": "stream not available"}}
+
+        self.assertEqual(compare_results(results, self.baseline, self.tolerances), [])
+
+    def test_regressions(self):
+        results = {"calibrate": {"pulses_per_second": 700.0,
+                                 "latency_p50_us": 130.0,
+                                 "latency_p99_us": 310.0,
+                                 "peak_rss_kb": 45000}}
+
+        regressions = compare_results(results, self.baseline, self.tolerances)
+
+        self.assertEqual(len(regressions), 4)
+        for regression, metric in zip(regressions, METRICS):
+            self.assertTrue(regression.startswith("calibrate " + metric))
+
+    def test_missing_case(self):
+        self.assertEqual(compare_results({}, self.baseline, self.tolerances), [])
+
+    def test_missing_baseline(self):
+        results = {"process_message": {"pulses_per_second": 1.0},
+                   "process_message_dump": {"pulses_per_second": 1.0}}
+
+        regressions = compare_results(results, self.baseline, self.tolerances)
+
+        self.assertListEqual(["process_message: skipped in the baseline (stream not available)",
+                              "process_message_dump: not in the baseline"], regressions)
+
+    def test_run_case(self):
+        metrics = run_case("find_minmax", n_calls=5)
+
+        self.assertEqual(metrics["n_calls"], 5)
+        for metric in METRICS:
+            self.assertGreater(metrics[metric], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.buffers import CalibrationBuffers, allocate_device_buffers
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration, WD_N_CHANNELS, \
+    WD_N_CELLS
+from frontend_digitizers_calibration.devices.utils import calibrate_channels
+from frontend_digitizers_calibration.workers import WorkerMessage
+
+
+class CalibrationData(object):
+    def __init__(self, vcal, tcal):
+        self.vcal = vcal
+        self.tcal = tcal
+
+
+def generate_message(random_state, channels_definition, background=False):
+    values = {}
+
+    for channel in channels_definition:
+        pv_prefix = channel[config.CONFIG_CHANNEL_PV_PREFIX]
+
+        values[pv_prefix + "-DATA"] = random_state.randint(1800, 2300, WD_N_CELLS).astype(">i2")
+        values[pv_prefix + "-DRS_TC"] = random_state.randint(0, WD_N_CELLS)
+        values[pv_prefix + "-WD-gain-RBa"] = random_state.randint(0, 16)
+        values[pv_prefix + "-ROI_sig_min"] = 100
+        values[pv_prefix + "-ROI_sig_max"] = 300
+        values[pv_prefix + "-ROI_bg_min"] = 0
+        values[pv_prefix + "-ROI_bg_max"] = 90
+
+        if background:
+            values[pv_prefix + "-BG-DATA"] = random_state.randint(1900, 2000, WD_N_CELLS).astype(">i2")
+            values[pv_prefix + "-BG-DRS_TC"] = random_state.randint(0, WD_N_CELLS)
+
+    return WorkerMessage(0, values)
+
+
+class TestBuffers(unittest.TestCase):
+    def setUp(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+
+        tcal = TimeCalibration()
+        tcal.load_default(5120)
+        self.calibration_data = CalibrationData(VoltageCalibration(os.path.join(current_folder,
+                                                                                "data/configs/wd135-5120.vcal")),
+                                                tcal)
+
+        self.channels_definition = [{config.CONFIG_CHANNEL_PV_PREFIX: "channel%d" % index,
+                                     config.CONFIG_CHANNEL_NUMBER: index} for index in range(4)]
+
+    def test_calibrate_many_in_place(self):
+        random_state = numpy.random.RandomState(0)
+        vcal = self.calibration_data.vcal
+
+        n_waveforms = 6
+        data = (random_state.randint(1700, 2300, (n_waveforms, WD_N_CELLS)).astype(numpy.float32) - 2048) / 4096
+        trigger_cells = random_state.randint(0, WD_N_CELLS, n_waveforms).astype(numpy.int32)
+        channels = random_state.randint(0, WD_N_CHANNELS, n_waveforms).astype(numpy.int32)
+
+        expected = vcal.calibrate_many(data.copy(), trigger_cells, channels)
+        calibrated = vcal.calibrate_many(data.copy(), trigger_cells, channels,
+                                         workspace=CalibrationBuffers(n_waveforms))
+
+        numpy.testing.assert_array_equal(expected, calibrated)
+
+    def test_calibrate_channels(self):
+        random_state = numpy.random.RandomState(1)
+        buffers = CalibrationBuffers(len(self.channels_definition), n_sets=2)
+
+        outputs = []
+
+        for _ in range(3):
+            message = generate_message(random_state, self.channels_definition)
+
+            expected = calibrate_channels(message, {}, self.channels_definition, self.calibration_data)
+            calibrated = calibrate_channels(message, {}, self.channels_definition, self.calibration_data,
+                                            buffers=buffers)
+
+            self.assertListEqual(sorted(expected.keys()), sorted(calibrated.keys()))
+            for name, value in expected.items():
+                numpy.testing.assert_array_equal(value, calibrated[name])
+
+            outputs.append(calibrated["channel0-DATA-CALIBRATED"])
+
+        # The output arrays are used in rotation.
+        self.assertFalse(numpy.shares_memory(outputs[0], outputs[1]))
+        self.assertTrue(numpy.shares_memory(outputs[0], outputs[2]))
+
+    def test_allocate_device_buffers(self):
+        devices = {"device": {config.CONFIG_DEVICE_CHANNELS: self.channels_definition}}
+
+        self.assertIsNone(allocate_device_buffers(devices, 0))
+        self.assertEqual(4, allocate_device_buffers(devices, 3)["device"].n_channels)
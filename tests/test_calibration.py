@@ -0,0 +1,278 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from time import sleep
+from unittest import mock
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration, CalibrationManager, \
+    WD_N_CHANNELS, WD_N_CELLS, precompile_calibrations
+from frontend_digitizers_calibration.calibration_cache import PRECOMPILED_FORMAT_VERSION
+
+
+class TestVoltageCalibration(unittest.TestCase):
+    def setUp(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+        self.calibration = VoltageCalibration(os.path.join(current_folder, "data/configs/wd135-5120.vcal"))
+
+    @staticmethod
+    def reference_calibrate(calibration, data, trigger_cell, channel):
+        # Original implementation, with the calibration rotated by the trigger cell.
+        data -= numpy.roll(calibration.wf_offset1[channel], -trigger_cell)
+        data -= calibration.wf_offset2[channel]
+
+        msk_gtz = data > 0
+        gain_correction = numpy.copy(numpy.roll(calibration.wf_gain2[channel], -trigger_cell))
+        gain_correction[msk_gtz] = numpy.roll(calibration.wf_gain1[channel], -trigger_cell)[msk_gtz]
+        data /= gain_correction
+
+        return data
+
+    def test_calibrate(self):
+        self.assertTrue(self.calibration.valid)
+
+        random_state = numpy.random.RandomState(0)
+
+        for channel_number in range(WD_N_CHANNELS):
+            for trigger_cell in [0, 1, 134, 512, WD_N_CELLS - 1]:
+                raw_data = random_state.randint(1700, 2300, WD_N_CELLS)
+                data = (raw_data.astype(numpy.float32) - 2048) / 4096
+
+                expected = self.reference_calibrate(self.calibration, data.copy(), trigger_cell, channel_number)
+                calibrated = self.calibration.calibrate(data.copy(), trigger_cell, channel_number)
+
+                numpy.testing.assert_array_equal(expected, calibrated)
+
+    def test_calibrate_many(self):
+        random_state = numpy.random.RandomState(1)
+
+        n_waveforms = 8
+        raw_data = random_state.randint(1700, 2300, (n_waveforms, WD_N_CELLS))
+        data = (raw_data.astype(numpy.float32) - 2048) / 4096
+        trigger_cells = random_state.randint(0, WD_N_CELLS, n_waveforms)
+        channels = random_state.randint(0, WD_N_CHANNELS, n_waveforms)
+
+        calibrated = self.calibration.calibrate_many(data.copy(), trigger_cells, channels)
+
+        for index in range(n_waveforms):
+            expected = self.calibration.calibrate(data[index].copy(), trigger_cells[index], channels[index])
+            numpy.testing.assert_array_equal(expected, calibrated[index])
+
+    def test_cache_folder(self):
+        cache_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_folder)
+
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+        filename = os.path.join(current_folder, "data/configs/wd135-5120.vcal")
+
+        # The first load stores the derived tables, the second one maps them.
+        VoltageCalibration(filename, cache_folder)
+        self.assertEqual(1, len(os.listdir(cache_folder)))
+        cached_calibration = VoltageCalibration(filename, cache_folder)
+
+        numpy.testing.assert_array_equal(self.calibration.doubled_wf_offset1, cached_calibration.doubled_wf_offset1)
+        numpy.testing.assert_array_equal(self.calibration.doubled_wf_gain1, cached_calibration.doubled_wf_gain1)
+        numpy.testing.assert_array_equal(self.calibration.doubled_wf_gain2, cached_calibration.doubled_wf_gain2)
+
+    def test_precompiled(self):
+        cache_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_folder)
+
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+        config_folder = os.path.join(current_folder, "data/configs")
+
+        n_precompiled, invalid_files = precompile_calibrations({"frequency_mapping": {"5120": "wd135-5120.vcal",
+                                                                                      "2560": "missing.vcal"}},
+                                                               config_folder, cache_folder)
+        self.assertEqual(1, n_precompiled)
+        self.assertListEqual([os.path.join(config_folder, "missing.vcal")], invalid_files)
+
+        precompiled_file, = [os.path.join(cache_folder, name) for name in os.listdir(cache_folder)]
+        self.assertTrue(precompiled_file.endswith(".precompiled-v%d.npy" % PRECOMPILED_FORMAT_VERSION))
+
+        # All the tables are views of the precompiled file.
+        cached_calibration = VoltageCalibration(os.path.join(config_folder, "wd135-5120.vcal"), cache_folder)
+        for table in (cached_calibration.doubled_wf_offset1, cached_calibration.wf_offset2,
+                      cached_calibration.wf_gain1):
+            self.assertEqual(precompiled_file, table.base.filename)
+
+        numpy.testing.assert_array_equal(self.calibration.doubled_wf_gain1, cached_calibration.doubled_wf_gain1)
+        numpy.testing.assert_array_equal(self.calibration.wf_offset2, cached_calibration.wf_offset2)
+        self.assertEqual(self.calibration.sampling_frequency, cached_calibration.sampling_frequency)
+
+        # A precompiled file of another format is replaced.
+        precompiled = numpy.load(precompiled_file)
+        precompiled["format_version"] = PRECOMPILED_FORMAT_VERSION + 1
+        numpy.save(precompiled_file, precompiled)
+
+        with self.assertLogs("frontend_digitizers_calibration.calibration_cache", "WARNING"):
+            cached_calibration = VoltageCalibration(os.path.join(config_folder, "wd135-5120.vcal"), cache_folder)
+
+        self.assertTrue(cached_calibration.valid)
+        self.assertEqual(PRECOMPILED_FORMAT_VERSION, numpy.load(precompiled_file)["format_version"][0])
+
+    def write_crc_file(self, crc_function):
+        """
+        Copy of the test calibration file with a CRC set - the crc field of the test file is 0, not set.
+        :param crc_function: Function of the file content with the crc field zeroed, returning the CRC to store.
+        """
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(current_folder, "data/configs/wd135-5120.vcal"), "rb") as file:
+            content = bytearray(file.read())
+
+        self.assertEqual(bytes(4), content[4:8])
+        content[4:8] = (crc_function(bytes(content)) & 0xffffffff).to_bytes(4, "little")
+        self.assertNotEqual(bytes(4), content[4:8])
+
+        filename = os.path.join(folder, "crc.vcal")
+        with open(filename, "wb") as file:
+            file.write(content)
+
+        return filename, content
+
+    def test_crc(self):
+        # The CRC32 of the file with the crc field zeroed.
+        filename, content = self.write_crc_file(zlib.crc32)
+        folder = os.path.dirname(filename)
+
+        with mock.patch.object(config, "CALIBRATION_CRC_CHECK", config.CALIBRATION_CRC_CHECK_STRICT):
+            self.assertTrue(VoltageCalibration(filename).valid)
+
+            # Corrupt a gain.
+            content[-1000] ^= 1
+            with open(filename, "wb") as file:
+                file.write(content)
+
+            self.assertFalse(VoltageCalibration(filename).valid)
+            self.assertFalse(VoltageCalibration(filename, folder).valid)
+
+        with mock.patch.object(config, "CALIBRATION_CRC_CHECK", config.CALIBRATION_CRC_CHECK_OFF):
+            self.assertTrue(VoltageCalibration(filename).valid)
+
+        # Only logged by default.
+        with self.assertLogs("frontend_digitizers_calibration.calibration_cache", "WARNING") as logs:
+            self.assertTrue(VoltageCalibration(filename).valid)
+        self.assertIn("does not match its CRC", logs.output[0])
+
+    def test_crc_convention(self):
+        # The CRC32 of the content following the crc field is not accepted.
+        filename, _ = self.write_crc_file(lambda content: zlib.crc32(content[8:]))
+
+        with mock.patch.object(config, "CALIBRATION_CRC_CHECK", config.CALIBRATION_CRC_CHECK_STRICT):
+            self.assertFalse(VoltageCalibration(filename).valid)
+
+
+class TestTimeCalibration(unittest.TestCase):
+    def test_default_time_axis(self):
+        time_calibration = TimeCalibration()
+        time_calibration.load_default(5120)
+
+        # The sampling is uniform, so all channels and trigger cells share the same time axis.
+        expected = numpy.arange(WD_N_CELLS, dtype=numpy.float32) * numpy.float32(1e3 / 5120)
+        numpy.testing.assert_allclose(expected, time_calibration.get_time_axis(0, 0), rtol=1e-6)
+
+        self.assertIs(time_calibration.get_time_axis(0, 0),
+                      time_calibration.get_time_axis(WD_N_CELLS - 1, WD_N_CHANNELS - 1))
+        self.assertEqual((0.0, 1e3 / 5120), time_calibration.get_time_axis_descriptor())
+
+    def test_time_axis(self):
+        cache_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_folder)
+
+        random_state = numpy.random.RandomState(0)
+        binary_data = numpy.zeros(1, dtype=TimeCalibration.TimeCalibrationBinaryData)
+        binary_data["version_id"] = b"CAL2"
+        binary_data["sampling_frequency"] = 5120
+        binary_data["dt"] = 1 / 5.12e9 * (1 + 0.1 * random_state.normal(size=(WD_N_CHANNELS, WD_N_CELLS)))
+
+        filename = os.path.join(cache_folder, "test.tcal")
+        binary_data.tofile(filename)
+
+        time_calibration = TimeCalibration(filename, time_axis_cache_size=2)
+        cached_time_calibration = TimeCalibration(filename, cache_folder)
+        self.assertTrue(time_calibration.valid)
+        self.assertIsNone(time_calibration.get_time_axis_descriptor())
+
+        dt = binary_data["dt"][0]
+
+        for channel_number in [0, WD_N_CHANNELS - 1]:
+            for trigger_cell in [0, 134, WD_N_CELLS - 1]:
+                # Time axis starting at the trigger cell.
+                expected = numpy.cumsum(numpy.roll(dt[channel_number], -trigger_cell)[:-1], dtype=numpy.float64)
+                expected = numpy.insert(expected, 0, 0) * 1e9
+
+                numpy.testing.assert_allclose(expected, time_calibration.get_time_axis(trigger_cell, channel_number),
+                                              rtol=1e-5, atol=1e-3)
+                numpy.testing.assert_array_equal(time_calibration.get_time_axis(trigger_cell, channel_number),
+                                                 cached_time_calibration.get_time_axis(trigger_cell, channel_number))
+
+        # Only the most recently used time axes are kept.
+        self.assertListEqual([(WD_N_CHANNELS - 1, 134), (WD_N_CHANNELS - 1, WD_N_CELLS - 1)],
+                             list(time_calibration.time_axes.keys()))
+
+
+class TestCalibrationManager(unittest.TestCase):
+    def setUp(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+        self.config_folder = os.path.join(current_folder, "data/configs/")
+        self.ioc_host_config = {"frequency_mapping": {"5120": "wd135-5120.vcal",
+                                                      "2560": "wd136-5120.vcal"}}
+
+    def test_cache(self):
+        calibration_manager = CalibrationManager(self.ioc_host_config, self.config_folder, cache_size=2)
+
+        self.assertTrue(calibration_manager.load_calibration_data(5120))
+        vcal_5120 = calibration_manager.vcal
+
+        self.assertTrue(calibration_manager.load_calibration_data(2560))
+        self.assertFalse(calibration_manager.load_calibration_data(1280))
+        self.assertListEqual([2560, 1280], list(calibration_manager.calibrations.keys()))
+
+        # 5120 was evicted and has to be loaded again.
+        self.assertTrue(calibration_manager.load_calibration_data(5120))
+        self.assertIsNot(vcal_5120, calibration_manager.vcal)
+        vcal_5120 = calibration_manager.vcal
+
+        # 2560 is still cached.
+        self.assertTrue(calibration_manager.load_calibration_data(2560))
+        self.assertTrue(calibration_manager.load_calibration_data(5120))
+        self.assertIs(vcal_5120, calibration_manager.vcal)
+
+    def test_preload(self):
+        calibration_manager = CalibrationManager(self.ioc_host_config, self.config_folder)
+        calibration_manager.preload_calibration_data()
+
+        self.assertListEqual([2560, 5120], list(calibration_manager.calibrations.keys()))
+
+    def test_concurrent_preload(self):
+        calibration_manager = CalibrationManager(self.ioc_host_config, self.config_folder, background_loading=True)
+        calibration_manager.start_preloading()
+
+        # The first message waits for the preloading instead of starting a background load.
+        self.assertTrue(calibration_manager.load_calibration_data(2560))
+        self.assertIsNone(calibration_manager.preloading_thread)
+        self.assertIsNone(calibration_manager.loading_frequency)
+        self.assertListEqual([5120, 2560], list(calibration_manager.calibrations.keys()))
+
+    def test_background_loading(self):
+        calibration_manager = CalibrationManager(self.ioc_host_config, self.config_folder, background_loading=True)
+
+        # The calibration is not available until it is loaded.
+        self.assertFalse(calibration_manager.load_calibration_data(5120))
+        self.assertEqual(5120, calibration_manager.loading_frequency)
+
+        for _ in range(100):
+            if calibration_manager.loading_frequency is None:
+                break
+            sleep(0.1)
+
+        self.assertIsNone(calibration_manager.loading_frequency)
+        self.assertTrue(calibration_manager.load_calibration_data(5120))
+        self.assertTrue(calibration_manager.vcal.valid)
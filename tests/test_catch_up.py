@@ -0,0 +1,55 @@
+import unittest
+
+from frontend_digitizers_calibration.catch_up import CatchUpPolicy, get_message_lag
+
+
+class MessageData(object):
+    def __init__(self, pulse_id, global_timestamp, global_timestamp_offset=0):
+        self.pulse_id = pulse_id
+        self.global_timestamp = global_timestamp
+        self.global_timestamp_offset = global_timestamp_offset
+        self.data = {}
+
+
+class Message(object):
+    def __init__(self, pulse_id, global_timestamp, global_timestamp_offset=0):
+        self.data = MessageData(pulse_id, global_timestamp, global_timestamp_offset)
+
+
+class TestCatchUp(unittest.TestCase):
+    def test_message_lag(self):
+        self.assertAlmostEqual(get_message_lag(Message(0, 100, 500000000), clock=lambda: 102.0), 1.5)
+        self.assertIsNone(get_message_lag(Message(0, 0), clock=lambda: 102.0))
+
+    def test_disabled(self):
+        policy = CatchUpPolicy()
+
+        self.assertFalse(policy.enabled)
+        self.assertFalse(policy.skip(Message(0, 1), queue_depth=1000))
+
+    def test_lag(self):
+        now = 1000.0
+        policy = CatchUpPolicy(max_lag=1.0, clock=lambda: now)
+
+        # Message timestamps lagging by: 0.5 s, then a backlog of 2 s draining down to 0.3 s.
+        lags = [0.5, 2.0, 1.5, 1.0, 0.7, 0.45, 0.3, 0.8]
+        skipped = [policy.skip(Message(pulse_id, now - lag)) for pulse_id, lag in enumerate(lags)]
+
+        # Catching up until the lag is below half of the maximum lag.
+        self.assertListEqual([False, True, True, True, True, False, False, False], skipped)
+        self.assertEqual(policy.n_skipped, 4)
+        self.assertEqual(policy.n_catch_ups, 1)
+        self.assertFalse(policy.catching_up)
+
+    def test_queue_depth(self):
+        policy = CatchUpPolicy(max_queue_depth=10)
+
+        depths = [5, 11, 8, 6, 5, 4, 11]
+        skipped = [policy.skip(Message(pulse_id, 0), queue_depth=depth) for pulse_id, depth in enumerate(depths)]
+
+        self.assertListEqual([False, True, True, True, False, False, True], skipped)
+        self.assertEqual(policy.get_statistics(), {"skipped": 4, "catch_ups": 2, "catching_up": True})
+
+
+if __name__ == '__main__':
+    unittest.main()
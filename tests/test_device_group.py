@@ -0,0 +1,115 @@
+import os
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.mapping import compile_device_plans, compile_device_group, \
+    device_type_parallel_processing_function_mapping, device_type_grouped_processing_function_mapping
+from frontend_digitizers_calibration.devices.utils import calculate_intensity_and_position, DevicePlan
+from tests.test_buffers import CalibrationData, generate_message
+
+NUMPY_VERSION = tuple(int(part) for part in numpy.__version__.split(".")[:2])
+
+
+class TestDeviceGroup(unittest.TestCase):
+    def setUp(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+
+        tcal = TimeCalibration()
+        tcal.load_default(5120)
+        self.calibration_data = CalibrationData(VoltageCalibration(os.path.join(current_folder,
+                                                                                "data/configs/wd135-5120.vcal")),
+                                                tcal)
+
+        def channels(first):
+            return [{config.CONFIG_CHANNEL_PV_PREFIX: "channel%d" % index,
+                     config.CONFIG_CHANNEL_NUMBER: index % 8} for index in range(first, first + 4)]
+
+        position = {"x_scaling_offset": 0.1, "y_scaling_offset": -0.1, "x_scaling_factor": 2, "y_scaling_factor": 3}
+
+        self.devices = {
+            "pbps1-": dict(position, device_type="pbps", channels=channels(0)),
+            "single-": {"device_type": "single_channel", "scaling_factor": 2, "scaling_offset": 1,
+                        "channels": channels(8)[:1]},
+            "pbpg-": dict(position, device_type="pbpg", channels=channels(4), keithley_intensity="keithley"),
+            "pbps2-": dict(position, device_type="pbps", channels=channels(12), x_scaling_factor=0.5)
+        }
+
+        channels_definition = [channel for device_definition in self.devices.values()
+                               for channel in device_definition[config.CONFIG_DEVICE_CHANNELS]]
+        self.message = generate_message(numpy.random.RandomState(0), channels_definition)
+
+    def process(self, device_plans):
+        data_to_send = {}
+
+        for device_name, plan in device_plans.items():
+            data_to_send.update(plan.processing_function(self.message, device_name, plan.device_definition,
+                                                         plan.channels_definition, self.calibration_data, plan=plan))
+
+        return data_to_send
+
+    def test_group(self):
+        expected = self.process(compile_device_plans(self.devices, device_type_parallel_processing_function_mapping))
+
+        device_plans = compile_device_plans(self.devices, device_type_grouped_processing_function_mapping)
+        device_group = compile_device_group(device_plans)
+
+        self.assertListEqual(["pbps1-", "pbpg-", "pbps2-"], device_group.device_names)
+        self.assertListEqual([1, 0.5, 1], device_group.intensity_scaling_factors.tolist())
+        self.assertListEqual([2, 2, 0.5], device_group.x_scaling_factors.tolist())
+
+        result = self.process(device_plans)
+        self.assertNotIn("pbps1-XPOS", result)
+
+        device_group.calculate(result)
+
+        self.assertSetEqual(set(expected), set(result))
+        for name in expected:
+            numpy.testing.assert_allclose(expected[name], result[name], rtol=1e-6, atol=1e-7, err_msg=name)
+
+    @unittest.skipIf(NUMPY_VERSION < (2, 0), "NumPy < 2 promotes the per-device calculation to float64.")
+    def test_group_float32(self):
+        # With the NEP 50 promotion of NumPy 2, the per-device calculation stays in float32 like the group.
+        expected = self.process(compile_device_plans(self.devices, device_type_parallel_processing_function_mapping))
+
+        device_plans = compile_device_plans(self.devices, device_type_grouped_processing_function_mapping)
+        result = compile_device_group(device_plans).calculate(self.process(device_plans))
+
+        for name in expected:
+            numpy.testing.assert_array_equal(expected[name], result[name], err_msg=name)
+
+    def test_no_group(self):
+        devices = {"single-": self.devices["single-"]}
+        device_plans = compile_device_plans(devices, device_type_grouped_processing_function_mapping)
+
+        self.assertIsNone(compile_device_group(device_plans))
+
+    def test_zero_sum(self):
+        device_plans = compile_device_plans(self.devices, device_type_grouped_processing_function_mapping)
+        device_group = compile_device_group(device_plans)
+
+        data_to_send = {}
+        for sum_keys in device_group.sum_keys:
+            data_to_send.update(zip(sum_keys, numpy.array([1, -1, 3, 1], dtype=numpy.float32)))
+
+        device_group.calculate(data_to_send)
+
+        for device_name in device_group.device_names:
+            self.assertTrue(numpy.isnan(data_to_send[device_name + "XPOS"]))
+            self.assertAlmostEqual(data_to_send[device_name + "YPOS"], 0.5 * 3 - 0.1, places=6)
+            self.assertEqual(data_to_send[device_name + "INTENSITY-X"], 0)
+
+        # The scalar calculation of a single device - with Python floats it used to raise ZeroDivisionError.
+        plan = DevicePlan("pbps1-", self.devices["pbps1-"])
+        data_to_send = {channel.data_sum: value for channel, value in zip(plan.channels, [1.0, -1.0, 3.0, 1.0])}
+
+        calculate_intensity_and_position(None, data_to_send, None, "pbps1-", self.devices["pbps1-"], plan=plan)
+
+        self.assertTrue(numpy.isnan(data_to_send["pbps1-XPOS"]))
+        self.assertAlmostEqual(data_to_send["pbps1-YPOS"], 0.5 * 3 - 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
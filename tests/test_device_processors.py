@@ -0,0 +1,160 @@
+import os
+import unittest
+from unittest import mock
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices import mapping
+from frontend_digitizers_calibration.devices.mapping import compile_device_plans, compile_output_template, \
+    get_device_processor, register_device_processor, device_type_parallel_processing_function_mapping
+from frontend_digitizers_calibration.devices.pbpg import average_pbpg
+from frontend_digitizers_calibration.devices.utils import DeviceProcessor, calibrate_channels
+from tests.test_buffers import CalibrationData, generate_message
+
+SUFFIX_DEVICE_CHARGE = "CHARGE"
+
+
+def process_charge(message, device_name, device_definition, channels_definition, calibration_data, buffers=None,
+                   plan=None, data_to_send=None):
+    calibrate_channels(message, data_to_send, channels_definition, calibration_data, buffers=buffers, plan=plan)
+
+    data_to_send[plan.device_keys[SUFFIX_DEVICE_CHARGE]] = data_to_send[plan.channels[0].data_sum] * 2
+
+    return data_to_send
+
+
+charge_processor = DeviceProcessor(device_type="charge",
+                                   processing_function=process_charge,
+                                   n_channels=1,
+                                   device_outputs=(SUFFIX_DEVICE_CHARGE,))
+
+
+class TestDeviceProcessors(unittest.TestCase):
+    def setUp(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+
+        tcal = TimeCalibration()
+        tcal.load_default(5120)
+        self.calibration_data = CalibrationData(VoltageCalibration(os.path.join(current_folder,
+                                                                                "data/configs/wd135-5120.vcal")),
+                                                tcal)
+
+        def channels(first, n_channels=4):
+            return [{config.CONFIG_CHANNEL_PV_PREFIX: "channel%d" % index,
+                     config.CONFIG_CHANNEL_NUMBER: index % 8} for index in range(first, first + n_channels)]
+
+        position = {"x_scaling_offset": 0.1, "y_scaling_offset": -0.1, "x_scaling_factor": 2, "y_scaling_factor": 3}
+
+        self.devices = {
+            "pbps-": dict(position, device_type="pbps", channels=channels(0)),
+            "pbpg-": dict(position, device_type="pbpg", channels=channels(4), keithley_intensity="keithley"),
+            "single-": {"device_type": "single_channel", "scaling_factor": 2, "scaling_offset": 1,
+                        "channels": channels(8, 1)}
+        }
+
+        channels_definition = [channel for device_definition in self.devices.values()
+                               for channel in device_definition[config.CONFIG_DEVICE_CHANNELS]]
+        self.message = generate_message(numpy.random.RandomState(0), channels_definition)
+        self.message.data.data["keithley"] = self.message.data.data["channel0-ROI_sig_min"]
+
+        # The registration changes the module level mappings.
+        registries = [mapping.device_processors, mapping.device_type_processing_function_mapping,
+                      mapping.device_type_parallel_processing_function_mapping,
+                      mapping.device_type_grouped_processing_function_mapping,
+                      mapping.device_type_group_intensity_scaling_factor_mapping,
+                      mapping.device_type_ordered_processing_function_mapping,
+                      mapping.device_type_batch_processing_function_mapping, mapping.device_type_plan_mapping]
+        saved = [dict(registry) for registry in registries]
+
+        def restore():
+            for registry, registry_saved in zip(registries, saved):
+                registry.clear()
+                registry.update(registry_saved)
+
+        self.addCleanup(restore)
+
+    def process(self, devices, processing_function_mapping=device_type_parallel_processing_function_mapping):
+        device_plans = compile_device_plans(devices, processing_function_mapping)
+        data_to_send = compile_output_template(device_plans)
+
+        for device_name, plan in device_plans.items():
+            plan.processing_function(message=self.message, device_name=device_name,
+                                     device_definition=plan.device_definition,
+                                     channels_definition=plan.channels_definition,
+                                     calibration_data=self.calibration_data, plan=plan, data_to_send=data_to_send)
+
+            if plan.ordered_processing_function is not None:
+                plan.ordered_processing_function(message=self.message, device_name=device_name,
+                                                 device_definition=plan.device_definition, data_to_send=data_to_send,
+                                                 plan=plan)
+
+        return device_plans, data_to_send
+
+    def test_reference_processors(self):
+        self.assertListEqual(["pbps", "pbpg", "single_channel"], list(mapping.device_processors)[:3])
+        self.assertIs(mapping.device_type_ordered_processing_function_mapping["pbpg"], average_pbpg)
+        self.assertNotIn("pbps", mapping.device_type_ordered_processing_function_mapping)
+
+        device_plans, data_to_send = self.process(self.devices)
+
+        # All the declared outputs are written.
+        self.assertFalse([name for name, value in data_to_send.items() if value is None])
+        self.assertIn("pbpg-INTENSITY-AVG", data_to_send)
+        self.assertIn("channel8-TIME-AXIS", data_to_send)
+
+        pbpg_plan = device_plans["pbpg-"]
+        input_names = get_device_processor("pbpg").get_input_names(pbpg_plan)
+        self.assertIn("channel4-DRS_TC", input_names)
+        self.assertIn("keithley", input_names)
+        self.assertTrue(all(name in self.message.data.data for name in input_names))
+
+    def test_register(self):
+        register_device_processor(charge_processor)
+
+        devices = {"ict-": {"device_type": "charge", "channels": self.devices["single-"]["channels"]}}
+        device_plans, data_to_send = self.process(devices)
+
+        self.assertFalse([name for name, value in data_to_send.items() if value is None])
+        self.assertEqual(data_to_send["channel8-DATA-SUM"] * 2, data_to_send["ict-CHARGE"])
+        self.assertNotIn("charge", mapping.device_type_batch_processing_function_mapping)
+
+    def test_validate(self):
+        devices = {"pbps-": dict(self.devices["pbps-"], channels=self.devices["pbps-"]["channels"][:3])}
+
+        with self.assertRaisesRegex(ValueError, "needs 4 channels, 3 defined"):
+            compile_device_plans(devices)
+
+    def test_entry_points(self):
+        entry_point = mock.Mock()
+        entry_point.name = "charge"
+        entry_point.load.return_value = charge_processor
+
+        broken_entry_point = mock.Mock()
+        broken_entry_point.name = "broken"
+        broken_entry_point.load.side_effect = ImportError("missing")
+
+        with mock.patch.object(mapping, "iter_entry_points", return_value=[broken_entry_point, entry_point]) \
+                as entries, mock.patch.object(mapping, "_plugins_loaded", False):
+            self.assertIs(get_device_processor("charge"), charge_processor)
+            entries.assert_called_once_with("frontend_digitizers_calibration.devices")
+
+            with self.assertRaisesRegex(ValueError, "Unknown device_type 'broken'"):
+                get_device_processor("broken")
+
+            self.assertEqual(1, entries.call_count)
+
+    def test_unknown_device_type(self):
+        # The entry points of the installed packages are looked up with the API of the running Python version.
+        with mock.patch.object(mapping, "_plugins_loaded", False):
+            with self.assertRaisesRegex(ValueError, "Unknown device_type 'unknown', available: .*'pbps'"):
+                compile_device_plans({"unknown-": {"device_type": "unknown", "channels": []}})
+
+            self.assertTrue(mapping._plugins_loaded)
+
+        self.assertListEqual([], list(mapping.iter_entry_points("frontend_digitizers_calibration.missing")))
+
+
+if __name__ == '__main__':
+    unittest.main()
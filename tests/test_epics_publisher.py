@@ -0,0 +1,100 @@
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration.epics_publisher import EpicsPublisher, FakePVBackend, \
+    load_epics_publisher_config
+from tests.clock import FakeClock
+
+
+class TestEpicsPublisher(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakePVBackend()
+        self.clock = FakeClock()
+
+    def test_whitelist(self):
+        publisher = EpicsPublisher(backend=self.backend, whitelist=["DEVICE:*-INTENSITY"], clock=self.clock)
+
+        publisher.publish({"DEVICE:A-INTENSITY": 1.0, "DEVICE:A-DATA": numpy.zeros(1024)})
+        publisher.publish_pending(0)
+
+        self.assertListEqual(["DEVICE:A-INTENSITY"], list(self.backend.pvs.keys()))
+        self.assertEqual(1, self.backend.n_flushes)
+
+    def test_coalesce_and_unchanged(self):
+        publisher = EpicsPublisher(backend=self.backend, clock=self.clock)
+
+        publisher.publish({"PV": 1.0})
+        publisher.publish({"PV": 2.0})
+        publisher.publish_pending(0)
+
+        publisher.publish({"PV": 2.0})
+        publisher.publish_pending(0)
+
+        publisher.publish({"PV": numpy.arange(3)})
+        publisher.publish_pending(0)
+        publisher.publish({"PV": numpy.arange(3)})
+        publisher.publish_pending(0)
+
+        self.assertEqual(2, len(self.backend.pvs["PV"].values))
+        self.assertEqual(2.0, self.backend.pvs["PV"].values[0])
+        self.assertDictEqual({"published": 2, "coalesced": 1, "unchanged": 2, "dropped": 0, "pending": 0},
+                             publisher.get_statistics())
+
+    def test_rate_limit(self):
+        publisher = EpicsPublisher(backend=self.backend, max_rate=100, pv_max_rates={"SLOW*": 1}, clock=self.clock)
+
+        publisher.publish({"FAST": 1, "SLOW": 1})
+        publisher.publish_pending(0)
+
+        self.clock.time = 0.5
+        publisher.publish({"FAST": 2, "SLOW": 2})
+        next_ready = publisher.publish_pending(0)
+
+        self.assertListEqual([1, 2], self.backend.pvs["FAST"].values)
+        self.assertListEqual([1], self.backend.pvs["SLOW"].values)
+        self.assertAlmostEqual(0.5, next_ready)
+
+        self.clock.time = 1.0
+        publisher.publish_pending(0)
+        self.assertListEqual([1, 2], self.backend.pvs["SLOW"].values)
+
+    def test_reused_buffer(self):
+        publisher = EpicsPublisher(backend=self.backend, max_rate=1, copy_arrays=True, clock=self.clock)
+        output_buffer = numpy.zeros(4, dtype=numpy.float32)
+
+        publisher.publish({"WAVEFORM": output_buffer})
+        publisher.publish_pending(0)
+
+        # Rate limited, the buffer is reused by the next pulses before the value is put.
+        self.clock.time = 0.5
+        output_buffer[:] = 1
+        publisher.publish({"WAVEFORM": output_buffer})
+        output_buffer[:] = 2
+
+        self.clock.time = 1.0
+        publisher.publish_pending(0)
+
+        values = self.backend.pvs["WAVEFORM"].values
+        self.assertEqual(2, len(values))
+        numpy.testing.assert_array_equal(numpy.zeros(4), values[0])
+        numpy.testing.assert_array_equal(numpy.ones(4), values[1])
+
+    def test_disconnected(self):
+        publisher = EpicsPublisher(backend=self.backend, clock=self.clock)
+
+        publisher.publish({"PV": 1})
+        publisher.publish_pending(0)
+        self.backend.pvs["PV"].connected = False
+
+        publisher.publish({"PV": 2})
+        publisher.publish_pending(0)
+
+        self.assertEqual(1, publisher.n_dropped)
+
+    def test_load_config(self):
+        publisher_config = load_epics_publisher_config({"epics": {"whitelist": ["A*"], "max_rate": 10}})
+
+        self.assertListEqual(["A*"], publisher_config["whitelist"])
+        self.assertEqual(10, publisher_config["max_rate"])
+        self.assertTrue(publisher_config["skip_unchanged"])
@@ -0,0 +1,106 @@
+import shutil
+import tempfile
+import types
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration import config, fused_calibration
+from frontend_digitizers_calibration.buffers import CalibrationBuffers
+from frontend_digitizers_calibration.calibration import CalibrationManager, VoltageCalibration
+from frontend_digitizers_calibration.devices.mapping import compile_device_plans
+from frontend_digitizers_calibration.devices.utils import calibrate_channels
+from frontend_digitizers_calibration.fused_calibration import pairwise_sum, get_kernel, warm_up_fused_calibration, \
+    NUMBA_AVAILABLE
+from tests.benchmark import load_ioc_host_config, load_dump_messages, generate_synthetic_messages, \
+    load_calibration_manager, CONFIG_FOLDER
+
+
+class TestFusedCalibration(unittest.TestCase):
+    """
+    Without Numba the fused kernel runs as plain Python, with Numba compiled - both have to match NumPy.
+    """
+
+    def setUp(self):
+        self.ioc_host_config = load_ioc_host_config()
+        self.calibration_manager = load_calibration_manager(self.ioc_host_config)
+        self.device_plans = compile_device_plans(self.ioc_host_config[config.CONFIG_SECTION_DEVICES])
+
+    def assert_fused_equal(self, message, buffers=False):
+        for plan in self.device_plans.values():
+            results = []
+
+            for fused in (False, True):
+                device_buffers = CalibrationBuffers(len(plan.channels)) if buffers else None
+                results.append(calibrate_channels(message, {}, plan.channels_definition, self.calibration_manager,
+                                                  buffers=device_buffers, plan=plan, fused=fused))
+
+            expected, result = results
+            self.assertSetEqual(set(expected), set(result))
+
+            # Bit compatible, including the sums.
+            for name in expected:
+                numpy.testing.assert_array_equal(expected[name], result[name], err_msg=name)
+                self.assertEqual(numpy.asarray(expected[name]).dtype, numpy.asarray(result[name]).dtype, name)
+
+    def test_pairwise_sum(self):
+        random_state = numpy.random.RandomState(0)
+
+        for n in list(range(20)) + [127, 128, 129, 255, 256, 300, 1023, 1024]:
+            values = (random_state.randn(n + 3) * 1000).astype(numpy.float32)
+
+            self.assertEqual(values[3:].sum(), pairwise_sum(values, 3, n), n)
+
+    def test_kernel_globals(self):
+        get_kernel()
+
+        # The compiled sum is kept under its own name, pairwise_sum stays the Python function.
+        self.assertIsInstance(fused_calibration.pairwise_sum, types.FunctionType)
+        self.assertIs(pairwise_sum, fused_calibration.pairwise_sum)
+
+    @unittest.skipUnless(NUMBA_AVAILABLE, "Numba is not installed.")
+    def test_warm_up(self):
+        kernel = get_kernel()
+        self.assertNotIsInstance(kernel, types.FunctionType)
+
+        cache_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_folder)
+
+        message = generate_synthetic_messages(self.ioc_host_config, 1)[0]
+
+        for precompiled in (False, True):
+            warm_up_fused_calibration(VoltageCalibration.zeros(precompiled))
+            n_signatures = len(kernel.signatures)
+
+            calibration_manager = CalibrationManager(self.ioc_host_config, CONFIG_FOLDER,
+                                                     cache_folder=cache_folder if precompiled else None)
+            calibration_manager.load_calibration_data(5120)
+
+            for plan in self.device_plans.values():
+                calibrate_channels(message, {}, plan.channels_definition, calibration_manager, plan=plan, fused=True)
+
+            # The calibration of the stream does not compile the kernel again.
+            self.assertEqual(n_signatures, len(kernel.signatures), precompiled)
+
+    def test_dump(self):
+        for message in load_dump_messages(self.ioc_host_config):
+            self.assert_fused_equal(message)
+
+    def test_synthetic(self):
+        # With the background waveforms.
+        for message in generate_synthetic_messages(self.ioc_host_config, 2):
+            self.assert_fused_equal(message)
+            self.assert_fused_equal(message, buffers=True)
+
+    def test_empty_background(self):
+        message = generate_synthetic_messages(self.ioc_host_config, 1)[0]
+        for name in message.data.data:
+            if name.endswith("-ROI_bg_max"):
+                message.data.data[name].value = -1
+
+        with numpy.errstate(invalid="ignore"), self.assertWarns(RuntimeWarning):
+            self.assert_fused_equal(message)
+
+
+if __name__ == '__main__':
+    unittest.main()
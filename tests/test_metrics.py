@@ -0,0 +1,122 @@
+import unittest
+from threading import Event
+from urllib.request import urlopen
+
+from frontend_digitizers_calibration.metrics import Histogram, PulseIdMonitor, StreamMetrics, start_metrics_server, \
+    start_metrics_logging, STAGE_PROCESS, MESSAGES_DROPPED
+from frontend_digitizers_calibration.pipeline import StageQueue
+from tests.clock import FakeClock
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.001, 0.01, 0.1))
+
+        for value in [0.0005] * 50 + [0.005] * 49 + [0.5]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [50, 49, 0, 1])
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.sum, 0.0005 * 50 + 0.005 * 49 + 0.5)
+
+        self.assertEqual(histogram.quantile(0.5), 0.001)
+        self.assertEqual(histogram.quantile(0.99), 0.01)
+        self.assertEqual(histogram.quantile(1), float("inf"))
+
+    def test_stage_timer(self):
+        clock = FakeClock()
+        metrics = StreamMetrics(buckets=(0.001, 0.01), clock=clock)
+
+        for duration in (0.0005, 0.002):
+            with metrics.timer(STAGE_PROCESS):
+                clock.time += duration
+
+        histogram = metrics.histograms[STAGE_PROCESS]
+        self.assertEqual(histogram.counts, [1, 1, 0])
+        self.assertAlmostEqual(histogram.sum, 0.0025)
+
+    def test_pulse_id_gaps(self):
+        monitor = PulseIdMonitor()
+
+        # 25 Hz on a 100 Hz pulse_id - a step of 4 is not a gap.
+        for pulse_id in (100, 104, 108, 120, 124, 124):
+            monitor.update(pulse_id, 5120)
+
+        self.assertEqual(monitor.pulse_id_step, 4)
+        self.assertEqual(monitor.n_gaps, 1)
+        self.assertEqual(monitor.n_missing, 2)
+        self.assertEqual(monitor.last_gap_pulse_id, 120)
+        self.assertEqual(monitor.n_reordered, 1)
+        self.assertEqual(monitor.n_frequency_changes, 0)
+
+        monitor.update(128, 2560)
+        self.assertEqual(monitor.n_frequency_changes, 1)
+        self.assertEqual(monitor.last_frequency_change_pulse_id, 128)
+
+    def test_prometheus(self):
+        metrics = StreamMetrics(buckets=(0.001, 0.01))
+        metrics.observe(STAGE_PROCESS, 0.005)
+        metrics.increment(MESSAGES_DROPPED)
+        metrics.pulse_ids.update(10)
+
+        queue = StageQueue(10)
+        queue.put(1)
+        metrics.add_queue("compute", queue)
+
+        lines = metrics.format_prometheus().splitlines()
+
+        self.assertIn('digitizer_calibration_stage_seconds_bucket{stage="process",le="0.001"} 0', lines)
+        self.assertIn('digitizer_calibration_stage_seconds_bucket{stage="process",le="0.01"} 1', lines)
+        self.assertIn('digitizer_calibration_stage_seconds_bucket{stage="process",le="+Inf"} 1', lines)
+        self.assertIn('digitizer_calibration_stage_seconds_count{stage="process"} 1', lines)
+        self.assertIn('digitizer_calibration_messages_total{status="dropped"} 1', lines)
+        self.assertIn('digitizer_calibration_queue_depth{queue="compute"} 1', lines)
+        self.assertIn('digitizer_calibration_last_pulse_id 10', lines)
+
+        self.assertIn("dropped 1", metrics.format_summary())
+
+    def test_metrics_server(self):
+        metrics = StreamMetrics()
+        metrics.increment(MESSAGES_DROPPED, 3)
+
+        server = start_metrics_server(metrics, 0, host="127.0.0.1")
+        try:
+            with urlopen("http://127.0.0.1:%d/metrics" % server.server_address[1], timeout=5) as response:
+                content = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertIn('digitizer_calibration_messages_total{status="dropped"} 3', content)
+
+
+    def test_metrics_logging(self):
+        logged = Event()
+
+        class FailingQueue(object):
+            n_calls = 0
+
+            def qsize(self):
+                self.n_calls += 1
+                if self.n_calls == 1:
+                    raise RuntimeError("Queue not ready.")
+
+                logged.set()
+                return 0
+
+        metrics = StreamMetrics()
+        metrics.add_queue("compute", FailingQueue())
+
+        with self.assertLogs("frontend_digitizers_calibration.metrics") as logs:
+            stop_event = start_metrics_logging(metrics, 0.01)
+            try:
+                # The logging continues after the first summary failed.
+                self.assertTrue(logged.wait(5))
+            finally:
+                stop_event.set()
+
+        self.assertIn("Failed to log the stream metrics.", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
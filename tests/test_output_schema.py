@@ -0,0 +1,63 @@
+import unittest
+
+from frontend_digitizers_calibration.output_schema import load_output_schema
+from frontend_digitizers_calibration.workers import WorkerMessage
+
+
+class TestOutputSchema(unittest.TestCase):
+    def setUp(self):
+        self.message = WorkerMessage(0, {"channel1-DATA": [1, 2, 3],
+                                         "channel1-DRS_TC": 134,
+                                         "IOC:FREQ": 5120})
+
+    def test_no_schema(self):
+        self.assertIsNone(load_output_schema({"devices": {}}))
+
+    def test_schema(self):
+        output_schema = load_output_schema({"output": {"stream": {"pass_through": ["*-DRS_TC", "IOC:FREQ"]},
+                                                       "epics": {"computed": ["*-SUM"], "pass_through": []}}})
+
+        data = {"channel1-DATA-SUM": 1.0, "channel1-DATA-CALIBRATED": [0.1, 0.2, 0.3]}
+        output_schema.append_message_data(self.message, data)
+
+        # Only the pass-through values of any output are copied.
+        self.assertNotIn("channel1-DATA", data)
+
+        stream_data, epics_data = output_schema.split(self.message, data)
+
+        self.assertSetEqual({"channel1-DATA-SUM", "channel1-DATA-CALIBRATED", "channel1-DRS_TC", "IOC:FREQ"},
+                            set(stream_data.keys()))
+        self.assertDictEqual({"channel1-DATA-SUM": 1.0}, epics_data)
+
+    def test_changed_keys(self):
+        output_schema = load_output_schema({"output": {"epics": {"computed": ["*-SUM"]}}})
+
+        output_schema.split(self.message, {"channel1-DATA-SUM": 1.0, "channel1-DATA-MIN": 0.0})
+
+        # Same number of values, but different names - the key lists are compiled again.
+        stream_data, epics_data = output_schema.split(self.message, {"channel2-DATA-SUM": 2.0,
+                                                                     "channel2-DATA-MIN": 0.0})
+        self.assertDictEqual({"channel2-DATA-SUM": 2.0}, epics_data)
+        self.assertEqual(2, len(stream_data))
+
+    def test_changed_names_same_count(self):
+        output_schema = load_output_schema({"output": {"stream": {"pass_through": ["*-DRS_TC"]},
+                                                       "epics": {"computed": ["*-SUM"], "pass_through": []}}})
+
+        _, epics_data = output_schema.split(self.message, {"channel1-DATA-SUM": 1.0, "channel1-DATA-MIN": 0.0})
+        self.assertDictEqual({"channel1-DATA-SUM": 1.0}, epics_data)
+
+        # Same number of values and the selected names are still there, but another one is selected now.
+        _, epics_data = output_schema.split(self.message, {"channel1-DATA-SUM": 1.0, "channel2-DATA-SUM": 2.0})
+        self.assertDictEqual({"channel1-DATA-SUM": 1.0, "channel2-DATA-SUM": 2.0}, epics_data)
+
+        # Same number of input channels, but a different pass-through channel.
+        data = {}
+        output_schema.append_message_data(WorkerMessage(0, {"channel1-DRS_TC": 134, "IOC:FREQ": 5120,
+                                                            "channel1-DATA": [1, 2, 3]}), data)
+        self.assertDictEqual({"channel1-DRS_TC": 134}, data)
+
+        data = {}
+        output_schema.append_message_data(WorkerMessage(1, {"channel1-DRS_TC": 134, "channel2-DRS_TC": 112,
+                                                            "channel1-DATA": [1, 2, 3]}), data)
+        self.assertDictEqual({"channel1-DRS_TC": 134, "channel2-DRS_TC": 112}, data)
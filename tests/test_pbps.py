@@ -9,7 +9,8 @@ frontend_digitizers_calibration.utils.notify_epics = mock_notify_epics
 from frontend_digitizers_calibration.devices.utils import SUFFIX_CHANNEL_DATA_SUM, SUFFIX_CHANNEL_BG_DATA_SUM, \
     SUFFIX_CHANNEL_DATA_CALIBRATED, SUFFIX_CHANNEL_BG_DATA_CALIBRATED, SUFFIX_DEVICE_INTENSITY, SUFFIX_DEVICE_XPOS, \
     SUFFIX_DEVICE_YPOS, SUFFIX_CHANNEL_DATA_MIN, SUFFIX_CHANNEL_DATA_MAX, SUFFIX_CHANNEL_BG_DATA_MIN, \
-    SUFFIX_CHANNEL_BG_DATA_MAX
+    SUFFIX_CHANNEL_BG_DATA_MAX, SUFFIX_CHANNEL_DATA_AMP, SUFFIX_CHANNEL_TIME_AXIS, SUFFIX_CHANNEL_BG_TIME_AXIS, \
+    SUFFIX_X_INTENSITY, SUFFIX_Y_INTENSITY
 
 from frontend_digitizers_calibration.devices.pbps import process_pbps
 from tests.utils import MockCalibrationData
@@ -46,10 +47,15 @@ class TestPbps(unittest.TestCase):
             expected_data.add(pv_prefix + SUFFIX_CHANNEL_DATA_MAX)
             expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_DATA_MIN)
             expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_DATA_MAX)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_DATA_AMP)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_TIME_AXIS)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_TIME_AXIS)
 
         # Per device data.
         expected_data.add(device_name+SUFFIX_DEVICE_INTENSITY)
         expected_data.add(device_name+SUFFIX_DEVICE_XPOS)
         expected_data.add(device_name+SUFFIX_DEVICE_YPOS)
+        expected_data.add(device_name+SUFFIX_X_INTENSITY)
+        expected_data.add(device_name+SUFFIX_Y_INTENSITY)
 
         self.assertSetEqual(expected_data, set(result.keys()))
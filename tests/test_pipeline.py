@@ -0,0 +1,88 @@
+import unittest
+from queue import Queue
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.pipeline import StageQueue, start_stage, PipelineStageError
+
+
+class TestPipeline(unittest.TestCase):
+    @staticmethod
+    def drain(stage_queue):
+        items = []
+        while stage_queue.qsize():
+            items.append(stage_queue.get())
+        return items
+
+    def test_drop_oldest(self):
+        stage_queue = StageQueue(3, config.BACKPRESSURE_DROP_OLDEST)
+        for pulse_id in range(5):
+            stage_queue.put(pulse_id)
+
+        self.assertListEqual([2, 3, 4], self.drain(stage_queue))
+        self.assertEqual(2, stage_queue.n_dropped)
+
+    def test_drop_newest(self):
+        stage_queue = StageQueue(3, config.BACKPRESSURE_DROP_NEWEST)
+        for pulse_id in range(5):
+            stage_queue.put(pulse_id)
+
+        self.assertListEqual([0, 1, 2], self.drain(stage_queue))
+        self.assertEqual(2, stage_queue.n_dropped)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, StageQueue, 3, "drop_random")
+
+    def test_stage_order(self):
+        input_queue = StageQueue(10)
+        output = Queue()
+
+        def process(pulse_id):
+            if pulse_id == 3:
+                raise ValueError("Failing item.")
+            output.put(pulse_id)
+
+        start_stage("test", process, input_queue)
+
+        for pulse_id in range(100):
+            input_queue.put(pulse_id)
+
+        # The failing item is skipped, the order of the others is preserved.
+        self.assertListEqual([pulse_id for pulse_id in range(100) if pulse_id != 3],
+                             [output.get(timeout=1) for _ in range(99)])
+
+    def test_persistent_failure(self):
+        input_queue = StageQueue(10)
+        output = Queue()
+
+        def process(pulse_id):
+            if pulse_id >= 3:
+                raise ValueError("Broken output.")
+            output.put(pulse_id)
+
+        with self.assertLogs("frontend_digitizers_calibration.pipeline", "ERROR"):
+            stage = start_stage("test", process, input_queue, max_consecutive_failures=5)
+
+            for pulse_id in range(8):
+                input_queue.put(pulse_id)
+
+            self.assertTrue(stage.stop(timeout=5))
+
+        self.assertListEqual([0, 1, 2], [output.get(timeout=1) for _ in range(3)])
+
+        # The stage stopped after 5 failures in a row, the producer is told instead of blocking.
+        with self.assertRaisesRegex(PipelineStageError, "'test' failed 5 times in a row"):
+            stage.check()
+        self.assertRaises(PipelineStageError, input_queue.put, 8)
+
+    def test_stop(self):
+        input_queue = StageQueue(100)
+        output = []
+
+        stage = start_stage("test", output.append, input_queue)
+        for pulse_id in range(50):
+            input_queue.put(pulse_id)
+
+        # The queued items are processed before the stage stops.
+        self.assertTrue(stage.stop(timeout=5))
+        self.assertListEqual(list(range(50)), output)
+        stage.check()
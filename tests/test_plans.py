@@ -0,0 +1,93 @@
+import os
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.mapping import compile_device_plans, \
+    device_type_parallel_processing_function_mapping
+from frontend_digitizers_calibration.devices.pbpg import calculate_pbpg, average_pbpg
+from frontend_digitizers_calibration.devices.pbps import process_pbps
+from frontend_digitizers_calibration.devices.single_channel import process_single_channel
+from frontend_digitizers_calibration.devices.utils import DevicePlan
+from tests.test_buffers import CalibrationData, generate_message
+
+
+class TestPlans(unittest.TestCase):
+    def setUp(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+
+        tcal = TimeCalibration()
+        tcal.load_default(5120)
+        self.calibration_data = CalibrationData(VoltageCalibration(os.path.join(current_folder,
+                                                                                "data/configs/wd135-5120.vcal")),
+                                                tcal)
+
+        def channels(first):
+            return [{config.CONFIG_CHANNEL_PV_PREFIX: "channel%d" % index,
+                     config.CONFIG_CHANNEL_NUMBER: index % 8} for index in range(first, first + 4)]
+
+        position = {"x_scaling_offset": 0.1, "y_scaling_offset": -0.1, "x_scaling_factor": 2, "y_scaling_factor": 3}
+
+        self.devices = {
+            "pbps-": dict(position, device_type="pbps", channels=channels(0)),
+            "pbpg-": dict(position, device_type="pbpg", channels=channels(4), keithley_intensity="keithley"),
+            "single-": {"device_type": "single_channel", "scaling_factor": 2, "scaling_offset": 1,
+                        "channels": channels(8)[:1]}
+        }
+
+        channels_definition = [channel for device_definition in self.devices.values()
+                               for channel in device_definition[config.CONFIG_DEVICE_CHANNELS]]
+        self.message = generate_message(numpy.random.RandomState(0), channels_definition)
+        self.message.data.data["keithley"] = self.message.data.data["channel0-ROI_sig_min"]
+
+    def test_compile_device_plans(self):
+        device_plans = compile_device_plans(self.devices, device_type_parallel_processing_function_mapping)
+
+        self.assertListEqual(list(self.devices), list(device_plans))
+        self.assertIs(device_plans["pbps-"].processing_function, process_pbps)
+        self.assertIsNone(device_plans["pbps-"].ordered_processing_function)
+        self.assertIs(device_plans["pbpg-"].processing_function, calculate_pbpg)
+        self.assertIs(device_plans["pbpg-"].ordered_processing_function, average_pbpg)
+
+        plan = device_plans["pbpg-"]
+        self.assertFalse(hasattr(plan, "__dict__"))
+        self.assertFalse(plan.channel_numbers.flags.writeable)
+        self.assertFalse(plan.gain_table.flags.writeable)
+        self.assertListEqual([4, 5, 6, 7], plan.channel_numbers.tolist())
+        self.assertEqual("channel4-DATA-SUM", plan.channels[0].data_sum)
+        self.assertEqual("pbpg-INTENSITY-AVG", plan.device_keys["INTENSITY-AVG"])
+        self.assertEqual("keithley", plan.keithley_intensity)
+
+    def test_plan_processing(self):
+        device_plans = compile_device_plans(self.devices)
+
+        for device_name, plan in device_plans.items():
+            device_definition = self.devices[device_name]
+            channels_definition = device_definition[config.CONFIG_DEVICE_CHANNELS]
+
+            processing_function = {"pbps": process_pbps,
+                                   "pbpg": calculate_pbpg,
+                                   "single_channel": process_single_channel}[plan.device_type]
+
+            expected = processing_function(self.message, device_name, device_definition, channels_definition,
+                                           self.calibration_data)
+            result = processing_function(self.message, device_name, device_definition, channels_definition,
+                                         self.calibration_data, plan=plan)
+
+            self.assertSetEqual(set(expected), set(result))
+            for name in expected:
+                numpy.testing.assert_array_equal(expected[name], result[name], err_msg=name)
+
+    def test_generic_device_plan(self):
+        plan = DevicePlan("device-", {"channels": [{"pv_prefix": "channel", "channel_number": 3}]},
+                          gain_mapping={0: 1.0, 2: 0.5})
+
+        self.assertListEqual([1.0, 0.0, 0.5], plan.gain_table.tolist())
+        self.assertEqual("device-XPOS", plan.device_keys["XPOS"])
+        self.assertIsNone(plan.x_scaling_factor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import VoltageCalibration, TimeCalibration
+from frontend_digitizers_calibration.devices.pbpg import calculate_pbpg, average_pbpg
+from frontend_digitizers_calibration.devices.pbps import process_pbps
+from frontend_digitizers_calibration.devices.utils import calibrate_channels, calibrate_channels_batch, DevicePlan
+from frontend_digitizers_calibration.dump import DumpReader, write_dump_message
+from frontend_digitizers_calibration.recalibration import stack_messages, recalibrate_dump
+from frontend_digitizers_calibration.running_statistics import DeviceStatistics
+from frontend_digitizers_calibration.utils import load_ioc_host_config
+from frontend_digitizers_calibration.workers import WorkerMessage
+from tests.test_buffers import CalibrationData, generate_message
+
+FREQUENCY_NAME = "frequency"
+
+
+class TestRecalibration(unittest.TestCase):
+    def setUp(self):
+        self.current_folder = os.path.dirname(os.path.abspath(__file__))
+        self.temp_folder = tempfile.mkdtemp()
+
+        tcal = TimeCalibration()
+        tcal.load_default(5120)
+        self.calibration_data = CalibrationData(VoltageCalibration(os.path.join(self.current_folder,
+                                                                                "data/configs/wd135-5120.vcal")),
+                                                tcal)
+
+        def channels(first):
+            return [{config.CONFIG_CHANNEL_PV_PREFIX: "channel%d" % index,
+                     config.CONFIG_CHANNEL_NUMBER: index} for index in range(first, first + 4)]
+
+        position = {"x_scaling_offset": 0.1, "y_scaling_offset": -0.1, "x_scaling_factor": 2, "y_scaling_factor": 3}
+        self.devices = {
+            "pbps-": dict(position, device_type="pbps", channels=channels(0)),
+            "pbpg-": dict(position, device_type="pbpg", channels=channels(4), keithley_intensity="keithley",
+                          intensity_average_window=3),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def generate_messages(self, n_messages):
+        random_state = numpy.random.RandomState(0)
+        channels_definition = [channel for device_definition in self.devices.values()
+                               for channel in device_definition[config.CONFIG_DEVICE_CHANNELS]]
+
+        messages = []
+        for pulse_id in range(100, 100 + n_messages):
+            message = generate_message(random_state, channels_definition, background=True)
+            values = {name: value.value for name, value in message.data.data.items()}
+
+            values["channel0-ROI_sig_max"] = 300 if pulse_id % 3 else 400
+            values["keithley"] = 2.0
+            values[FREQUENCY_NAME] = 5120
+
+            messages.append((pulse_id, values))
+
+        return messages
+
+    def test_read_dump(self):
+        reader = DumpReader(os.path.join(self.current_folder, "data/SAROP21-CVME-PBPS1_ioc_dump"))
+        self.assertEqual(1, len(reader))
+
+        pulse_id, values = next(iter(reader))
+        self.assertEqual(4010355740, pulse_id)
+        self.assertEqual(26, len(values))
+        self.assertEqual(5120, values["SAROP21-CVME-PBPS1:Lnk9Ch15-WD_FREQ"])
+        self.assertEqual((1024,), values["SAROP21-CVME-PBPS1:Lnk9Ch12-DATA"].shape)
+        self.assertListEqual([1980, 1945, 1998], values["SAROP21-CVME-PBPS1:Lnk9Ch12-DATA"][:3].tolist())
+
+    def test_write_dump(self):
+        values = {"waveform": numpy.arange(10, dtype=numpy.int16), "scalar": numpy.float64(1.5), "missing": None,
+                  "image": numpy.arange(6, dtype=numpy.uint32).reshape(2, 3)}
+
+        for message_index in range(2):
+            write_dump_message(self.temp_folder, message_index, 10 + message_index, values)
+
+        messages = list(DumpReader(self.temp_folder))
+        self.assertListEqual([10, 11], [pulse_id for pulse_id, _ in messages])
+
+        pulse_id, read_values = messages[1]
+        numpy.testing.assert_array_equal(values["waveform"], read_values["waveform"])
+        numpy.testing.assert_array_equal(values["image"], read_values["image"])
+        self.assertEqual(1.5, read_values["scalar"])
+        self.assertIsNone(read_values["missing"])
+
+    def test_calibrate_channels_batch(self):
+        messages = self.generate_messages(7)
+        channels_definition = self.devices["pbps-"][config.CONFIG_DEVICE_CHANNELS]
+        plan = DevicePlan("pbps-", self.devices["pbps-"])
+
+        result = calibrate_channels_batch(stack_messages(messages), {}, self.calibration_data, plan)
+
+        for index, (pulse_id, values) in enumerate(messages):
+            expected = calibrate_channels(WorkerMessage(pulse_id, values), {}, channels_definition,
+                                          self.calibration_data)
+
+            self.assertSetEqual(set(expected), set(result))
+            for name in expected:
+                numpy.testing.assert_array_equal(expected[name], result[name][index], err_msg=name)
+
+    def test_recalibrate_bundled_dump(self):
+        config_folder = os.path.join(self.current_folder, "data/configs")
+        _, ioc_host_config = load_ioc_host_config(config_folder=config_folder,
+                                                  config_file_name="test_SAROP21-CVME-PBPS1.json")
+
+        # The dump predates the gain and ROI values, its pulse is skipped instead of failing the recalibration.
+        with self.assertLogs("frontend_digitizers_calibration.recalibration", "WARNING") as logs:
+            n_written, n_skipped = recalibrate_dump(os.path.join(self.current_folder,
+                                                                 "data/SAROP21-CVME-PBPS1_ioc_dump"),
+                                                    ioc_host_config, config_folder,
+                                                    os.path.join(self.temp_folder, "output"))
+
+        self.assertEqual((0, 1), (n_written, n_skipped))
+        self.assertIn("SAROP21-CVME-PBPS1:Lnk9Ch15-WD-gain-RBa", logs.output[0])
+
+    def test_incomplete_messages(self):
+        messages = self.generate_messages(12)
+        del messages[4][1]["channel2-WD-gain-RBa"]
+        # Without the background, the pulses are processed in a separate batch.
+        for name in [name for name in messages[7][1] if "-BG-" in name]:
+            del messages[7][1][name]
+
+        dump_folder = os.path.join(self.temp_folder, "dump")
+        os.makedirs(dump_folder)
+        for message_index, (pulse_id, values) in enumerate(messages):
+            write_dump_message(dump_folder, message_index, pulse_id, values)
+
+        ioc_host_config = {"devices": self.devices,
+                           "frequency": FREQUENCY_NAME,
+                           "frequency_mapping": {"5120": "wd135-5120.vcal"}}
+
+        output_folder = os.path.join(self.temp_folder, "output")
+        with self.assertLogs("frontend_digitizers_calibration.recalibration", "WARNING"):
+            n_written, n_skipped = recalibrate_dump(dump_folder, ioc_host_config,
+                                                    os.path.join(self.current_folder, "data/configs"),
+                                                    output_folder, batch_size=5)
+
+        self.assertEqual((11, 1), (n_written, n_skipped))
+        self.assertListEqual([pulse_id for index, (pulse_id, _) in enumerate(messages) if index != 4],
+                             numpy.load(os.path.join(output_folder, "pulse_id.npy")).tolist())
+
+        background_sum = numpy.load(os.path.join(output_folder, "channel0-BG-DATA-SUM.npy"))
+        self.assertEqual(11, len(background_sum))
+
+    def test_recalibrate_dump(self):
+        n_messages = 12
+        messages = self.generate_messages(n_messages)
+
+        dump_folder = os.path.join(self.temp_folder, "dump")
+        os.makedirs(dump_folder)
+        for message_index, (pulse_id, values) in enumerate(messages):
+            write_dump_message(dump_folder, message_index, pulse_id, values)
+
+        ioc_host_config = {"devices": self.devices,
+                           "frequency": FREQUENCY_NAME,
+                           "frequency_mapping": {"5120": "wd135-5120.vcal"}}
+
+        output_folder = os.path.join(self.temp_folder, "output")
+        n_written, n_skipped = recalibrate_dump(dump_folder, ioc_host_config, os.path.join(self.current_folder,
+                                                                                           "data/configs"),
+                                                output_folder, batch_size=5)
+
+        self.assertEqual((n_messages, 0), (n_written, n_skipped))
+        self.assertListEqual([pulse_id for pulse_id, _ in messages],
+                             numpy.load(os.path.join(output_folder, "pulse_id.npy")).tolist())
+
+        statistics = DeviceStatistics("pbpg-", self.devices["pbpg-"])
+
+        for index, (pulse_id, values) in enumerate(messages):
+            message = WorkerMessage(pulse_id, values)
+            expected = process_pbps(message, "pbps-", self.devices["pbps-"], self.devices["pbps-"]["channels"],
+                                    self.calibration_data)
+            pbpg_data = calculate_pbpg(message, "pbpg-", self.devices["pbpg-"], self.devices["pbpg-"]["channels"],
+                                       self.calibration_data)
+            expected.update(average_pbpg(message, "pbpg-", self.devices["pbpg-"], pbpg_data, statistics=statistics))
+
+            for name in ["channel0-DATA-SUM", "channel0-BG-DATA-CALIBRATED", "channel5-DATA-MAX", "pbps-XPOS",
+                         "pbpg-INTENSITY", "pbpg-INTENSITY-AVG", "pbpg-INTENSITY-CAL"]:
+                result = numpy.load(os.path.join(output_folder, name + ".npy"), mmap_mode="r")
+                self.assertEqual(n_messages, len(result))
+                numpy.testing.assert_allclose(expected[name], result[index], rtol=1e-6, err_msg=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration.devices.pbpg import average_pbpg
+from frontend_digitizers_calibration.running_statistics import RunningStatistics, DeviceStatistics, \
+    allocate_device_statistics
+from frontend_digitizers_calibration.workers import WorkerMessage
+
+
+class TestRunningStatistics(unittest.TestCase):
+    def test_rolling_mean_and_variance(self):
+        values = numpy.random.RandomState(0).normal(1e6, 10, 1000)
+        statistics = RunningStatistics(window=7)
+
+        for index, value in enumerate(values):
+            statistics.add(value)
+
+            window = values[max(0, index - 6):index + 1]
+            self.assertEqual(len(window), statistics.count)
+            self.assertAlmostEqual(window.mean(), statistics.mean, delta=1e-6)
+            self.assertAlmostEqual(window.var(), statistics.variance, delta=1e-3)
+
+    def test_no_drift(self):
+        statistics = RunningStatistics(window=3)
+
+        for value in [1e12, -1e12, 1e-3] * 1000 + [1.0, 2.0, 3.0]:
+            statistics.add(value)
+
+        self.assertEqual(2.0, statistics.mean)
+        self.assertAlmostEqual(2 / 3, statistics.variance)
+
+    def test_ewma_and_non_finite(self):
+        statistics = RunningStatistics(window=10, ewma_alpha=0.5)
+        self.assertTrue(numpy.isnan(statistics.mean))
+
+        for value in [2.0, float("nan"), 4.0, float("inf")]:
+            statistics.add(value)
+
+        self.assertEqual(2, statistics.count)
+        self.assertEqual(3.0, statistics.mean)
+        self.assertEqual(3.0, statistics.ewma)
+
+        with self.assertRaises(ValueError):
+            RunningStatistics(window=0)
+
+    def test_device_statistics(self):
+        devices = {"device-": {"running_statistics": {"values": ["XPOS"], "window": 2, "ewma_alpha": 0.5}},
+                   "other-": {}}
+        device_statistics = allocate_device_statistics(devices)
+
+        for xpos in [1.0, 3.0, 5.0]:
+            data = device_statistics["device-"].update({"device-XPOS": xpos, "device-YPOS": 0.0})
+            self.assertEqual({}, device_statistics["other-"].update({}))
+
+        self.assertEqual(4.0, data["device-XPOS-MEAN"])
+        self.assertEqual(1.0, data["device-XPOS-STD"])
+        self.assertEqual(3.5, data["device-XPOS-EWMA"])
+        self.assertNotIn("device-YPOS-MEAN", data)
+
+    def test_pbpg_average_per_device(self):
+        device_definition = {"device_type": "pbpg", "channels": [], "keithley_intensity": "keithley",
+                             "intensity_average_window": 2}
+        message = WorkerMessage(0, {"keithley": 1.0})
+
+        statistics = {"a-": DeviceStatistics("a-", device_definition),
+                      "b-": DeviceStatistics("b-", device_definition)}
+
+        for intensity_a, intensity_b in [(1.0, 100.0), (3.0, 200.0), (5.0, 300.0)]:
+            data_a = average_pbpg(message, "a-", device_definition, {"a-INTENSITY": intensity_a},
+                                  statistics=statistics["a-"])
+            data_b = average_pbpg(message, "b-", device_definition, {"b-INTENSITY": intensity_b},
+                                  statistics=statistics["b-"])
+
+        self.assertEqual(4.0, data_a["a-INTENSITY-AVG"])
+        self.assertEqual(250.0, data_b["b-INTENSITY-AVG"])
+        self.assertEqual(5.0 / 4.0, data_a["a-INTENSITY-CAL"])
+
+
+if __name__ == '__main__':
+    unittest.main()
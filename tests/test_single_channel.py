@@ -7,7 +7,9 @@ import frontend_digitizers_calibration.utils
 frontend_digitizers_calibration.utils.notify_epics = mock_notify_epics
 
 from frontend_digitizers_calibration.devices.utils import SUFFIX_CHANNEL_DATA_SUM, SUFFIX_CHANNEL_BG_DATA_SUM, \
-    SUFFIX_CHANNEL_DATA_CALIBRATED, SUFFIX_CHANNEL_BG_DATA_CALIBRATED
+    SUFFIX_CHANNEL_DATA_CALIBRATED, SUFFIX_CHANNEL_BG_DATA_CALIBRATED, SUFFIX_CHANNEL_DATA_MIN, SUFFIX_CHANNEL_DATA_MAX, \
+    SUFFIX_CHANNEL_BG_DATA_MIN, SUFFIX_CHANNEL_BG_DATA_MAX, SUFFIX_CHANNEL_DATA_AMP, SUFFIX_CHANNEL_TIME_AXIS, \
+    SUFFIX_CHANNEL_BG_TIME_AXIS
 from frontend_digitizers_calibration.devices.single_channel import process_single_channel, SUFFIX_DEVICE_SCALED_DATA_SUM
 
 from tests.utils import MockCalibrationData
@@ -38,6 +40,13 @@ class TestSingleChannel(unittest.TestCase):
             expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_DATA_SUM)
             expected_data.add(pv_prefix + SUFFIX_CHANNEL_DATA_CALIBRATED)
             expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_DATA_CALIBRATED)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_DATA_MIN)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_DATA_MAX)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_DATA_MIN)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_DATA_MAX)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_DATA_AMP)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_TIME_AXIS)
+            expected_data.add(pv_prefix + SUFFIX_CHANNEL_BG_TIME_AXIS)
 
         # Per device data.
         expected_data.add(device_name+SUFFIX_DEVICE_SCALED_DATA_SUM)
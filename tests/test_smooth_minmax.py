@@ -0,0 +1,50 @@
+import bisect
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration.smooth_minmax import find_minmax
+
+
+def reference_find_minmax(data, window_size=21):
+    # Original sorted list implementation.
+    min_val = None
+    max_val = None
+    sorted_list = []
+
+    for i in range(0, len(data), window_size):
+        del sorted_list[:]
+        if i + window_size < (len(data)):
+            for j in range(i, i + window_size):
+                bisect.insort_left(sorted_list, data[j])
+        else:
+            for j in range(len(data)-window_size, len(data)):
+                bisect.insort_left(sorted_list, data[j])
+
+        median = sorted_list[(window_size//2)+1]
+        if min_val is None or median < min_val:
+            min_val = median
+        if max_val is None or median > max_val:
+            max_val = median
+
+    return [min_val, max_val]
+
+
+class TestSmoothMinmax(unittest.TestCase):
+    def test_find_minmax(self):
+        random_state = numpy.random.RandomState(0)
+
+        for n_samples in [1024, 1029, 1050, 21, 42]:
+            for window_size in [21, 5]:
+                data = random_state.normal(size=n_samples).astype(numpy.float32)
+
+                self.assertEqual(reference_find_minmax(data, window_size), find_minmax(data, window_size))
+
+    def test_find_minmax_2d(self):
+        random_state = numpy.random.RandomState(1)
+        data = random_state.normal(size=(4, 1024)).astype(numpy.float32)
+
+        [data_min, data_max] = find_minmax(data)
+
+        for index in range(data.shape[0]):
+            self.assertEqual(reference_find_minmax(data[index]), [data_min[index], data_max[index]])
@@ -0,0 +1,158 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+from frontend_digitizers_calibration import stream
+from frontend_digitizers_calibration.startup import StartupProfile, import_in_background
+from tests.benchmark import load_ioc_host_config, CONFIG_FOLDER, CONFIG_FILE
+from tests.clock import FakeClock
+
+
+class TestStartupProfile(unittest.TestCase):
+    def test_stages(self):
+        clock = FakeClock()
+        startup_profile = StartupProfile(clock=clock)
+
+        with startup_profile.stage("connect input"):
+            clock.time += 0.25
+
+        with self.assertRaises(ValueError), startup_profile.stage("configuration"):
+            clock.time += 0.5
+            raise ValueError()
+
+        clock.time += 1
+        with self.assertLogs("frontend_digitizers_calibration.startup") as logs:
+            startup_profile.report()
+
+        self.assertListEqual([("connect input", 0.25), ("configuration", 0.5)], startup_profile.stages)
+        self.assertEqual(1.75, startup_profile.startup_time)
+        self.assertIn("connect input 0.250 s, configuration 0.500 s; ready after 1.750 s", logs.output[0])
+
+        # The stages finishing after the report are logged one by one.
+        with self.assertLogs("frontend_digitizers_calibration.startup") as logs:
+            with startup_profile.stage("preload calibrations"):
+                clock.time += 2
+
+        self.assertIn("'preload calibrations' finished in 2.000 s, 3.750 s after the start", logs.output[0])
+        self.assertEqual(1.75, startup_profile.startup_time)
+
+    def test_disabled(self):
+        startup_profile = StartupProfile(enabled=False)
+
+        with startup_profile.stage("connect input"):
+            pass
+
+        self.assertIs(sys.modules["json"], startup_profile.import_module("json"))
+        startup_profile.report()
+
+        self.assertListEqual([], startup_profile.stages)
+        self.assertIsNone(startup_profile.startup_time)
+
+    def test_import_in_background(self):
+        startup_profile = StartupProfile()
+
+        import_in_background("json", startup_profile).join()
+
+        with self.assertLogs("frontend_digitizers_calibration.startup", "WARNING"):
+            import_in_background("missing_module_for_the_test", startup_profile).join()
+
+        self.assertListEqual(["import json", "import missing_module_for_the_test"],
+                             [name for name, _ in startup_profile.stages])
+
+
+class TestWorkerStreamStartup(unittest.TestCase):
+    def test_order(self):
+        calls = []
+
+        def record(name, return_value=None):
+            def call(*args, **kwargs):
+                calls.append(name)
+                return return_value
+            return call
+
+        worker_pool = mock.Mock(spec=["qsize", "submit", "submit_result", "close"])
+        worker_pool.qsize.return_value = 0
+
+        with mock.patch.object(stream, "WorkerPool", side_effect=record("workers", worker_pool)), \
+                mock.patch.object(stream, "start_metrics", side_effect=record("metrics")), \
+                mock.patch.object(stream, "import_in_background", side_effect=record("import epics")), \
+                mock.patch.object(stream, "connect_input_stream", side_effect=record("input", mock.Mock())), \
+                mock.patch.object(stream, "connect_output_stream", side_effect=record("output", mock.Mock())), \
+                mock.patch.object(stream, "receive_message", side_effect=KeyboardInterrupt):
+
+            stream.start_worker_stream(ioc_host="localhost", ioc_host_config=load_ioc_host_config(),
+                                       config_folder=CONFIG_FOLDER, input_stream_port=9999, output_stream_port=9998,
+                                       non_blocking=False, calibration_cache_size=2, preload_calibrations=False,
+                                       background_calibration_loading=False, uncalibrated_fallback=None,
+                                       calibration_cache_folder=None, workers=2)
+
+        # The workers are forked before any thread is started or socket connected.
+        self.assertListEqual(["workers", "metrics", "import epics", "input", "output"], calls)
+
+    def test_failed_startup(self):
+        worker_pool = mock.Mock(spec=["qsize", "submit", "submit_result", "close"])
+        input_stream = mock.Mock()
+
+        with mock.patch.object(stream, "WorkerPool", return_value=worker_pool), \
+                mock.patch.object(stream, "start_metrics"), \
+                mock.patch.object(stream, "connect_input_stream", return_value=input_stream), \
+                mock.patch.object(stream, "connect_output_stream", side_effect=RuntimeError("Port in use.")):
+
+            with self.assertRaises(RuntimeError):
+                stream.start_worker_stream(ioc_host="localhost", ioc_host_config=load_ioc_host_config(),
+                                           config_folder=CONFIG_FOLDER, input_stream_port=9999,
+                                           output_stream_port=9998, non_blocking=False, calibration_cache_size=2,
+                                           preload_calibrations=False, background_calibration_loading=False,
+                                           uncalibrated_fallback=None, calibration_cache_folder=None, workers=2)
+
+        # The workers are stopped and the input stream disconnected when the output stream cannot be connected.
+        worker_pool.close.assert_called_once_with()
+        input_stream.disconnect.assert_called_once_with()
+
+    def test_temporary_cache_folder(self):
+        cache_folders = []
+
+        def start_worker_stream(calibration_cache_folder, **kwargs):
+            self.assertTrue(os.path.isdir(calibration_cache_folder))
+            cache_folders.append(calibration_cache_folder)
+            raise KeyboardInterrupt()
+
+        with mock.patch.object(stream, "start_worker_stream", side_effect=start_worker_stream):
+            with self.assertRaises(KeyboardInterrupt):
+                stream.start_stream(config_folder=CONFIG_FOLDER, config_file=os.path.basename(CONFIG_FILE),
+                                    input_stream_port=9999, output_stream_port=9998, workers=2,
+                                    calibration_cache_folder=None)
+
+        # The temporary folder of the precompiled calibrations is removed when the stream stops.
+        self.assertEqual(1, len(cache_folders))
+        self.assertFalse(os.path.exists(cache_folders[0]))
+
+
+
+class TestStreamStartup(unittest.TestCase):
+    def test_failed_startup(self):
+        input_stream = mock.Mock()
+
+        with mock.patch.object(stream, "CalibrationManager"), \
+                mock.patch.object(stream, "start_metrics"), \
+                mock.patch.object(stream, "connect_input_stream", return_value=input_stream), \
+                mock.patch.object(stream, "connect_output_stream", side_effect=RuntimeError("Port in use.")):
+
+            with self.assertRaises(RuntimeError):
+                stream.start_stream(config_folder=CONFIG_FOLDER, config_file=os.path.basename(CONFIG_FILE),
+                                    input_stream_port=9999, output_stream_port=9998)
+
+        # The input stream is connected first, and disconnected when the rest of the startup fails.
+        input_stream.disconnect.assert_called_once_with()
+
+    def test_pipelined_workers(self):
+        with mock.patch.object(stream, "start_worker_stream"):
+            with self.assertLogs("frontend_digitizers_calibration.stream", "WARNING"):
+                stream.start_stream(config_folder=CONFIG_FOLDER, config_file=os.path.basename(CONFIG_FILE),
+                                    input_stream_port=9999, output_stream_port=9998, workers=2, pipelined=True,
+                                    calibration_cache_folder=None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from frontend_digitizers_calibration import config
+from frontend_digitizers_calibration.calibration import TimeCalibration, WD_N_CHANNELS, WD_N_CELLS
+from frontend_digitizers_calibration.devices.utils import DevicePlan
+from frontend_digitizers_calibration.time_axis import add_time_axis_references, TimeAxisDeduplicator, \
+    TimeAxisResolver
+from frontend_digitizers_calibration.workers import WorkerMessage
+
+
+class TestTimeAxis(unittest.TestCase):
+    def setUp(self):
+        device_definition = {config.CONFIG_DEVICE_CHANNELS: [{config.CONFIG_CHANNEL_PV_PREFIX: "channel1",
+                                                              config.CONFIG_CHANNEL_NUMBER: 3}]}
+        self.device_plans = {"device": DevicePlan("device", device_definition)}
+
+    def get_data(self, trigger_cell, calibration_id, keep_time_axis):
+        message = WorkerMessage(0, {"channel1-DRS_TC": trigger_cell})
+        data = {"channel1-TIME-AXIS": numpy.arange(WD_N_CELLS, dtype=numpy.float32)}
+
+        add_time_axis_references(message, self.device_plans, data, calibration_id, keep_time_axis)
+
+        return data
+
+    def test_reference(self):
+        data = self.get_data(134, "default-5120MHz", keep_time_axis=False)
+
+        self.assertNotIn("channel1-TIME-AXIS", data)
+        self.assertListEqual([3, 134], list(data["channel1-TIME-AXIS-REF"]))
+        self.assertEqual("default-5120MHz", data["channel1-TIME-AXIS-CALIBRATION"])
+
+    def test_background_reference(self):
+        message = WorkerMessage(0, {"channel1-DRS_TC": 134, "channel1-BG-DRS_TC": 112})
+        data = {"channel1-TIME-AXIS": numpy.arange(WD_N_CELLS, dtype=numpy.float32),
+                "channel1-BG-TIME-AXIS": numpy.arange(WD_N_CELLS, dtype=numpy.float32)}
+
+        add_time_axis_references(message, self.device_plans, data, "default-5120MHz", keep_time_axis=True)
+        TimeAxisDeduplicator().apply(data)
+
+        self.assertIn("channel1-BG-TIME-AXIS", data)
+        self.assertListEqual([3, 134], list(data["channel1-TIME-AXIS-REF"]))
+        self.assertListEqual([3, 112], list(data["channel1-BG-TIME-AXIS-REF"]))
+        self.assertEqual("default-5120MHz", data["channel1-BG-TIME-AXIS-CALIBRATION"])
+
+    def test_deduplicator(self):
+        deduplicator = TimeAxisDeduplicator()
+
+        sent = []
+        for trigger_cell, calibration_id in [(1, "a"), (1, "a"), (2, "a"), (2, "b"), (2, "b")]:
+            data = deduplicator.apply(self.get_data(trigger_cell, calibration_id, keep_time_axis=True))
+            sent.append("channel1-TIME-AXIS" in data)
+
+        self.assertListEqual([True, False, True, True, False], sent)
+
+    def test_uniform_deduplicator(self):
+        deduplicator = TimeAxisDeduplicator()
+
+        sent = []
+        for trigger_cell, calibration_id in [(1, "default-5120MHz"), (2, "default-5120MHz"), (3, "default-2560MHz"),
+                                             (4, "default-2560MHz")]:
+            data = deduplicator.apply(self.get_data(trigger_cell, calibration_id, keep_time_axis=True))
+            sent.append("channel1-TIME-AXIS" in data)
+
+        # The time axis of the default calibrations does not depend on the trigger cell.
+        self.assertListEqual([True, False, True, False], sent)
+
+    def test_not_calibrated(self):
+        message = WorkerMessage(0, {})
+        data = {"channel1-TIME-AXIS": None}
+
+        add_time_axis_references(message, self.device_plans, data, "default-5120MHz", keep_time_axis=False)
+
+        self.assertDictEqual({"channel1-TIME-AXIS": None}, data)
+
+    def test_resolver(self):
+        calibration_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, calibration_folder)
+
+        binary_data = numpy.zeros(1, dtype=TimeCalibration.TimeCalibrationBinaryData)
+        binary_data["version_id"] = b"CAL2"
+        binary_data["dt"] = numpy.random.RandomState(0).uniform(1.9e-10, 2e-10, (WD_N_CHANNELS, WD_N_CELLS))
+        filename = os.path.join(calibration_folder, "wd135-5120.tcal")
+        binary_data.tofile(filename)
+
+        time_calibration = TimeCalibration(filename)
+        resolver = TimeAxisResolver(calibration_folder)
+
+        numpy.testing.assert_array_equal(time_calibration.get_time_axis(134, 3),
+                                         resolver.resolve(time_calibration.calibration_id, [3, 134]))
+
+        default_time_calibration = TimeCalibration()
+        default_time_calibration.load_default(5120)
+        numpy.testing.assert_array_equal(default_time_calibration.get_time_axis(0, 0),
+                                         resolver.resolve(default_time_calibration.calibration_id, [3, 134]))
+
+        # The calibration file changed since the reference was sent.
+        self.assertRaises(ValueError, resolver.resolve, "wd135-5120.tcal-00000000", [3, 134])
@@ -0,0 +1,107 @@
+import os
+import time
+import unittest
+from queue import Queue
+
+from frontend_digitizers_calibration.workers import ReorderBuffer, WorkerPool, WorkerMessage, WorkerPoolError
+
+
+def delayed_square(value):
+    # Earlier items take longer, so they complete out of order.
+    time.sleep(0.001 * (value % 5))
+
+    if value == 7:
+        raise ValueError("Failing item.")
+
+    return value * value
+
+
+def exit_on_item_1(value):
+    if value == 1:
+        # The worker process dies without reporting the item.
+        os._exit(1)
+
+    return value
+
+
+class TestWorkers(unittest.TestCase):
+    def test_reorder_buffer(self):
+        reorder_buffer = ReorderBuffer()
+
+        self.assertListEqual([], reorder_buffer.add(2, "c"))
+        self.assertListEqual([], reorder_buffer.add(1, "b"))
+        self.assertListEqual(["a", "b", "c"], reorder_buffer.add(0, "a"))
+        self.assertListEqual(["d"], reorder_buffer.add(3, "d"))
+        self.assertEqual(0, len(reorder_buffer))
+
+    def test_worker_pool_order(self):
+        output = Queue()
+
+        worker_pool = WorkerPool(n_workers=4,
+                                 worker_function=delayed_square,
+                                 output_function=lambda item, result: output.put((item, result)),
+                                 max_in_flight=8)
+
+        try:
+            for value in range(50):
+                worker_pool.submit(value, value)
+
+            results = [output.get(timeout=5) for _ in range(50)]
+        finally:
+            worker_pool.close()
+
+        # The failing item is passed with a None result, the order is preserved.
+        self.assertListEqual([(value, None if value == 7 else value * value) for value in range(50)], results)
+
+    def test_worker_pool_submit_result(self):
+        output = Queue()
+
+        worker_pool = WorkerPool(n_workers=2,
+                                 worker_function=delayed_square,
+                                 output_function=lambda item, result: output.put((item, result)),
+                                 max_in_flight=8)
+
+        try:
+            for value in range(20):
+                if value % 3:
+                    worker_pool.submit(value, value)
+                else:
+                    worker_pool.submit_result(value, -value)
+
+            results = [output.get(timeout=5) for _ in range(20)]
+        finally:
+            worker_pool.close()
+
+        # The items not processed by the workers keep their place in the order.
+        expected = [(value, None if value == 7 else value * value) if value % 3 else (value, -value)
+                    for value in range(20)]
+        self.assertListEqual(expected, results)
+        self.assertEqual(0, worker_pool.qsize())
+
+    def test_worker_died(self):
+        output = Queue()
+
+        worker_pool = WorkerPool(n_workers=2,
+                                 worker_function=exit_on_item_1,
+                                 output_function=lambda item, result: output.put((item, result)),
+                                 max_in_flight=4,
+                                 result_timeout=1,
+                                 poll_interval=0.1)
+
+        start_time = time.monotonic()
+        try:
+            with self.assertRaisesRegex(WorkerPoolError, "No result for item 1"):
+                for value in range(20):
+                    worker_pool.submit(value, value)
+        finally:
+            worker_pool.close()
+
+        self.assertLess(time.monotonic() - start_time, 5)
+        self.assertEqual((0, 0), output.get(timeout=1))
+        self.assertTrue(output.empty())
+
+    def test_worker_message(self):
+        message = WorkerMessage(10, {"value": 1.5})
+
+        self.assertEqual(10, message.data.pulse_id)
+        self.assertEqual(1.5, message.data.data["value"].value)
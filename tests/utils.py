@@ -4,11 +4,26 @@ import numpy
 from bsread.handlers.compact import Message, Value
 
 
-class MockCalibrationData(object):
+class MockVoltageCalibration(object):
     @staticmethod
     def calibrate(data, trigger_cell, channel_number):
         return data
 
+    @staticmethod
+    def calibrate_many(data, trigger_cells, channel_numbers):
+        return data
+
+
+class MockTimeCalibration(object):
+    @staticmethod
+    def get_time_axis(trigger_cell, channel_number):
+        return numpy.arange(1024, dtype="float32")
+
+
+class MockCalibrationData(object):
+    vcal = MockVoltageCalibration
+    tcal = MockTimeCalibration
+
 
 def mock_notify_epics(data):
     print(data)
@@ -27,6 +42,10 @@ def generate_test_message(n_channels):
         message.data.data["channel%d_prefix-DRS_TC" % i] = Value(134)
         message.data.data["channel%d_prefix-BG-DRS_TC" % i] = Value(112)
         message.data.data["channel%d_prefix-WD-gain-RBa" % i] = Value(3)
+        message.data.data["channel%d_prefix-ROI_sig_min" % i] = Value(100)
+        message.data.data["channel%d_prefix-ROI_sig_max" % i] = Value(300)
+        message.data.data["channel%d_prefix-ROI_bg_min" % i] = Value(0)
+        message.data.data["channel%d_prefix-ROI_bg_max" % i] = Value(90)
 
     return message
 